@@ -1,8 +1,12 @@
 ﻿using System;
 using System.Diagnostics;
 using System.IO;
+using System.Linq;
+using System.Net;
 using System.Net.Http;
 using System.Threading.Tasks;
+using Newtonsoft.Json;
+using Newtonsoft.Json.Linq;
 
 namespace Prova_Esperta
 {
@@ -14,8 +18,8 @@ namespace Prova_Esperta
         private readonly int _port;
         private bool _isRunning = false;
         private readonly HttpClient _httpClient = new HttpClient();
-        private const int MaxConnectionAttempts = 5;
-        private const int RetryDelay = 10000; // 10 secondi di attesa tra i tentativi
+        private const int MaxConnectionAttempts = 600;
+        private const int RetryDelay = 1000; // 1 secondo tra i controlli di /ready (al massimo 10 minuti di warm-up)
 
         public PythonServerManager(string pythonPath = "python", string serverScript = "server.py", int port = 5000)
         {
@@ -38,12 +42,10 @@ namespace Prova_Esperta
             {
                 StatusManager.SetServerConnecting();
 
-                // Se il server è già attivo, non serve avviarlo
+                // Se il server è già attivo, non serve avviarlo: si attende solo che sia pronto
                 if (await IsServerRunningAsync())
                 {
-                    _isRunning = true;
-                    StatusManager.SetServerConnected();
-                    return true;
+                    return await WaitForServerToBeReadyAsync();
                 }
 
                 // Altrimenti si avvia un nuovo processo
@@ -57,12 +59,12 @@ namespace Prova_Esperta
             }
         }
 
-        // Controlla se il server è già attivo sulla porta specificata
+        // Controlla se il server è già attivo sulla porta specificata (anche se i modelli sono ancora in caricamento)
         private async Task<bool> IsServerRunningAsync()
         {
             try
             {
-                var response = await _httpClient.GetAsync($"http://localhost:{_port}");
+                var response = await _httpClient.GetAsync($"http://localhost:{_port}/health");
                 return response.IsSuccessStatusCode;
             }
             catch
@@ -105,24 +107,48 @@ namespace Prova_Esperta
             StatusManager.SetServerConnecting();
         }
 
-        // Attende che il server sia effettivamente pronto
+        // Attende che il server sia effettivamente pronto: /ready risponde 503 finché i modelli sono in caricamento
+        // e 500 quando il caricamento è terminato con componenti in errore (es. file del modello mancante).
+        // Con almeno una rotta pronta ci si connette comunque, mostrando gli errori come avviso
         private async Task<bool> WaitForServerToBeReadyAsync()
         {
             for (int i = 0; i < MaxConnectionAttempts; i++)
             {
                 try
                 {
-                    var response = await _httpClient.GetAsync($"http://localhost:{_port}");
-                    if (response.IsSuccessStatusCode)
+                    var response = await _httpClient.GetAsync($"http://localhost:{_port}/ready");
+                    var (componentErrors, anyRouteReady) = await ReadReadinessAsync(response);
+
+                    if (response.IsSuccessStatusCode || (response.StatusCode == HttpStatusCode.InternalServerError && anyRouteReady))
                     {
                         _isRunning = true;
-                        StatusManager.SetServerConnected();
+                        if (componentErrors == null)
+                        {
+                            StatusManager.SetServerConnected();
+                        }
+                        else
+                        {
+                            StatusManager.SetServerConnectedWithWarnings(componentErrors);
+                        }
                         return true;
                     }
+
+                    if (response.StatusCode == HttpStatusCode.InternalServerError)
+                    {
+                        // Caricamento terminato senza nessuna rotta utilizzabile: inutile continuare ad attendere
+                        throw new InvalidOperationException(StatusManager.FormatComponentErrors(componentErrors ?? response.ReasonPhrase));
+                    }
+
+                    // Il server è in ascolto ma sta ancora caricando i modelli
+                    StatusManager.UpdateStatusMessage(StatusManager.Messages.ServerLoadingModels);
                 }
-                catch
+                catch (HttpRequestException)
                 {
-                    // Fallisce silenziosamente e riprova dopo il delay
+                    // Server non ancora in ascolto: riprova dopo il delay
+                }
+                catch (TaskCanceledException)
+                {
+                    // Timeout della singola richiesta: riprova dopo il delay
                 }
 
                 await Task.Delay(RetryDelay);
@@ -131,6 +157,28 @@ namespace Prova_Esperta
             throw new TimeoutException(StatusManager.Messages.ServerTimeout);
         }
 
+        // Legge dalla risposta di /ready i componenti in errore ("nome: messaggio", oppure null se non ce ne sono)
+        // e se almeno una rotta è pronta
+        private static async Task<(string componentErrors, bool anyRouteReady)> ReadReadinessAsync(HttpResponseMessage response)
+        {
+            try
+            {
+                var body = JObject.Parse(await response.Content.ReadAsStringAsync());
+                string componentErrors = null;
+                if (body["errore"] is JObject errors && errors.HasValues)
+                {
+                    componentErrors = string.Join("; ", errors.Properties().Select(p => $"{p.Name}: {p.Value}"));
+                }
+                bool anyRouteReady = body["rotte"] is JObject routes && routes.Properties().Any(p => p.Value.Type == JTokenType.Boolean && (bool)p.Value);
+                return (componentErrors, anyRouteReady);
+            }
+            catch (JsonException)
+            {
+                // Risposta non JSON: si tratta come caricamento in corso
+                return (null, false);
+            }
+        }
+
         // Arresta il server se è attivo
         public void StopServer()
         {
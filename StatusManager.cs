@@ -20,10 +20,13 @@ namespace Prova_Esperta
             public const string ServerConnectionFailed = "Impossibile connettersi al server";
             public const string ServerDisconnected = "Il server è stato disconnesso";
             public const string ServerReconnectionFailed = "Errore durante la riconnessione";
+            public const string ServerLoadingModels = "Server avviato, caricamento dei modelli in corso...";
 
             // Template di messaggi di connessione con parametri
             public const string ServerConnectionAttempt = "Tentativo {0}/{1} - Server non ancora pronto...";
             public const string ServerConnectionFailedAfterAttempts = "Impossibile connettersi al server dopo {0} tentativi";
+            public const string ServerComponentErrors = "Il server non è riuscito a caricare alcuni componenti: {0}";
+            public const string ServerConnectedWithWarnings = "Server connesso, ma alcuni componenti non sono disponibili: {0}";
 
             // Messaggi di elaborazione richieste
             public const string ProcessingRequest = "Elaborazione in corso...";
@@ -69,6 +72,11 @@ namespace Prova_Esperta
             return string.Format(Messages.ServerConnectionFailedAfterAttempts, attempts);
         }
 
+        public static string FormatComponentErrors(string errors)
+        {
+            return string.Format(Messages.ServerComponentErrors, errors);
+        }
+
         public static string FormatError(string errorMessage)
         {
             return string.Format(Messages.ErrorTemplate, errorMessage);
@@ -87,6 +95,12 @@ namespace Prova_Esperta
             UpdateServerConnectionStatus(true);
         }
 
+        public static void SetServerConnectedWithWarnings(string componentErrors)
+        {
+            UpdateStatusMessage(string.Format(Messages.ServerConnectedWithWarnings, componentErrors));
+            UpdateServerConnectionStatus(true);
+        }
+
         public static void SetServerDisconnected()
         {
             UpdateStatusMessage(Messages.ServerDisconnected);
@@ -0,0 +1,84 @@
+#ammissione.py
+# Controllo di ammissione all'ingresso delle rotte che generano. Una richiesta /generate che non può
+# essere servita in tempi ragionevoli viene rifiutata subito con 429 e Retry-After, prima di spendere
+# traduzione, retrieval e PubMed per una generazione che finirebbe comunque in una coda piena.
+# Le rotte economiche (/search servita dalla cache, /health, /metrics...) non passano di qui.
+import os
+import logging
+from contextlib import contextmanager
+
+from executors import configurazione_stadio, get_stadio
+from metrics import richieste_ammesse
+
+logger = logging.getLogger(__name__)
+
+
+def _limiti_predefiniti():
+    """
+    Richieste /generate ammesse contemporaneamente: quante lo stadio "generazione" può eseguire
+    o tenere in coda. Un solo batch alla volta, che usa comunque la corsia a bassa priorità.
+    """
+    generazione = configurazione_stadio("generazione")
+    return {
+        "interattiva": int(os.environ.get("PROVA_AMMISSIONE_INTERATTIVE", generazione["workers"] + generazione["coda"])),
+        "batch": int(os.environ.get("PROVA_AMMISSIONE_BATCH", "1")),
+    }
+
+
+class AmmissioneRifiutataError(Exception):
+    """Sollevata quando la corsia ha già il numero massimo di richieste ammesse."""
+
+    def __init__(self, corsia, riprova_tra):
+        super().__init__(f"Troppe richieste nella corsia '{corsia}'")
+        self.corsia = corsia
+        self.riprova_tra = riprova_tra
+
+
+class Biglietto:
+    """Ammissione di una richiesta; rilascia() è idempotente, così può essere chiamata da più punti di uscita."""
+
+    def __init__(self, controllo, corsia):
+        self._controllo = controllo
+        self.corsia = corsia
+        self._rilasciato = False
+
+    def rilascia(self):
+        if not self._rilasciato:
+            self._rilasciato = True
+            self._controllo._attive[self.corsia] -= 1
+
+
+class ControlloAmmissione:
+    """Conta le richieste ammesse per corsia. Usato solo dal thread dell'event loop."""
+
+    def __init__(self, limiti=None):
+        self.limiti = limiti or _limiti_predefiniti()
+        self._attive = {corsia: 0 for corsia in self.limiti}
+        self._rifiutate = {corsia: 0 for corsia in self.limiti}
+
+    def entra(self, corsia):
+        """Ammette una richiesta nella corsia o solleva AmmissioneRifiutataError; il biglietto va rilasciato."""
+        if self._attive[corsia] >= self.limiti[corsia]:
+            self._rifiutate[corsia] += 1
+            richieste_ammesse.inc(corsia=corsia, esito="rifiutata")
+            raise AmmissioneRifiutataError(corsia, get_stadio("generazione").stima_attesa())
+        self._attive[corsia] += 1
+        richieste_ammesse.inc(corsia=corsia, esito="ammessa")
+        return Biglietto(self, corsia)
+
+    @contextmanager
+    def ammessa(self, corsia):
+        biglietto = self.entra(corsia)
+        try:
+            yield biglietto
+        finally:
+            biglietto.rilascia()
+
+    def statistiche(self):
+        return {
+            corsia: {"attive": self._attive[corsia], "limite": limite, "rifiutate": self._rifiutate[corsia]}
+            for corsia, limite in self.limiti.items()
+        }
+
+
+ammissione = ControlloAmmissione()
@@ -0,0 +1,92 @@
+#arricchimento.py
+# Arricchimento del corpus in background ("stale-while-revalidate"). In modalità "asincrona", quando FAISS
+# trova pochi documenti ma almeno uno abbastanza simile, la richiesta risponde subito con i risultati locali
+# e la ricerca PubMed con l'ingestione nel corpus per quella query viene accodata qui: la prossima domanda
+# simile trova i documenti già nell'indice. Le query già in coda o in corso non vengono accodate di nuovo.
+import os
+import time
+import queue
+import logging
+import threading
+
+from cache_ricerche import normalizza_query
+from metrics import arricchimenti
+
+logger = logging.getLogger(__name__)
+
+MODALITA = ("sincrona", "asincrona")
+MODALITA_PREDEFINITA = os.environ.get("PROVA_ARRICCHIMENTO", "sincrona")
+# Similarità minima del miglior documento locale per rispondere senza attendere PubMed
+SOGLIA_LOCALE = float(os.environ.get("PROVA_ARRICCHIMENTO_SOGLIA", "0.6"))
+DIMENSIONE_CODA = int(os.environ.get("PROVA_ARRICCHIMENTO_CODA", "64"))
+# Una query già arricchita non viene riaccodata prima di questo intervallo (PubMed può non avere nulla di nuovo)
+RIPROVA_DOPO = float(os.environ.get("PROVA_ARRICCHIMENTO_RIPROVA_SECONDI", "600"))
+
+
+def modalita_richiesta(valore=None):
+    """Modalità per una richiesta: quella indicata dal client, se valida, altrimenti quella configurata."""
+    return valore if valore in MODALITA else MODALITA_PREDEFINITA
+
+
+def risultati_accettabili(risultati, soglia=SOGLIA_LOCALE):
+    """Soglia più bassa di risultati_sufficienti: basta un documento locale con similarità >= soglia."""
+    return any(doc.get("similarity", 0) >= soglia for doc in risultati)
+
+
+class CodaArricchimento:
+    """
+    Coda limitata servita da un solo thread, avviato alla prima query accodata. Il thread non eredita
+    la scadenza né il profilo della richiesta che l'ha accodata: il lavoro continua anche dopo la risposta.
+    """
+
+    def __init__(self, funzione, dimensione=DIMENSIONE_CODA, riprova_dopo=RIPROVA_DOPO):
+        self.funzione = funzione
+        self.riprova_dopo = riprova_dopo
+        self._coda = queue.Queue(dimensione)
+        self._in_corso = set()
+        self._completate = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def accoda(self, query):
+        """Accoda l'arricchimento per la query senza bloccare. Restituisce l'esito (accodata, gia_in_corso, recente, coda_piena)."""
+        chiave = normalizza_query(query)
+        with self._lock:
+            if chiave in self._in_corso:
+                esito = "gia_in_corso"
+            elif time.monotonic() - self._completate.get(chiave, -self.riprova_dopo) < self.riprova_dopo:
+                esito = "recente"
+            else:
+                try:
+                    self._coda.put_nowait((chiave, query))
+                    self._in_corso.add(chiave)
+                    esito = "accodata"
+                except queue.Full:
+                    esito = "coda_piena"
+            if esito == "accodata" and self._thread is None:
+                self._thread = threading.Thread(target=self._ciclo, name="arricchimento-pubmed", daemon=True)
+                self._thread.start()
+        arricchimenti.inc(esito=esito)
+        return esito
+
+    def _ciclo(self):
+        while True:
+            chiave, query = self._coda.get()
+            try:
+                aggiunti = self.funzione(query)
+                arricchimenti.inc(esito="completata")
+                logger.info(f"→ Arricchimento in background completato: {aggiunti} documenti aggiunti per '{query}'")
+            except Exception as e:
+                arricchimenti.inc(esito="errore")
+                logger.warning(f"Arricchimento in background fallito per '{query}': {e}")
+            finally:
+                with self._lock:
+                    self._in_corso.discard(chiave)
+                    ora = time.monotonic()
+                    self._completate[chiave] = ora
+                    # Dimentica le query completate da più di riprova_dopo secondi
+                    self._completate = {c: t for c, t in self._completate.items() if ora - t < self.riprova_dopo}
+
+    def statistiche(self):
+        with self._lock:
+            return {"in_coda": self._coda.qsize(), "in_corso": len(self._in_corso), "recenti": len(self._completate)}
@@ -0,0 +1,549 @@
+#backends.py
+import os
+import json
+import glob
+import time
+import zlib
+import logging
+import threading
+
+from risorse import completa_config
+from scadenze import scadenza_corrente
+
+logger = logging.getLogger(__name__)
+
+# Token speciali rimossi dalle risposte, per formato di prompt
+TOKEN_SPECIALI = {
+    "chatml": ["<|im_start|>", "<|im_end|>", "<|endoftext|>"],
+    "inst": ["[INST]", "[/INST]", "</s>", "<s>"],
+}
+
+# Stop sequence sempre attive, per formato di prompt: la generazione termina alla fine del turno
+STOP_PREDEFINITE = {
+    "chatml": ["<|im_end|>", "<|endoftext|>", "<|im_start|>"],
+    "inst": ["</s>", "[INST]"],
+}
+
+# Configurazione predefinita dei modelli per ogni rotta; può essere sovrascritta da modelli.json.
+# n_threads e n_gpu_layers a None vengono decisi dal governatore delle risorse (vedi risorse.py)
+ROTTE_PREDEFINITE = {
+    # Domande mediche: GPT4All eseguito in un processo separato (vedi reasoning.py)
+    "medica": {
+        "backend": "gpt4all",
+        "modello": None,            # None = primo modello preferito trovato nelle cartelle standard
+        "quantizzazione": None,     # es. "Q4_0": filtra i file del modello per quantizzazione
+        "n_threads": None,
+        "n_ctx": 2048,
+        "n_batch": 8,
+        "formato_prompt": "chatml",
+    },
+    # Domande non mediche: llama.cpp nel processo del server
+    "generale": {
+        "backend": "llama_cpp",
+        "modello": "mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+        "quantizzazione": "Q4_K_M",
+        "n_threads": None,
+        "n_ctx": 2048,
+        "n_batch": 512,
+        "n_gpu_layers": None,
+        "formato_prompt": "inst",
+        # Decodifica speculativa (vedi BackendLlamaCpp): None, "prompt_lookup" oppure "bozza"
+        # con un modello piccolo dello stesso vocabolario indicato in "modello_bozza"
+        "speculativa": os.environ.get("PROVA_SPECULATIVA") or None,
+        "modello_bozza": os.environ.get("PROVA_MODELLO_BOZZA") or None,
+        "token_bozza": 10,
+    },
+}
+
+CONFIG_FILE = "modelli.json"
+
+# Modelli preferiti per GPT4All, cercati in quest'ordine
+MODELLI_PREFERITI = ["qwen2.5", "mistral", "orca", "gpt4all-j", "replit"]
+MODELLI_ESCLUSI = ["falcon"]
+
+
+def cartelle_modelli(cartella_script=True):
+    """
+    Cartelle in cui cercare i file dei modelli. La cartella dello script (dove si trova il GGUF di
+    Mistral) vale solo per i modelli indicati per nome: la scelta automatica del modello GPT4All
+    non deve poter prendere il modello di un'altra rotta o quello di bozza.
+    """
+    user_home = os.path.expanduser("~")
+    cartelle = [
+        os.path.join(user_home, "AppData", "Local", "nomic.ai", "GPT4All"),
+        os.path.join(user_home, ".cache", "gpt4all"),
+        os.path.join("models"),
+    ]
+    if cartella_script:
+        cartelle.append(os.path.dirname(os.path.abspath(__file__)))
+    return cartelle
+
+
+def get_available_models(cartella_script=True):
+    """Restituisce i percorsi di tutti i file di modello trovati nelle cartelle standard."""
+    available_models = []
+    for model_dir in cartelle_modelli(cartella_script):
+        if os.path.exists(model_dir):
+            for ext in [".gguf", ".bin", ".ggml"]:
+                available_models.extend(glob.glob(os.path.join(model_dir, f"*{ext}")))
+    return available_models
+
+
+def risolvi_modello(config):
+    """
+    Trova il file del modello indicato nella configurazione.
+
+    Args:
+        config (dict): Configurazione della rotta (chiavi 'modello' e 'quantizzazione').
+
+    Returns:
+        str: Il percorso del file del modello.
+    """
+    modello = config.get("modello")
+    quantizzazione = (config.get("quantizzazione") or "").lower()
+    if modello and os.path.isabs(modello) and os.path.exists(modello):
+        return modello
+
+    # Senza un modello indicato si cerca, come GPT4All, solo nelle cartelle dei modelli GPT4All
+    candidati = [m for m in get_available_models(cartella_script=bool(modello))
+                 if not any(x in m.lower() for x in MODELLI_ESCLUSI)
+                 and quantizzazione in os.path.basename(m).lower()]
+    if modello:
+        candidati = [m for m in candidati if os.path.basename(m) == os.path.basename(modello)]
+    else:
+        preferiti = [m for nome in MODELLI_PREFERITI for m in candidati if nome in os.path.basename(m).lower()]
+        candidati = preferiti or candidati
+
+    if not candidati:
+        raise FileNotFoundError(f"Nessun modello trovato per la configurazione: {config}")
+    return candidati[0]
+
+
+class BackendGenerazione:
+    """
+    Interfaccia comune dei backend di generazione.
+
+    Le sottoclassi implementano _carica_modello e _stream_token; il resto (prompt,
+    stop sequence, misure di prefill/decodifica, pulizia) è condiviso.
+    """
+
+    nome = "base"
+
+    def __init__(self, config):
+        self.config = dict(config)
+        self.formato = self.config.get("formato_prompt", "chatml")
+        self._modello = None
+        self._lock = threading.Lock()
+
+    @property
+    def caricato(self):
+        return self._modello is not None
+
+    def carica(self):
+        """Carica il modello una sola volta."""
+        with self._lock:
+            if self._modello is None:
+                inizio = time.perf_counter()
+                self._modello = self._carica_modello()
+                logger.info(f"Backend {self.nome} caricato in {time.perf_counter() - inizio:.1f}s: {self.config.get('percorso')}")
+        return self
+
+    def scarica(self):
+        """Rilascia il modello; le generazioni in corso mantengono il proprio riferimento."""
+        with self._lock:
+            self._modello = None
+
+    def costruisci_prompt(self, sistema, utente):
+        """Costruisce il prompt nel formato atteso dal modello."""
+        if self.formato == "inst":
+            return f"[INST] {sistema}\n\n{utente}\n[/INST]"
+        return f"<|im_start|>system\n{sistema}<|im_end|>\n<|im_start|>user\n{utente}<|im_end|>\n<|im_start|>assistant\n"
+
+    def pulisci(self, testo):
+        """Rimuove i token speciali del formato di prompt."""
+        for token in TOKEN_SPECIALI.get(self.formato, []):
+            testo = testo.replace(token, "")
+        return testo.strip()
+
+    def genera_stream(self, prompt, stop=None, conteggio=None, **opzioni):
+        """
+        Genera testo in streaming, interrompendosi alla prima stop sequence.
+        Le opzioni usano nomi comuni (max_tokens, temperatura, top_k, top_p,
+        repeat_penalty, frequency_penalty, presence_penalty); se `conteggio` è un dict,
+        conteggio['token'] riporta i token effettivamente generati dal modello.
+        """
+        # Riferimento locale: una sostituzione a caldo non interrompe la generazione in corso
+        modello = self._modello or self.carica()._modello
+        stop = [s for s in (stop or []) if s]
+        # Caratteri trattenuti per riconoscere stop sequence spezzate su più token
+        trattenuti = max((len(s) for s in stop), default=1) - 1
+        testo = ""
+        emesso = 0
+        for token in self._stream_token(modello, prompt, stop, **opzioni):
+            if conteggio is not None:
+                conteggio["token"] = conteggio.get("token", 0) + 1
+            testo += token
+            posizioni = [testo.find(s, max(0, emesso - trattenuti)) for s in stop]
+            posizioni = [p for p in posizioni if p >= 0]
+            if posizioni:
+                fine = min(posizioni)
+                if fine > emesso:
+                    yield testo[emesso:fine]
+                return
+            sicuro = len(testo) - trattenuti
+            if sicuro > emesso:
+                yield testo[emesso:sicuro]
+                emesso = sicuro
+        if len(testo) > emesso:
+            yield testo[emesso:]
+
+    def genera(self, prompt, stop=None, validatore=None, scadenza=None, **opzioni):
+        """
+        Genera la risposta completa, validandola mentre viene prodotta.
+
+        Args:
+            prompt (str): Il prompt già formattato.
+            stop (list): Stop sequence aggiuntive a quelle del formato.
+            validatore (callable): Funzione (testo_parziale, token) che restituisce il motivo
+                per interrompere la generazione, oppure None per continuare.
+            scadenza (float): Istante time.monotonic() oltre il quale la generazione viene interrotta.
+                La generazione si ferma anche quando la richiesta corrente scade o il client si disconnette.
+
+        Returns:
+            tuple: Il testo generato e le misure {'token', 'prefill', 'decode', 'interruzione'}
+            (durate in secondi, interruzione None se la generazione è terminata normalmente).
+        """
+        inizio = time.perf_counter()
+        primo_token = None
+        parti = []
+        conteggio = {"token": 0}
+        interruzione = None
+        stop = list(stop or []) + STOP_PREDEFINITE.get(self.formato, [])
+        richiesta = scadenza_corrente()
+        stream = self.genera_stream(prompt, stop=stop, conteggio=conteggio, **opzioni)
+        try:
+            for parte in stream:
+                if primo_token is None:
+                    primo_token = time.perf_counter()
+                parti.append(parte)
+                if scadenza is not None and time.monotonic() >= scadenza:
+                    interruzione = "tempo_scaduto"
+                elif richiesta is not None and richiesta.interruzione():
+                    interruzione = richiesta.interruzione()
+                elif validatore is not None:
+                    interruzione = validatore("".join(parti), conteggio["token"])
+                if interruzione:
+                    break
+        finally:
+            # Chiudere lo stream ferma anche la generazione nel backend
+            stream.close()
+        fine = time.perf_counter()
+        primo_token = primo_token or fine
+        return "".join(parti), {"token": conteggio["token"], "prefill": primo_token - inizio,
+                                "decode": fine - primo_token, "interruzione": interruzione}
+
+    def descrizione(self):
+        return {"backend": self.nome, "caricato": self.caricato, **self.config}
+
+    def _carica_modello(self):
+        raise NotImplementedError
+
+    def _stream_token(self, modello, prompt, stop, **opzioni):
+        raise NotImplementedError
+
+
+class BackendGPT4All(BackendGenerazione):
+    nome = "gpt4all"
+
+    def _carica_modello(self):
+        from gpt4all import GPT4All
+
+        parametri = {"allow_download": False, "n_ctx": self.config.get("n_ctx", 2048)}
+        if self.config.get("n_threads"):
+            parametri["n_threads"] = self.config["n_threads"]
+        return GPT4All(self.config["percorso"], **parametri)
+
+    def _stream_token(self, modello, prompt, stop, **opzioni):
+        # La callback restituisce False quando lo stream viene chiuso, fermando GPT4All
+        interrotto = threading.Event()
+        try:
+            yield from modello.generate(
+                prompt,
+                max_tokens=opzioni.get("max_tokens", 250),
+                temp=opzioni.get("temperatura", 0.7),
+                top_k=opzioni.get("top_k", 40),
+                top_p=opzioni.get("top_p", 0.9),
+                repeat_penalty=opzioni.get("repeat_penalty", 1.2),
+                n_batch=self.config.get("n_batch", 8),
+                streaming=True,
+                callback=lambda *_: not interrotto.is_set(),
+            )
+        finally:
+            interrotto.set()
+
+
+class BozzaModello:
+    """
+    Modello di bozza per la decodifica speculativa di llama.cpp: un modello GGUF piccolo, con lo stesso
+    vocabolario del principale, propone in modo greedy i prossimi token. Llama.generate riusa la cache KV
+    del prefisso comune, quindi a ogni passo il modello di bozza valuta solo i token nuovi.
+    """
+
+    def __init__(self, modello, token_bozza=10):
+        self.modello = modello
+        self.token_bozza = token_bozza
+
+    def __call__(self, input_ids, /, **kwargs):
+        import numpy as np
+
+        bozza = []
+        for token in self.modello.generate(list(input_ids), temp=0.0, top_k=1, reset=True):
+            bozza.append(token)
+            if len(bozza) >= self.token_bozza or token == self.modello.token_eos():
+                break
+        return np.array(bozza, dtype=np.intc)
+
+
+class ContatoreBozze:
+    """
+    Conta i passi di verifica e i token proposti dal modello di bozza. I token accettati non sono
+    riportati da llama.cpp: sono stimati da BackendLlamaCpp.genera, quindi anche il tasso è una stima.
+    """
+
+    def __init__(self, bozza):
+        self.bozza = bozza
+        self.passi = 0
+        self.proposti = 0
+        self.accettati = 0
+
+    def __call__(self, input_ids, /, **kwargs):
+        proposta = self.bozza(input_ids, **kwargs)
+        self.passi += 1
+        self.proposti += len(proposta)
+        return proposta
+
+    def tasso_accettazione(self):
+        return round(self.accettati / self.proposti, 3) if self.proposti else None
+
+
+class BackendLlamaCpp(BackendGenerazione):
+    """
+    llama.cpp nel processo del server. Con config["speculativa"] la decodifica è speculativa:
+      - "prompt_lookup": le bozze sono n-grammi ripresi dal prompt (storia e contesto), senza un secondo modello
+      - "bozza": le bozze vengono da un modello piccolo (config["modello_bozza"]) con lo stesso vocabolario
+    Ogni token viene comunque scelto dal modello principale, che verifica le bozze in un solo passaggio:
+    cambia il numero di passaggi, non la qualità della risposta.
+    """
+
+    nome = "llama_cpp"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._bozze = None
+
+    def _crea_bozza(self):
+        modalita = self.config.get("speculativa")
+        token_bozza = self.config.get("token_bozza", 10)
+        if modalita == "prompt_lookup":
+            from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+            return LlamaPromptLookupDecoding(num_pred_tokens=token_bozza)
+        if modalita == "bozza":
+            from llama_cpp import Llama
+            return BozzaModello(Llama(
+                model_path=self.config["percorso_bozza"],
+                n_ctx=self.config.get("n_ctx", 2048),
+                n_threads=self.config.get("n_threads"),
+                n_batch=self.config.get("n_batch", 512),
+                n_gpu_layers=self.config.get("n_gpu_layers") or 0,
+                verbose=False,
+            ), token_bozza)
+        raise ValueError(f"Modalità di decodifica speculativa sconosciuta: {modalita}")
+
+    def _carica_modello(self):
+        from llama_cpp import Llama
+
+        self._bozze = ContatoreBozze(self._crea_bozza()) if self.config.get("speculativa") else None
+        modello = Llama(
+            model_path=self.config["percorso"],
+            n_ctx=self.config.get("n_ctx", 2048),
+            n_threads=self.config.get("n_threads"),
+            n_batch=self.config.get("n_batch", 512),
+            n_gpu_layers=self.config.get("n_gpu_layers") or 0,
+            draft_model=self._bozze,
+            verbose=False,
+        )
+        bozza = self._bozze.bozza if self._bozze is not None else None
+        if isinstance(bozza, BozzaModello) and bozza.modello.n_vocab() != modello.n_vocab():
+            raise ValueError(f"Il modello di bozza ha un vocabolario diverso dal principale "
+                             f"({bozza.modello.n_vocab()} contro {modello.n_vocab()})")
+        return modello
+
+    def genera(self, prompt, stop=None, validatore=None, scadenza=None, **opzioni):
+        """
+        Come BackendGenerazione.genera; con la decodifica speculativa le misure riportano anche
+        'speculativa' e 'bozza' = {'proposti', 'accettati'} per questa generazione.
+        """
+        if not self.caricato:
+            self.carica()
+        bozze = self._bozze
+        if bozze is None:
+            return super().genera(prompt, stop=stop, validatore=validatore, scadenza=scadenza, **opzioni)
+        passi, proposti = bozze.passi, bozze.proposti
+        testo, misure = super().genera(prompt, stop=stop, validatore=validatore, scadenza=scadenza, **opzioni)
+        # Ogni passo di verifica produce i token di bozza accettati più uno del modello principale;
+        # il primo token viene dal prefill, senza bozza. misure["token"] conta i blocchi dello stream
+        # (un carattere multibyte può unirne più di uno): i token generati si ricavano ritokenizzando il testo.
+        # È una stima: mancano i token delle stop sequence e quelli scartati all'interruzione
+        passi, proposti = bozze.passi - passi, bozze.proposti - proposti
+        generati = len(self._modello.tokenize(testo.encode("utf-8"), add_bos=False)) if testo else 0
+        accettati = min(proposti, max(0, generati - 1 - passi))
+        bozze.accettati += accettati
+        misure["speculativa"] = self.config["speculativa"]
+        misure["bozza"] = {"proposti": proposti, "accettati": accettati}
+        return testo, misure
+
+    def descrizione(self):
+        descrizione = super().descrizione()
+        if self._bozze is not None:
+            descrizione["tasso_accettazione_bozze"] = self._bozze.tasso_accettazione()
+        return descrizione
+
+    def _stream_token(self, modello, prompt, stop, **opzioni):
+        for chunk in modello.create_completion(
+            prompt=prompt,
+            max_tokens=opzioni.get("max_tokens", 400),
+            temperature=opzioni.get("temperatura", 0.7),
+            top_k=opzioni.get("top_k", 40),
+            top_p=opzioni.get("top_p", 0.9),
+            repeat_penalty=opzioni.get("repeat_penalty", 1.1),
+            frequency_penalty=opzioni.get("frequency_penalty", 0.0),
+            presence_penalty=opzioni.get("presence_penalty", 0.0),
+            stop=stop or None,
+            stream=True,
+        ):
+            yield chunk['choices'][0]['text']
+
+
+class BackendStub(BackendGenerazione):
+    """
+    Backend finto e deterministico: simula prefill e decodifica con tempi fissi e produce
+    sempre lo stesso testo per lo stesso prompt. Usato da benchmark e test di carico.
+    """
+
+    nome = "stub"
+    PAROLE = ["risposta", "simulata", "dal", "modello", "stub", "per", "il", "benchmark"]
+
+    def _carica_modello(self):
+        return self
+
+    def _stream_token(self, modello, prompt, stop, **opzioni):
+        seme = zlib.crc32(prompt.encode("utf-8"))
+        token = min(opzioni.get("max_tokens", 40), self.config.get("token", 40))
+        time.sleep(self.config.get("prefill", 0.2))
+        pausa = 1.0 / self.config.get("token_al_secondo", 20.0)
+        yield "Risposta:"
+        for i in range(token - 1):
+            time.sleep(pausa)
+            yield " " + self.PAROLE[(seme + i) % len(self.PAROLE)]
+
+
+BACKENDS = {
+    "gpt4all": BackendGPT4All,
+    "llama_cpp": BackendLlamaCpp,
+    "stub": BackendStub,
+}
+
+
+def registra_backend(nome, classe):
+    """Aggiunge un nuovo tipo di backend utilizzabile nella configurazione delle rotte."""
+    BACKENDS[nome] = classe
+
+
+def crea_backend(config):
+    """Crea (senza caricarlo) il backend descritto da una configurazione già risolta."""
+    if config["backend"] not in BACKENDS:
+        raise ValueError(f"Backend sconosciuto: {config['backend']}")
+    return BACKENDS[config["backend"]](config)
+
+
+def risolvi_config(config, rotta=None):
+    """
+    Completa la configurazione con il percorso del file del modello (non serve per lo stub)
+    e, se è indicata la rotta, con i thread assegnati dal governatore delle risorse.
+    """
+    config = completa_config(rotta, config) if rotta is not None else dict(config)
+    if config["backend"] != "stub" and not config.get("percorso"):
+        config["percorso"] = risolvi_modello(config)
+    if config.get("speculativa") == "bozza" and not config.get("percorso_bozza"):
+        if not config.get("modello_bozza"):
+            raise ValueError("La decodifica speculativa 'bozza' richiede modello_bozza")
+        config["percorso_bozza"] = risolvi_modello({"modello": config["modello_bozza"]})
+    return config
+
+
+class RegistroModelli:
+    """
+    Associa a ogni rotta un backend configurabile. I backend vengono caricati alla prima
+    richiesta e possono essere sostituiti a caldo senza riavviare il server.
+    """
+
+    def __init__(self, rotte=None):
+        self._config = {rotta: dict(config) for rotta, config in (rotte or ROTTE_PREDEFINITE).items()}
+        self._backend = {}
+        self._lock = threading.Lock()
+
+    def carica_file(self, percorso=CONFIG_FILE):
+        """Sovrascrive la configurazione delle rotte con il contenuto di un file JSON, se esiste."""
+        if os.path.exists(percorso):
+            with open(percorso, 'r', encoding='utf-8') as f:
+                for rotta, config in json.load(f).items():
+                    self._config[rotta] = {**self._config.get(rotta, {}), **config}
+            logger.info(f"Configurazione modelli caricata da {percorso}")
+
+    def config_risolta(self, rotta):
+        """Configurazione della rotta con il percorso del modello, senza caricarlo."""
+        backend = self._backend.get(rotta)
+        if backend is not None:
+            return dict(backend.config)
+        return risolvi_config(self._config[rotta], rotta)
+
+    def get(self, rotta):
+        """Restituisce il backend caricato della rotta, caricandolo se necessario."""
+        backend = self._backend.get(rotta)
+        if backend is None:
+            with self._lock:
+                backend = self._backend.get(rotta)
+                if backend is None:
+                    backend = crea_backend(risolvi_config(self._config[rotta], rotta))
+                    self._backend[rotta] = backend
+        return backend.carica()
+
+    def sostituisci(self, rotta, config, carica=True):
+        """
+        Sostituisce a caldo il modello di una rotta. Il nuovo backend viene caricato prima
+        dello scambio, così le richieste non restano mai senza modello.
+        """
+        nuova = {**self._config.get(rotta, {}), **config}
+        nuova.pop("percorso", None)
+        nuova.pop("percorso_bozza", None)
+        backend = crea_backend(risolvi_config(nuova, rotta))
+        if carica:
+            backend.carica()
+        with self._lock:
+            vecchio = self._backend.get(rotta)
+            self._config[rotta] = nuova
+            self._backend[rotta] = backend
+        if vecchio is not None:
+            vecchio.scarica()
+        logger.info(f"Modello della rotta '{rotta}' sostituito: {backend.config.get('percorso', backend.nome)}")
+        return backend
+
+    def descrizione(self):
+        return {
+            rotta: self._backend[rotta].descrizione() if rotta in self._backend else {"caricato": False, **config}
+            for rotta, config in self._config.items()
+        }
+
+
+registro = RegistroModelli()
+registro.carica_file()
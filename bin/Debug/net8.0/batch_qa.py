@@ -0,0 +1,108 @@
+#batch_qa.py
+# Pre-calcolo delle risposte per elenchi di domande (es. FAQ) con la pipeline di /generate/batch:
+# traduzione e embedding a lotti, un'unica ricerca FAISS, chiamate PubMed condivise
+# e generazione distribuita sui worker LLM. I risultati vengono scritti in JSONL appena pronti.
+#
+# Uso:
+#   python batch_qa.py domande.txt --output risposte.jsonl         # in-process, con i modelli locali
+#   python batch_qa.py domande.txt --url http://127.0.0.1:5000     # tramite un server già avviato
+#   python batch_qa.py domande.txt --stub                          # traduttore, PubMed e LLM finti
+# Il file delle domande può essere un testo (una domanda per riga), una lista JSON o un file JSONL
+# con il campo "domanda".
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+
+def leggi_domande(percorso):
+    """Legge le domande da un file .txt, .json o .jsonl."""
+    with open(percorso, 'r', encoding='utf-8') as f:
+        contenuto = f.read()
+    if percorso.endswith(".jsonl"):
+        righe = [json.loads(riga) for riga in contenuto.splitlines() if riga.strip()]
+        return [riga["domanda"] if isinstance(riga, dict) else riga for riga in righe]
+    if percorso.endswith(".json"):
+        return [d["domanda"] if isinstance(d, dict) else d for d in json.loads(contenuto)]
+    return [riga.strip() for riga in contenuto.splitlines() if riga.strip()]
+
+
+def scrivi(uscita, risultato):
+    uscita.write(json.dumps(risultato, ensure_ascii=False) + "\n")
+    uscita.flush()
+
+
+async def elabora_in_process(domande, k, uscita):
+    """Esegue la pipeline batch nel processo corrente, senza passare dal server HTTP."""
+    import server
+    from risorse import applica_thread_librerie
+
+    applica_thread_librerie()
+    mediche, documenti = await server.prepara_batch(domande, k)
+    risultati = []
+    async for risultato in server.risposte_batch(domande, mediche, documenti):
+        scrivi(uscita, risultato)
+        risultati.append(risultato)
+    server.chiudi_stadi()
+    return risultati
+
+
+def elabora_via_http(url, domande, k, uscita, dimensione_batch):
+    """Invia le domande a /generate/batch a blocchi e inoltra le righe JSONL man mano che arrivano."""
+    import requests
+
+    risultati = []
+    for inizio in range(0, len(domande), dimensione_batch):
+        blocco = domande[inizio:inizio + dimensione_batch]
+        with requests.post(f"{url}/generate/batch", json={"domande": blocco, "num_results": k}, stream=True, timeout=None) as risposta:
+            risposta.raise_for_status()
+            for riga in risposta.iter_lines():
+                if not riga:
+                    continue
+                risultato = json.loads(riga)
+                # Indice rispetto all'intero file, non al singolo blocco
+                risultato["indice"] += inizio
+                scrivi(uscita, risultato)
+                risultati.append(risultato)
+    return risultati
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Risposte in batch a un elenco di domande, in formato JSONL")
+    parser.add_argument("domande", help="File .txt, .json o .jsonl con le domande")
+    parser.add_argument("--output", help="File JSONL di uscita (predefinito: standard output)")
+    parser.add_argument("--url", help="Usa un server già avviato invece della pipeline in-process")
+    parser.add_argument("--stub", action="store_true", help="Backend finti per traduttore, PubMed e LLM (offline)")
+    parser.add_argument("--num-results", type=int, default=5)
+    parser.add_argument("--dimensione-batch", type=int, default=200, help="Domande per richiesta con --url")
+    args = parser.parse_args()
+
+    domande = leggi_domande(args.domande)
+    if not domande:
+        sys.exit("Nessuna domanda trovata")
+    uscita = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    inizio = time.perf_counter()
+    try:
+        if args.url:
+            risultati = elabora_via_http(args.url.rstrip("/"), domande, args.num_results, uscita, args.dimensione_batch)
+        else:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            if args.stub:
+                import server
+                from stub_backends import installa_stub
+                installa_stub(server)
+            risultati = asyncio.run(elabora_in_process(domande, args.num_results, uscita))
+    finally:
+        if args.output:
+            uscita.close()
+
+    durata = time.perf_counter() - inizio
+    errori = sum(1 for r in risultati if "errore" in r)
+    print(f"{len(risultati)} risposte ({errori} con errore) in {durata:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#benchmark.py
+# Micro-benchmark delle funzioni principali della pipeline, eseguibili offline:
+# PubMed viene rigiocato dalle fixtures XML, gli embedding e FAISS sono reali.
+#
+# Uso: python benchmark.py [--ripetizioni 20] [--solo cerca_documenti] [--json risultati.json]
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import statistics
+
+import requests
+
+from stub_backends import PubMedRegistrato, carica_domande
+
+
+def percentile(valori, p):
+    """Percentile con interpolazione al valore più vicino."""
+    if not valori:
+        return 0.0
+    ordinati = sorted(valori)
+    indice = min(len(ordinati) - 1, int(round(p / 100 * (len(ordinati) - 1))))
+    return ordinati[indice]
+
+
+def riepilogo(nome, durate):
+    """Statistiche di latenza (in millisecondi) e throughput di una serie di misure."""
+    return {
+        "nome": nome,
+        "n": len(durate),
+        "media_ms": round(statistics.mean(durate) * 1000, 2) if durate else 0.0,
+        "p50_ms": round(percentile(durate, 50) * 1000, 2),
+        "p95_ms": round(percentile(durate, 95) * 1000, 2),
+        "p99_ms": round(percentile(durate, 99) * 1000, 2),
+        "al_secondo": round(len(durate) / sum(durate), 2) if durate and sum(durate) > 0 else 0.0,
+    }
+
+
+def stampa_tabella(righe):
+    """Stampa i riepiloghi in una tabella allineata."""
+    intestazione = f"{'benchmark':<36} {'n':>5} {'media':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'op/s':>8}"
+    print(intestazione)
+    print("-" * len(intestazione))
+    for r in righe:
+        print(f"{r['nome']:<36} {r['n']:>5} {r['media_ms']:>8.2f}ms {r['p50_ms']:>8.2f}ms "
+              f"{r['p95_ms']:>8.2f}ms {r['p99_ms']:>8.2f}ms {r['al_secondo']:>8.2f}")
+
+
+def misura_latenze(funzione, ripetizioni, riscaldamento=1, preparazione=None):
+    """
+    Esegue la funzione più volte e restituisce le durate in secondi.
+    La preparazione (se presente) viene eseguita prima di ogni ripetizione, fuori dalla misura.
+    """
+    for _ in range(riscaldamento):
+        if preparazione:
+            preparazione()
+        funzione()
+    durate = []
+    for _ in range(ripetizioni):
+        if preparazione:
+            preparazione()
+        inizio = time.perf_counter()
+        funzione()
+        durate.append(time.perf_counter() - inizio)
+    return durate
+
+
+def installa_pubmed_registrato():
+    """Rigioca le risposte PubMed dalle fixtures invece di chiamare la rete."""
+    import pubmed
+
+    pubmed.requests = types.SimpleNamespace(get=PubMedRegistrato(), RequestException=requests.RequestException)
+
+
+def prepara_corpus(documenti):
+    """Crea nella cartella corrente un indice FAISS con i documenti indicati."""
+    import retriever
+    from create_faiss_index import create_faiss_index
+
+    create_faiss_index(documenti, index_path=retriever.FAISS_INDEX_FILE, ids_path=retriever.ID_MAP_FILE)
+    retriever.save_json(documenti, retriever.DOCS_FILE)
+
+
+def bench_search_pubmed(ripetizioni):
+    from pubmed import search_pubmed
+
+    return [riepilogo("search_pubmed[fixture]", misura_latenze(
+        lambda: search_pubmed("What are the symptoms of a heart attack?", max_results=50), ripetizioni))]
+
+
+def bench_filtra_risultati(ripetizioni):
+    from pubmed import search_pubmed
+    from retriever import filtra_risultati_per_rilevanza
+
+    documenti = search_pubmed("heart attack symptoms", max_results=50)
+    return [riepilogo(f"filtra_risultati_per_rilevanza[{len(documenti)} doc]", misura_latenze(
+        lambda: filtra_risultati_per_rilevanza("What are the symptoms of a heart attack?", [dict(d) for d in documenti]),
+        ripetizioni))]
+
+
+def bench_cerca_documenti(ripetizioni):
+    from pubmed import search_pubmed
+    from retriever import cerca_documenti
+
+    corpus = search_pubmed("medical overview", max_results=50)
+    domanda = "What are the symptoms of a heart attack?"
+
+    # Caso 1: l'indice contiene già il corpus, la risposta arriva da FAISS
+    prepara_corpus(corpus)
+    risultati = [riepilogo("cerca_documenti[faiss]", misura_latenze(lambda: cerca_documenti(domanda, 5), ripetizioni))]
+
+    # Caso 2: indice vuoto, ogni ricerca scarica da PubMed (rigiocato) e aggiorna l'indice
+    risultati.append(riepilogo("cerca_documenti[pubmed+ingestione]", misura_latenze(
+        lambda: cerca_documenti(domanda, 5), ripetizioni, preparazione=lambda: prepara_corpus([]))))
+    return risultati
+
+
+def bench_classifica(ripetizioni):
+    import server
+
+    domande = carica_domande()
+    storia = [{"domanda": domande[0]["it"], "risposta": "Dolore al petto, sudorazione e nausea."}]
+    server.get_esempi_embeddings()
+    risultati = []
+    for etichetta, testo, contesto in [
+        ("medica", domande[0]["en"], []),
+        ("non_medica", domande[8]["en"], []),
+        ("follow-up", domande[-1]["en"], storia),
+    ]:
+        risultati.append(riepilogo(f"classifica_domanda_con_storia[{etichetta}]", misura_latenze(
+            lambda: server.classifica_domanda_con_storia(testo, contesto), ripetizioni)))
+    return risultati
+
+
+BENCHMARK = {
+    "search_pubmed": bench_search_pubmed,
+    "filtra_risultati": bench_filtra_risultati,
+    "cerca_documenti": bench_cerca_documenti,
+    "classifica": bench_classifica,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark offline della pipeline di retrieval e classificazione")
+    parser.add_argument("--ripetizioni", type=int, default=20)
+    parser.add_argument("--solo", choices=sorted(BENCHMARK), action="append", help="Esegue solo i benchmark indicati")
+    parser.add_argument("--json", help="Salva i risultati in un file JSON per confrontarli tra versioni")
+    args = parser.parse_args()
+
+    # Tutti i file dell'indice vengono creati in una cartella temporanea
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cartella_originale = os.getcwd()
+    cartella = tempfile.mkdtemp(prefix="benchmark_")
+    os.chdir(cartella)
+    installa_pubmed_registrato()
+
+    risultati = []
+    try:
+        for nome in args.solo or BENCHMARK:
+            risultati.extend(BENCHMARK[nome](args.ripetizioni))
+    finally:
+        os.chdir(cartella_originale)
+        shutil.rmtree(cartella, ignore_errors=True)
+
+    stampa_tabella(risultati)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(risultati, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#cache_ricerche.py
+# Cache dei risultati di /search. Ogni elemento ricorda la versione del corpus con cui è stato calcolato
+# (il contatore di stato_condiviso, incrementato a ogni scrittura dell'indice): quando il corpus cambia
+# gli elementi diventano automaticamente scaduti, senza invalidazioni esplicite.
+import os
+import json
+import threading
+from collections import OrderedDict
+
+from metrics import cache
+
+CAPACITA_PREDEFINITA = int(os.environ.get("PROVA_CACHE_RICERCHE", "1024"))
+
+
+def normalizza_query(testo):
+    """Minuscole, spazi compattati e punteggiatura finale rimossa: domande equivalenti, stessa chiave."""
+    return " ".join(testo.lower().split()).rstrip("?!. ")
+
+
+def chiave_ricerca(domanda, num_results, filtri=None):
+    # I filtri sui metadati fanno parte della chiave: la stessa domanda filtrata ha risultati diversi
+    return (normalizza_query(domanda), num_results, json.dumps(filtri, sort_keys=True) if filtri else None)
+
+
+class CacheVersionata:
+    """Cache LRU i cui elementi valgono solo per la versione del corpus con cui sono stati calcolati."""
+
+    def __init__(self, nome, capacita=CAPACITA_PREDEFINITA):
+        self.nome = nome
+        self.capacita = capacita
+        self._dati = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chiave, versione):
+        """Restituisce il valore memorizzato per la versione indicata, oppure None."""
+        with self._lock:
+            elemento = self._dati.get(chiave)
+            if elemento is None:
+                esito = "miss"
+            elif elemento[0] != versione:
+                del self._dati[chiave]
+                esito = "scaduta"
+            else:
+                self._dati.move_to_end(chiave)
+                esito = "hit"
+        cache.inc(cache=self.nome, esito=esito)
+        return elemento[1] if esito == "hit" else None
+
+    def put(self, chiave, versione, valore):
+        with self._lock:
+            self._dati[chiave] = (versione, valore)
+            self._dati.move_to_end(chiave)
+            while len(self._dati) > self.capacita:
+                self._dati.popitem(last=False)
+
+    def statistiche(self):
+        with self._lock:
+            return {"elementi": len(self._dati), "capacita": self.capacita}
+
+
+cache_ricerche = CacheVersionata("ricerca")
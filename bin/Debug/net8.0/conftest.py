@@ -0,0 +1,3 @@
+#conftest.py
+# load_test.py è il generatore di carico, non un file di test: pytest non deve raccoglierlo.
+collect_ignore = ["load_test.py"]
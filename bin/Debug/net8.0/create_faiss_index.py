@@ -1,9 +1,10 @@
 #create_faiss_index.py
 import os
 import json
-import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from embedding_onnx import carica_embedder
+import vector_store
+import stato_condiviso
 
 def load_documents(file_path="documents.json"):
     """Carica i documenti da un file JSON, se esiste."""
@@ -18,7 +19,7 @@ def load_documents(file_path="documents.json"):
         return []
 
 def create_faiss_index(documents=None, index_path="faiss_index.index", ids_path="document_ids.json"):
-    """Crea e salva un indice FAISS a partire da una lista di documenti."""
+    """Crea e salva un indice (FAISS o memory-mapped, secondo PROVA_VETTORI) a partire da una lista di documenti."""
     if documents is None:
         documents = load_documents()
         if not documents:
@@ -26,36 +27,40 @@ def create_faiss_index(documents=None, index_path="faiss_index.index", ids_path=
             documents = []
 
     if not documents:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        model = carica_embedder('all-MiniLM-L6-v2')
         dummy = model.encode(["test"]).astype('float32')
-        index = faiss.IndexFlatL2(dummy.shape[1])
-        faiss.write_index(index, index_path)
-        with open(ids_path, 'w', encoding='utf-8') as f:
-            json.dump([], f)
+        with stato_condiviso.blocco_corpus():
+            vector_store.crea_indice(dummy[:0], index_path, d=dummy.shape[1])
+            with open(ids_path, 'w', encoding='utf-8') as f:
+                json.dump([], f)
+            stato_condiviso.incrementa_versione()
         print("Indice FAISS vuoto creato.")
         return
 
     texts = [doc["text"] for doc in documents]
     ids = [doc["id"] for doc in documents]
 
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    model = carica_embedder('all-MiniLM-L6-v2')
     print("Creazione degli embedding...")
     embeddings = model.encode(texts, show_progress_bar=True).astype('float32')
 
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
-
-    faiss.write_index(index, index_path)
-    with open(ids_path, 'w', encoding='utf-8') as f:
-        json.dump(ids, f)
+    # Il blocco evita che i worker del server leggano l'indice a metà scrittura
+    with stato_condiviso.blocco_corpus():
+        vector_store.crea_indice(embeddings, index_path)
+        with open(ids_path, 'w', encoding='utf-8') as f:
+            json.dump(ids, f)
+        stato_condiviso.incrementa_versione()
 
     print(f"Indice FAISS creato con {len(texts)} documenti.")
     print(f"Salvato: {index_path}, Mappatura ID: {ids_path}")
 
 if __name__ == "__main__":
-    if os.path.exists("faiss_index.index"):
-        os.remove("faiss_index.index")
+    # Prima di eliminare il corpus ne salva uno snapshot, ripristinabile con snapshot.py importa
+    if vector_store.esiste_indice("faiss_index.index"):
+        import snapshot
+        percorso, _ = snapshot.esporta(suffisso="-prima-della-ricreazione")
+        print(f"Snapshot del corpus corrente salvato in {percorso}")
+    vector_store.elimina_indice("faiss_index.index")
     if os.path.exists("document_ids.json"):
         os.remove("document_ids.json")
     if os.path.exists("documents.json"):
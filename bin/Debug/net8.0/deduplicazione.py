@@ -0,0 +1,248 @@
+#deduplicazione.py
+# Rilevamento dei quasi-duplicati nel corpus. PubMed restituisce spesso più versioni dello stesso articolo,
+# errata e abstract quasi identici con titoli diversi, che il controllo sull'ID (title[:50]) non riconosce.
+# Due controlli complementari:
+#   - SimHash a 64 bit sugli shingle di parole: testi quasi identici (stesso abstract con piccole modifiche)
+#   - distanza tra embedding: testi riformulati ma con lo stesso contenuto
+#
+# Uso offline (compattazione di un corpus esistente):
+#   python deduplicazione.py compatta [--prova]
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Distanza di Hamming massima tra SimHash e similarità coseno minima per considerare due testi duplicati
+SOGLIA_HAMMING = int(os.environ.get("PROVA_DEDUP_HAMMING", "3"))
+SOGLIA_COSENO = float(os.environ.get("PROVA_DEDUP_COSENO", "0.97"))
+
+BIT_SIMHASH = 64
+PAROLE_PER_SHINGLE = 3
+# Con 4 bande da 16 bit, due firme a distanza <= 3 coincidono per forza in almeno una banda
+BANDE = 4
+
+
+def _shingle(testo):
+    parole = re.findall(r"\w+", testo.lower())
+    if len(parole) < PAROLE_PER_SHINGLE:
+        return [" ".join(parole)] if parole else []
+    return [" ".join(parole[i:i + PAROLE_PER_SHINGLE]) for i in range(len(parole) - PAROLE_PER_SHINGLE + 1)]
+
+
+def simhash(testo):
+    """Firma SimHash a 64 bit del testo."""
+    pesi = [0] * BIT_SIMHASH
+    for shingle in _shingle(testo):
+        valore = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(BIT_SIMHASH):
+            pesi[bit] += 1 if valore >> bit & 1 else -1
+    return sum(1 << bit for bit in range(BIT_SIMHASH) if pesi[bit] > 0)
+
+
+def distanza_hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def firma_documento(doc):
+    """SimHash del documento; viene salvata nel documento stesso per non ricalcolarla a ogni ingestione."""
+    if "simhash" not in doc:
+        doc["simhash"] = format(simhash(doc.get("text", "")), "016x")
+    return int(doc["simhash"], 16)
+
+
+class IndiceSimHash:
+    """Ricerca dei quasi-duplicati per SimHash tramite bande: confronta solo le firme con una banda in comune."""
+
+    def __init__(self, soglia=SOGLIA_HAMMING):
+        self.soglia = soglia
+        self._bande = [{} for _ in range(BANDE)]
+        self._bit_banda = BIT_SIMHASH // BANDE
+
+    def _chiavi(self, firma):
+        maschera = (1 << self._bit_banda) - 1
+        return [(firma >> (i * self._bit_banda)) & maschera for i in range(BANDE)]
+
+    def aggiungi(self, firma, valore):
+        for banda, chiave in zip(self._bande, self._chiavi(firma)):
+            banda.setdefault(chiave, []).append((firma, valore))
+
+    def cerca(self, firma):
+        """Restituisce il valore del primo elemento entro la soglia di Hamming, oppure None."""
+        for banda, chiave in zip(self._bande, self._chiavi(firma)):
+            for altra, valore in banda.get(chiave, ()):
+                if distanza_hamming(firma, altra) <= self.soglia:
+                    return valore
+        return None
+
+
+def filtra_duplicati(candidati, embeddings, documenti_esistenti, index, soglia_coseno=SOGLIA_COSENO):
+    """
+    Seleziona i documenti da aggiungere al corpus, scartando quelli già presenti per ID,
+    quasi identici (SimHash) a un documento esistente o già accettato, oppure troppo vicini
+    nello spazio degli embedding.
+
+    Args:
+        candidati (list): I documenti da aggiungere.
+        embeddings (numpy.ndarray): Gli embedding dei candidati, uno per riga.
+        documenti_esistenti (list): I documenti già nel corpus.
+        index: L'indice dei vettori del corpus (FAISS o ArchivioMmap).
+
+    Returns:
+        tuple: Le posizioni dei candidati accettati e, per ogni candidato scartato, il motivo.
+    """
+    ids = {doc["id"] for doc in documenti_esistenti}
+    simhash_esistenti = IndiceSimHash()
+    for doc in documenti_esistenti:
+        simhash_esistenti.aggiungi(firma_documento(doc), doc["id"])
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+    # Distanza dal vicino più prossimo nell'indice: con vettori normalizzati coseno = 1 - d²/2
+    vicini = None
+    if index is not None and index.ntotal > 0 and len(candidati):
+        distanze, _ = index.search(np.ascontiguousarray(embeddings), 1)
+        vicini = 1 - distanze[:, 0] / 2
+
+    accettati, scartati = [], {}
+    for i, doc in enumerate(candidati):
+        if not doc.get("id") or not doc.get("text", "").strip():
+            scartati[i] = "vuoto"
+        elif doc["id"] in ids:
+            scartati[i] = "id"
+        elif simhash_esistenti.cerca(firma_documento(doc)) is not None:
+            scartati[i] = "simhash"
+        elif vicini is not None and vicini[i] >= soglia_coseno:
+            scartati[i] = "embedding"
+        elif accettati and float(np.max(embeddings[accettati] @ embeddings[i])) >= soglia_coseno:
+            scartati[i] = "embedding"
+        else:
+            accettati.append(i)
+            ids.add(doc["id"])
+            simhash_esistenti.aggiungi(firma_documento(doc), doc["id"])
+    return accettati, scartati
+
+
+def trova_duplicati(documenti, embeddings, soglia_coseno=SOGLIA_COSENO, righe_per_blocco=1024):
+    """
+    Per un corpus intero: mantiene la prima occorrenza di ogni gruppo di quasi-duplicati.
+
+    Returns:
+        list: Per ogni documento, None se viene mantenuto, altrimenti la posizione del documento che lo sostituisce.
+    """
+    sostituto = [None] * len(documenti)
+    simhash_mantenuti = IndiceSimHash()
+    mantenuti = np.zeros(len(documenti), dtype=bool)
+    ids = {}
+
+    for inizio in range(0, len(documenti), righe_per_blocco):
+        fine = min(inizio + righe_per_blocco, len(documenti))
+        # Similarità del blocco con tutti i documenti precedenti (e con se stesso)
+        similarita = embeddings[inizio:fine] @ embeddings[:fine].T
+        for i in range(inizio, fine):
+            doc = documenti[i]
+            precedente = ids.get(doc.get("id"))
+            if precedente is None:
+                precedente = simhash_mantenuti.cerca(firma_documento(doc))
+            if precedente is None:
+                vicini = np.nonzero((similarita[i - inizio, :i] >= soglia_coseno) & mantenuti[:i])[0]
+                precedente = int(vicini[0]) if len(vicini) else None
+            if precedente is not None:
+                sostituto[i] = precedente
+                continue
+            mantenuti[i] = True
+            ids[doc.get("id")] = i
+            simhash_mantenuti.aggiungi(firma_documento(doc), i)
+    return sostituto
+
+
+def slot_duplicati(embeddings, sostituto, query_embs, k=10):
+    """Media, per query, dei posti nei primi k risultati occupati da duplicati di un altro risultato."""
+    gruppo = np.array([i if s is None else s for i, s in enumerate(sostituto)])
+    sprecati = []
+    for query_emb in query_embs:
+        primi = np.argsort(-(embeddings @ query_emb))[:k]
+        sprecati.append(len(primi) - len(set(gruppo[primi].tolist())))
+    return float(np.mean(sprecati)) if sprecati else 0.0
+
+
+def _dimensione_file(*percorsi):
+    return sum(os.path.getsize(p) for p in percorsi if os.path.exists(p))
+
+
+def compatta(prova=False, soglia_coseno=SOGLIA_COSENO, k=10, query_campione=200):
+    """
+    Deduplica il corpus esistente e ricostruisce l'indice con i soli documenti mantenuti.
+    Gli embedding vengono ricalcolati, così indice e mappatura degli ID tornano allineati.
+
+    Returns:
+        dict: Il report con documenti, vettori, spazio su disco e posti nei top-k recuperati.
+    """
+    import retriever
+    import vector_store
+    import stato_condiviso
+
+    with stato_condiviso.blocco_corpus():
+        documenti = retriever.load_json(retriever.DOCS_FILE, [])
+        index = retriever.ensure_faiss_index()
+        vettori_prima = index.ntotal
+        percorsi_indice = [retriever.FAISS_INDEX_FILE] + [
+            p for precisione in ("float16", "int8")
+            for p in vector_store.percorsi_archivio(retriever.FAISS_INDEX_FILE, precisione).values()
+        ]
+        byte_prima = _dimensione_file(retriever.DOCS_FILE, retriever.ID_MAP_FILE, *percorsi_indice)
+
+        logger.info(f"Calcolo degli embedding di {len(documenti)} documenti...")
+        embeddings = retriever.get_model().encode([d.get("text", "") for d in documenti], batch_size=64).astype('float32')
+        embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        sostituto = trova_duplicati(documenti, embeddings, soglia_coseno)
+        mantenuti = [i for i, s in enumerate(sostituto) if s is None]
+
+        # Le query di prova sono i titoli di un campione di documenti mantenuti
+        campione = mantenuti[:: max(1, len(mantenuti) // query_campione)][:query_campione]
+        query_embs = retriever.get_model().encode([documenti[i].get("title", "") for i in campione], batch_size=64).astype('float32') \
+            if campione else np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+        sprecati = slot_duplicati(embeddings, sostituto, query_embs, k)
+
+        report = {
+            "documenti_prima": len(documenti),
+            "documenti_dopo": len(mantenuti),
+            "vettori_prima": vettori_prima,
+            "vettori_dopo": len(mantenuti),
+            "byte_prima": byte_prima,
+            f"slot_duplicati_top{k}_per_query": round(sprecati, 2),
+        }
+
+        if not prova:
+            nuovi_documenti = [documenti[i] for i in mantenuti]
+            vector_store.crea_indice(embeddings[mantenuti], retriever.FAISS_INDEX_FILE, d=embeddings.shape[1])
+            retriever.save_json(nuovi_documenti, retriever.DOCS_FILE)
+            retriever.save_json([d["id"] for d in nuovi_documenti], retriever.ID_MAP_FILE)
+            stato_condiviso.incrementa_versione()
+            report["byte_dopo"] = _dimensione_file(retriever.DOCS_FILE, retriever.ID_MAP_FILE, *percorsi_indice)
+            report["byte_recuperati"] = report["byte_prima"] - report["byte_dopo"]
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Deduplicazione e compattazione offline del corpus")
+    parser.add_argument("comando", choices=["compatta"])
+    parser.add_argument("--prova", action="store_true", help="Calcola il report senza modificare il corpus")
+    parser.add_argument("--soglia-coseno", type=float, default=SOGLIA_COSENO)
+    parser.add_argument("--k", type=int, default=10, help="Top-k usato per misurare i posti occupati da duplicati")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = compatta(prova=args.prova, soglia_coseno=args.soglia_coseno, k=args.k)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#embedding_onnx.py
+# Backend ONNX Runtime con quantizzazione dinamica int8 per i modelli di embedding MiniLM.
+# Con PROVA_EMBEDDING=onnx il server, il retriever e create_faiss_index usano i modelli esportati
+# in PROVA_CARTELLA_ONNX invece di SentenceTransformer in PyTorch (se mancano, si torna a PyTorch).
+#
+# Uso:
+#   python embedding_onnx.py esporta     # esporta e quantizza entrambi i modelli
+#   python embedding_onnx.py verifica    # confronta le similarità coseno con PyTorch
+#   python embedding_onnx.py benchmark   # misura la velocità rispetto a PyTorch
+import os
+import sys
+import json
+import logging
+import argparse
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BACKEND_EMBEDDING = os.environ.get("PROVA_EMBEDDING", "torch")
+CARTELLA_ONNX = os.environ.get("PROVA_CARTELLA_ONNX", "modelli_onnx")
+
+MODELLI = {
+    "retriever": "all-MiniLM-L6-v2",
+    "classificatore": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+}
+
+FILE_FP32 = "modello.onnx"
+FILE_INT8 = "modello_int8.onnx"
+FILE_CONFIG = "config_embedder.json"
+
+# Similarità coseno minima tra embedding PyTorch e ONNX perché la verifica sia superata
+SOGLIA_PARITA = 0.98
+
+
+def cartella_modello(nome):
+    return os.path.join(CARTELLA_ONNX, nome.replace("/", "__"))
+
+
+class EmbedderOnnx:
+    """
+    Embedder compatibile con SentenceTransformer.encode per i parametri usati nel progetto:
+    tokenizzazione con il tokenizer originale, inferenza ONNX Runtime, mean pooling e,
+    se il modello originale lo prevede, normalizzazione L2.
+    """
+
+    backend_embedding = "onnx"
+
+    def __init__(self, nome, cartella=None, quantizzato=True, thread=None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.nome = nome
+        cartella = cartella or cartella_modello(nome)
+        with open(os.path.join(cartella, FILE_CONFIG), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(cartella)
+
+        opzioni = ort.SessionOptions()
+        opzioni.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if thread is None:
+            from risorse import thread_per
+            thread = thread_per("embedding")
+        opzioni.intra_op_num_threads = thread
+        opzioni.inter_op_num_threads = 1
+        percorso = os.path.join(cartella, FILE_INT8 if quantizzato else FILE_FP32)
+        self.sessione = ort.InferenceSession(percorso, opzioni, providers=["CPUExecutionProvider"])
+        self._ingressi = {i.name for i in self.sessione.get_inputs()}
+        self.variante = "onnx-int8" if quantizzato else "onnx-fp32"
+        logger.info(f"Embedder {nome} caricato da {percorso}")
+
+    def _codifica_lotto(self, frasi):
+        token = self.tokenizer(frasi, padding=True, truncation=True,
+                               max_length=self.config["max_seq_length"], return_tensors="np")
+        ingressi = {k: v.astype(np.int64) for k, v in token.items() if k in self._ingressi}
+        stati = self.sessione.run(None, ingressi)[0]
+
+        # Mean pooling sui token reali (esclude il padding), come il modulo Pooling di sentence-transformers
+        maschera = token["attention_mask"][..., None].astype(np.float32)
+        embeddings = (stati * maschera).sum(axis=1) / np.clip(maschera.sum(axis=1), 1e-9, None)
+        if self.config["normalizza"]:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings.astype(np.float32)
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True,
+               convert_to_tensor=False, normalize_embeddings=False, **kwargs):
+        singola = isinstance(sentences, str)
+        frasi = [sentences] if singola else list(sentences)
+
+        lotti = [self._codifica_lotto(frasi[i:i + batch_size]) for i in range(0, len(frasi), batch_size)]
+        embeddings = np.concatenate(lotti) if lotti else np.zeros((0, self.config["dimensione"]), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        if singola:
+            embeddings = embeddings[0]
+        if convert_to_tensor:
+            import torch
+            return torch.from_numpy(embeddings)
+        return embeddings
+
+
+def carica_embedder(nome, backend=BACKEND_EMBEDDING):
+    """
+    Restituisce l'embedder per il modello indicato secondo PROVA_EMBEDDING ("torch" o "onnx").
+    Se il modello ONNX non è stato esportato, usa SentenceTransformer: l'attributo `backend_embedding`
+    dell'embedder restituito indica il backend effettivamente caricato.
+    """
+    if backend == "onnx":
+        try:
+            return EmbedderOnnx(nome)
+        except Exception as e:
+            logger.warning(f"Embedder ONNX per {nome} non disponibile, uso PyTorch: {e}")
+    from sentence_transformers import SentenceTransformer
+    modello = SentenceTransformer(nome)
+    modello.backend_embedding = "torch"
+    return modello
+
+
+def esporta(nome, cartella=None, quantizza=True):
+    """Esporta il trasformatore del modello in ONNX e ne crea la versione quantizzata int8."""
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+
+    cartella = cartella or cartella_modello(nome)
+    os.makedirs(cartella, exist_ok=True)
+    st = SentenceTransformer(nome, device="cpu")
+
+    pooling = next(m for m in st if isinstance(m, models.Pooling))
+    if pooling.get_pooling_mode_str() != "mean":
+        raise ValueError(f"Pooling {pooling.get_pooling_mode_str()} non supportato (solo mean)")
+    trasformatore = st[0].auto_model.eval()
+    esempio = st.tokenizer(["Esempio di frase per l'esportazione"], return_tensors="pt")
+    nomi_ingressi = [k for k in ("input_ids", "attention_mask", "token_type_ids") if k in esempio]
+
+    class _StatiNascosti(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.trasformatore = trasformatore
+
+        def forward(self, *ingressi):
+            return self.trasformatore(**dict(zip(nomi_ingressi, ingressi))).last_hidden_state
+
+    assi = {n: {0: "batch", 1: "sequenza"} for n in nomi_ingressi + ["last_hidden_state"]}
+    percorso_fp32 = os.path.join(cartella, FILE_FP32)
+    with torch.no_grad():
+        torch.onnx.export(_StatiNascosti(), tuple(esempio[k] for k in nomi_ingressi), percorso_fp32,
+                          input_names=nomi_ingressi, output_names=["last_hidden_state"],
+                          dynamic_axes=assi, opset_version=14)
+
+    if quantizza:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(percorso_fp32, os.path.join(cartella, FILE_INT8), weight_type=QuantType.QInt8)
+
+    st.tokenizer.save_pretrained(cartella)
+    with open(os.path.join(cartella, FILE_CONFIG), 'w', encoding='utf-8') as f:
+        json.dump({
+            "modello": nome,
+            "max_seq_length": st.max_seq_length,
+            "dimensione": st.get_sentence_embedding_dimension(),
+            "normalizza": any(isinstance(m, models.Normalize) for m in st),
+        }, f, indent=2)
+    logger.info(f"Modello {nome} esportato in {cartella}")
+    return cartella
+
+
+def frasi_di_prova():
+    """Domande (italiano e inglese) e abstract delle fixtures: testi brevi e lunghi come in produzione."""
+    import xml.etree.ElementTree as ET
+    from stub_backends import carica_domande, carica_fixture
+
+    frasi = [testo for coppia in carica_domande() for testo in (coppia["it"], coppia["en"])]
+    radice = ET.fromstring(carica_fixture("pubmed_efetch.xml", binario=True))
+    frasi.extend(e.text for e in radice.iter("AbstractText") if e.text)
+    return frasi
+
+
+def verifica_parita(nome, frasi, quantizzato=True):
+    """
+    Confronta gli embedding ONNX con quelli PyTorch: similarità coseno per frase,
+    differenza massima sulla matrice delle similarità e accordo sul vicino più prossimo.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    riferimento = SentenceTransformer(nome, device="cpu").encode(frasi, convert_to_numpy=True)
+    onnx = EmbedderOnnx(nome, quantizzato=quantizzato).encode(frasi)
+
+    def normalizza(x):
+        return x / np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-12, None)
+
+    rif_n, onnx_n = normalizza(riferimento), normalizza(onnx)
+    coseni = (rif_n * onnx_n).sum(axis=1)
+    sim_rif, sim_onnx = rif_n @ rif_n.T, onnx_n @ onnx_n.T
+    np.fill_diagonal(sim_rif, -np.inf)
+    np.fill_diagonal(sim_onnx, -np.inf)
+    accordo = float((sim_rif.argmax(axis=1) == sim_onnx.argmax(axis=1)).mean())
+    finite = np.isfinite(sim_rif)
+
+    return {
+        "modello": nome,
+        "frasi": len(frasi),
+        "coseno_min": round(float(coseni.min()), 4),
+        "coseno_medio": round(float(coseni.mean()), 4),
+        "delta_similarita_max": round(float(np.abs(sim_rif[finite] - sim_onnx[finite]).max()), 4),
+        "accordo_vicino_piu_prossimo": round(accordo, 4),
+        "superata": bool(coseni.min() >= SOGLIA_PARITA),
+    }
+
+
+def confronta_velocita(nome, frasi, ripetizioni=20):
+    """Latenza di una singola query e di un'ingestione in blocco, PyTorch contro ONNX int8."""
+    from sentence_transformers import SentenceTransformer
+    from benchmark import misura_latenze, riepilogo
+
+    torch_st = SentenceTransformer(nome, device="cpu")
+    onnx = EmbedderOnnx(nome)
+    breve = nome.split("/")[-1]
+    righe = []
+    for etichetta, embedder in (("torch", torch_st), ("onnx-int8", onnx)):
+        righe.append(riepilogo(f"{breve}[{etichetta}] query", misura_latenze(lambda: embedder.encode([frasi[0]]), ripetizioni)))
+        righe.append(riepilogo(f"{breve}[{etichetta}] blocco {len(frasi)}", misura_latenze(lambda: embedder.encode(frasi), max(3, ripetizioni // 5))))
+    return righe
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Esportazione, verifica e benchmark degli embedder ONNX int8")
+    parser.add_argument("comando", choices=["esporta", "verifica", "benchmark"])
+    parser.add_argument("--modello", choices=sorted(MODELLI) + ["tutti"], default="tutti")
+    parser.add_argument("--ripetizioni", type=int, default=20)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    nomi = list(MODELLI.values()) if args.modello == "tutti" else [MODELLI[args.modello]]
+
+    if args.comando == "esporta":
+        for nome in nomi:
+            esporta(nome)
+    elif args.comando == "verifica":
+        frasi = frasi_di_prova()
+        esiti = [verifica_parita(nome, frasi) for nome in nomi]
+        print(json.dumps(esiti, indent=2))
+        if not all(e["superata"] for e in esiti):
+            sys.exit(1)
+    else:
+        from benchmark import stampa_tabella
+
+        frasi = frasi_di_prova()
+        righe = [r for nome in nomi for r in confronta_velocita(nome, frasi, args.ripetizioni)]
+        stampa_tabella(righe)
+        for i in range(0, len(righe), 4):
+            print(f"{righe[i]['nome'].split('[')[0]}: speedup query x{righe[i]['p50_ms'] / max(righe[i + 2]['p50_ms'], 1e-6):.2f}, "
+                  f"blocco x{righe[i + 1]['p50_ms'] / max(righe[i + 3]['p50_ms'], 1e-6):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#executors.py
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import attesa_coda, lavori_scartati
+from scadenze import scadenza_corrente, RichiestaAnnullataError
+from profilazione import traccia_thread
+
+logger = logging.getLogger(__name__)
+
+# Configurazione predefinita degli stadi della pipeline:
+# - workers: thread dedicati allo stadio
+# - coda: numero massimo di richieste in attesa oltre a quelle in esecuzione
+STADI_PREDEFINITI = {
+    "rete": {"workers": 8, "coda": 64},         # traduzioni e chiamate PubMed
+    "embedding": {"workers": 2, "coda": 128},   # classificazione e ricerca FAISS
+    "generazione": {"workers": 1, "coda": 8},   # modelli LLM (llama.cpp non è thread-safe)
+    "indice": {"workers": 1, "coda": 32},       # scritture sull'indice FAISS, sempre serializzate
+    "amministrazione": {"workers": 1, "coda": 4},  # operazioni lente e rare (es. sostituzione modelli)
+    "memoria": {"workers": 1, "coda": 64},      # aggiornamento dei riassunti di conversazione dopo la risposta
+}
+
+# Numero di campioni di latenza conservati per ogni stadio
+CAMPIONI_LATENZA = 1000
+
+# Corsie di priorità: a parità di stadio le richieste interattive passano prima di quelle batch.
+# La quota indica la parte della coda utilizzabile dalla corsia, così il batch non la riempie mai del tutto
+CORSIE = {
+    "interattiva": {"priorita": 0, "quota_coda": 1.0},
+    "batch": {"priorita": 1, "quota_coda": 0.5},
+}
+
+_corsia_corrente = contextvars.ContextVar("corsia_corrente", default="interattiva")
+
+
+def imposta_corsia(corsia):
+    """Imposta la corsia di priorità della richiesta corrente (e dei task che creerà)."""
+    if corsia not in CORSIE:
+        raise ValueError(f"Corsia sconosciuta: {corsia}")
+    _corsia_corrente.set(corsia)
+
+
+class StadioSaturoError(Exception):
+    """Sollevata quando la coda di uno stadio è piena e la richiesta viene rifiutata."""
+
+    def __init__(self, stadio, riprova_tra=5):
+        super().__init__(f"Coda dello stadio '{stadio}' piena")
+        self.stadio = stadio
+        self.riprova_tra = riprova_tra
+
+
+def _leggi_configurazione(nome, predefinita):
+    """
+    Legge la configurazione di uno stadio, permettendo l'override tramite variabili d'ambiente
+    (es. PROVA_STADIO_GENERAZIONE_WORKERS=2, PROVA_STADIO_GENERAZIONE_CODA=4).
+    """
+    prefisso = f"PROVA_STADIO_{nome.upper()}_"
+    return {
+        "workers": int(os.environ.get(prefisso + "WORKERS", predefinita["workers"])),
+        "coda": int(os.environ.get(prefisso + "CODA", predefinita["coda"])),
+    }
+
+
+def _percentile(valori, p):
+    if not valori:
+        return 0.0
+    ordinati = sorted(valori)
+    indice = min(len(ordinati) - 1, int(round(p / 100 * (len(ordinati) - 1))))
+    return ordinati[indice]
+
+
+class PostiPrioritari:
+    """
+    Posti di esecuzione di uno stadio, uno per worker. Quando sono tutti occupati le richieste
+    attendono in ordine di priorità e poi di arrivo. Usato solo dal thread dell'event loop.
+    """
+
+    def __init__(self, posti):
+        self.liberi = posti
+        self._attese = []
+        self._arrivi = itertools.count()
+
+    @property
+    def in_attesa(self):
+        return sum(1 for *_, futuro in self._attese if not futuro.done())
+
+    async def acquisisci(self, priorita):
+        if self.liberi > 0 and not self._attese:
+            self.liberi -= 1
+            return
+        futuro = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._attese, (priorita, next(self._arrivi), futuro))
+        try:
+            await futuro
+        except asyncio.CancelledError:
+            # Posto assegnato proprio mentre la richiesta veniva annullata: passa al successivo
+            if futuro.done() and not futuro.cancelled():
+                self.rilascia()
+            raise
+
+    def rilascia(self):
+        while self._attese:
+            *_, futuro = heapq.heappop(self._attese)
+            if not futuro.done():
+                futuro.set_result(None)
+                return
+        self.liberi += 1
+
+
+class Stadio:
+    """
+    Executor dedicato a uno stadio della pipeline, con concorrenza e coda limitate
+    e metriche di latenza (attesa in coda ed esecuzione).
+    """
+
+    def __init__(self, nome, workers, coda):
+        self.nome = nome
+        self.workers = workers
+        self.coda = coda
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stadio-{nome}")
+        self._posti = PostiPrioritari(workers)
+        self._in_volo = 0
+        self._attese = deque(maxlen=CAMPIONI_LATENZA)
+        self._esecuzioni = deque(maxlen=CAMPIONI_LATENZA)
+        self.completate = 0
+        self.errori = 0
+        self.rifiutate = 0
+        self.scartate = 0
+
+    async def esegui(self, funzione, *args):
+        """
+        Esegue una funzione bloccante nel pool dello stadio, rispettando la priorità della corsia corrente.
+        Solleva StadioSaturoError se lo stadio ha già raggiunto il limite di richieste per la corsia e
+        RichiestaAnnullataError se la richiesta è scaduta o annullata prima dell'esecuzione.
+        """
+        scadenza = scadenza_corrente()
+        if scadenza is not None and scadenza.interruzione():
+            self._scarta(scadenza.interruzione())
+        corsia = CORSIE[_corsia_corrente.get()]
+        # Il contatore viene modificato solo dal thread dell'event loop
+        if self._in_volo >= self.workers + int(self.coda * corsia["quota_coda"]):
+            self.rifiutate += 1
+            raise StadioSaturoError(self.nome, self.stima_attesa())
+
+        self._in_volo += 1
+        inviata = time.perf_counter()
+        # Il contesto (es. i tempi della richiesta) viene propagato al thread dello stadio
+        contesto = contextvars.copy_context()
+
+        def lavoro():
+            iniziata = time.perf_counter()
+            self._attese.append(iniziata - inviata)
+            attesa_coda.observe(iniziata - inviata, stadio=self.nome)
+            # Una richiesta scaduta o abbandonata durante l'attesa in coda non occupa il worker
+            if scadenza is not None and scadenza.interruzione():
+                self._scarta(scadenza.interruzione())
+            try:
+                with traccia_thread(f"stadio-{self.nome}"):
+                    return funzione(*args)
+            finally:
+                self._esecuzioni.append(time.perf_counter() - iniziata)
+
+        loop = asyncio.get_running_loop()
+
+        def libera_posto(_):
+            # Il posto si libera quando il thread ha finito davvero, anche se la richiesta è stata annullata
+            try:
+                loop.call_soon_threadsafe(self._posti.rilascia)
+            except RuntimeError:
+                pass  # event loop già chiuso allo spegnimento
+
+        try:
+            await self._posti.acquisisci(corsia["priorita"])
+            futuro = self._executor.submit(contesto.run, lavoro)
+            futuro.add_done_callback(libera_posto)
+            risultato = await asyncio.wrap_future(futuro)
+            self.completate += 1
+            return risultato
+        except (asyncio.CancelledError, RichiestaAnnullataError):
+            raise
+        except Exception:
+            self.errori += 1
+            raise
+        finally:
+            self._in_volo -= 1
+
+    def _scarta(self, motivo):
+        self.scartate += 1
+        lavori_scartati.inc(stadio=self.nome, motivo=motivo)
+        raise RichiestaAnnullataError(motivo)
+
+    def stima_attesa(self):
+        """Secondi stimati prima che una nuova richiesta venga eseguita, per l'header Retry-After."""
+        esecuzione = _percentile(list(self._esecuzioni), 50) or 1.0
+        turni = (self._in_volo + self.workers - 1) // self.workers
+        return max(1, min(120, int(round(esecuzione * max(1, turni)))))
+
+    def statistiche(self):
+        """Restituisce lo stato dello stadio e i percentili di latenza in secondi."""
+        attese = list(self._attese)
+        esecuzioni = list(self._esecuzioni)
+        return {
+            "workers": self.workers,
+            "coda": self.coda,
+            "in_volo": self._in_volo,
+            "in_attesa": self._posti.in_attesa,
+            "completate": self.completate,
+            "errori": self.errori,
+            "rifiutate": self.rifiutate,
+            "scartate": self.scartate,
+            "attesa_p50": _percentile(attese, 50),
+            "attesa_p95": _percentile(attese, 95),
+            "esecuzione_p50": _percentile(esecuzioni, 50),
+            "esecuzione_p95": _percentile(esecuzioni, 95),
+            "esecuzione_p99": _percentile(esecuzioni, 99),
+        }
+
+    def chiudi(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_stadi = {}
+
+
+def configurazione_stadio(nome):
+    """Workers e coda configurati per lo stadio (predefiniti o da variabili d'ambiente)."""
+    return _leggi_configurazione(nome, STADI_PREDEFINITI[nome])
+
+
+def get_stadio(nome):
+    """Restituisce lo stadio richiesto, creandolo alla prima chiamata."""
+    if nome not in _stadi:
+        if nome not in STADI_PREDEFINITI:
+            raise ValueError(f"Stadio sconosciuto: {nome}")
+        config = configurazione_stadio(nome)
+        _stadi[nome] = Stadio(nome, config["workers"], config["coda"])
+        logger.info(f"Stadio '{nome}' creato con {config['workers']} workers e coda di {config['coda']}")
+    return _stadi[nome]
+
+
+async def esegui_in_stadio(nome, funzione, *args):
+    """Esegue una funzione bloccante nell'executor dello stadio indicato."""
+    return await get_stadio(nome).esegui(funzione, *args)
+
+
+def statistiche_stadi():
+    """Statistiche di tutti gli stadi creati finora."""
+    return {nome: stadio.statistiche() for nome, stadio in _stadi.items()}
+
+
+def chiudi_stadi():
+    """Chiude tutti gli executor (da chiamare allo spegnimento del server)."""
+    for stadio in _stadi.values():
+        stadio.chiudi()
+    _stadi.clear()
@@ -0,0 +1,126 @@
+#load_test.py
+# Generatore di carico per /generate e /search con report dei percentili per stadio.
+#
+# Uso contro un server già avviato:
+#   python load_test.py --url http://127.0.0.1:5000 --concorrenza 8 --richieste 100
+# Uso offline, con server in-process e backend finti (traduttore, PubMed e LLM deterministici):
+#   python load_test.py --stub --concorrenza 8 --richieste 100
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmark import riepilogo, stampa_tabella
+from stub_backends import carica_domande
+
+
+def avvia_server_stub(porta):
+    """Avvia il server in un thread con i backend finti, in una cartella di lavoro temporanea."""
+    import uvicorn
+    import server
+    from stub_backends import installa_stub
+
+    installa_stub(server)
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=porta, log_level="warning")
+    istanza = uvicorn.Server(config)
+    threading.Thread(target=istanza.run, name="server-stub", daemon=True).start()
+    return istanza
+
+
+def attendi_pronto(url, timeout=600):
+    """Attende che /ready risponda 200 (modelli di embedding caricati)."""
+    scadenza = time.time() + timeout
+    while time.time() < scadenza:
+        try:
+            if requests.get(f"{url}/ready", timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Il server {url} non è diventato pronto entro {timeout} secondi")
+
+
+def esegui_richiesta(url, rotta, domanda):
+    """Invia una richiesta e restituisce durata, esito e tempi per stadio riportati dal server."""
+    inizio = time.perf_counter()
+    try:
+        risposta = requests.post(f"{url}{rotta}", json={"domanda": domanda, "num_results": 5, "includi_tempi": True}, timeout=1800)
+        durata = time.perf_counter() - inizio
+        corpo = risposta.json() if risposta.headers.get("content-type", "").startswith("application/json") else {}
+        return {"rotta": rotta, "durata": durata, "stato": risposta.status_code, "tempi": corpo.get("tempi") or {}}
+    except requests.RequestException as e:
+        return {"rotta": rotta, "durata": time.perf_counter() - inizio, "stato": None, "errore": str(e), "tempi": {}}
+
+
+def genera_carico(url, rotte, domande, concorrenza, totale):
+    """Invia `totale` richieste con `concorrenza` client paralleli, alternando rotte e domande."""
+    lavori = [(rotte[i % len(rotte)], domande[i % len(domande)]["it"]) for i in range(totale)]
+    inizio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrenza) as pool:
+        esiti = list(pool.map(lambda lavoro: esegui_richiesta(url, *lavoro), lavori))
+    return esiti, time.perf_counter() - inizio
+
+
+def report(esiti, durata_totale):
+    """Riepiloghi end-to-end per rotta e per singolo stadio, più il throughput complessivo."""
+    righe = []
+    for rotta in sorted({e["rotta"] for e in esiti}):
+        ok = [e for e in esiti if e["rotta"] == rotta and e["stato"] == 200]
+        righe.append(riepilogo(f"{rotta} (end-to-end)", [e["durata"] for e in ok]))
+
+        # I tempi per stadio arrivano dal server in millisecondi
+        stadi = sorted({stadio for e in ok for stadio in e["tempi"] if stadio != "totale"})
+        for stadio in stadi:
+            righe.append(riepilogo(f"{rotta} · {stadio}", [e["tempi"][stadio] / 1000 for e in ok if stadio in e["tempi"]]))
+
+    falliti = [e for e in esiti if e["stato"] != 200]
+    stampa_tabella(righe)
+    print()
+    print(f"Richieste: {len(esiti)}  completate: {len(esiti) - len(falliti)}  fallite/rifiutate: {len(falliti)}")
+    print(f"Durata: {durata_totale:.2f}s  throughput: {len(esiti) / durata_totale:.2f} richieste/s")
+    return {"stadi": righe, "richieste": len(esiti), "fallite": len(falliti), "durata": durata_totale,
+            "throughput": len(esiti) / durata_totale if durata_totale > 0 else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico per /generate e /search")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--stub", action="store_true", help="Avvia un server in-process con backend finti (offline)")
+    parser.add_argument("--porta", type=int, default=5055, help="Porta del server in-process (--stub)")
+    parser.add_argument("--rotte", default="/generate,/search")
+    parser.add_argument("--concorrenza", type=int, default=4)
+    parser.add_argument("--richieste", type=int, default=40)
+    parser.add_argument("--json", help="Salva il report in un file JSON")
+    args = parser.parse_args()
+
+    url = args.url
+    cartella = None
+    percorso_json = os.path.abspath(args.json) if args.json else None
+    if args.stub:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        cartella = tempfile.mkdtemp(prefix="load_test_")
+        os.chdir(cartella)
+        avvia_server_stub(args.porta)
+        url = f"http://127.0.0.1:{args.porta}"
+
+    try:
+        attendi_pronto(url)
+        esiti, durata = genera_carico(url, args.rotte.split(","), carica_domande(), args.concorrenza, args.richieste)
+        risultato = report(esiti, durata)
+        if percorso_json:
+            with open(percorso_json, "w", encoding="utf-8") as f:
+                json.dump(risultato, f, indent=2)
+    finally:
+        if cartella:
+            shutil.rmtree(cartella, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
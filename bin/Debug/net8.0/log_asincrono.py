@@ -0,0 +1,187 @@
+#log_asincrono.py
+# Logging non bloccante per il server. I thread della pipeline mettono i record in una coda limitata
+# e un thread dedicato (QueueListener) li scrive su console, così la scrittura non rallenta le richieste;
+# se la coda è piena il record viene scartato e contato, mai atteso.
+#   - campi strutturati: logger.info("messaggio", extra=campi(chiave=valore)), in testo o JSON (PROVA_LOG_FORMATO=json)
+#   - campionamento per categoria (nome del logger) sotto WARNING, es. PROVA_LOG_CAMPIONAMENTO="classificazione=0.1"
+#   - corpi grandi (prompt, risposte grezze) con traccia(): nel file rotante PROVA_FILE_TRACCE se impostato,
+#     altrimenti nel log normale solo a livello DEBUG
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+LIVELLO = os.environ.get("PROVA_LOG_LIVELLO", "INFO").upper()
+FORMATO = os.environ.get("PROVA_LOG_FORMATO", "testo")
+FILE_TRACCE = os.environ.get("PROVA_FILE_TRACCE", "")
+MAX_BYTE_TRACCE = 10 * 1024 * 1024
+FILE_TRACCE_CONSERVATI = 5
+DIMENSIONE_CODA = 10000
+
+# Frazione dei record conservati per categoria: i dettagli ripetuti a ogni richiesta vengono campionati
+CAMPIONAMENTO_PREDEFINITO = {
+    "classificazione": 0.1,
+    "retriever.risultati": 0.1,
+}
+
+logger_tracce = logging.getLogger("tracce")
+
+_listener = []
+_gestori_diretti = []
+
+
+def campi(**valori):
+    """Campi strutturati da passare come extra= a una chiamata di logging."""
+    return {"campi": valori}
+
+
+def leggi_campionamento(valore):
+    """Legge "categoria=frazione,..." e lo unisce alle frazioni predefinite."""
+    frequenze = dict(CAMPIONAMENTO_PREDEFINITO)
+    for voce in (valore or "").split(","):
+        if "=" in voce:
+            categoria, frazione = voce.split("=", 1)
+            frequenze[categoria.strip()] = float(frazione)
+    return frequenze
+
+
+class FiltroCampionamento(logging.Filter):
+    """Lascia passare solo una frazione dei record sotto WARNING, per categoria (prefisso più lungo del nome del logger)."""
+
+    def __init__(self, frequenze):
+        super().__init__()
+        self.frequenze = frequenze
+        self._cache = {}
+
+    def _frequenza(self, nome):
+        if nome not in self._cache:
+            parti = nome.split(".")
+            self._cache[nome] = next(
+                (self.frequenze[".".join(parti[:i])] for i in range(len(parti), 0, -1) if ".".join(parti[:i]) in self.frequenze),
+                1.0)
+        return self._cache[nome]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        frequenza = self._frequenza(record.name)
+        return frequenza >= 1.0 or random.random() < frequenza
+
+
+class FormatterStrutturato(logging.Formatter):
+    """Formato testuale del progetto con i campi strutturati in coda (chiave=valore), oppure una riga JSON."""
+
+    def __init__(self, formato=FORMATO):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.json = formato == "json"
+
+    def format(self, record):
+        valori = getattr(record, "campi", None) or {}
+        if self.json:
+            riga = {"ora": self.formatTime(record), "livello": record.levelname, "logger": record.name,
+                    "messaggio": record.getMessage(), **valori}
+            if record.exc_info:
+                riga["eccezione"] = self.formatException(record.exc_info)
+            return json.dumps(riga, ensure_ascii=False, default=str)
+        testo = super().format(record)
+        if valori:
+            testo += " | " + " ".join(f"{chiave}={valore}" for chiave, valore in valori.items())
+        return testo
+
+
+class GestoreCoda(logging.handlers.QueueHandler):
+    """QueueHandler che non blocca e non stampa errori quando la coda è piena: conta i record scartati."""
+
+    def __init__(self, coda):
+        super().__init__(coda)
+        self.scartati = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.scartati += 1
+
+
+def _in_coda(gestori, filtro=None):
+    coda = queue.Queue(DIMENSIONE_CODA)
+    gestore = GestoreCoda(coda)
+    if filtro is not None:
+        gestore.addFilter(filtro)
+    listener = logging.handlers.QueueListener(coda, *gestori, respect_handler_level=True)
+    listener.start()
+    _listener.append(listener)
+    return gestore
+
+
+def _dopo_fork():
+    """Nel processo figlio (reasoner) il thread del listener non esiste: si scrive direttamente."""
+    for nome, gestori in _gestori_diretti:
+        log = logging.getLogger(nome)
+        filtri = []
+        for gestore in list(log.handlers):
+            if isinstance(gestore, GestoreCoda):
+                filtri.extend(gestore.filters)
+                log.removeHandler(gestore)
+        for gestore in gestori:
+            for filtro in filtri:
+                gestore.addFilter(filtro)
+            log.addHandler(gestore)
+    _listener.clear()
+
+
+def configura_logging(livello=LIVELLO, campionamento=None):
+    """
+    Sostituisce i gestori della radice (quelli di basicConfig) con la coda non bloccante.
+    Idempotente: le chiamate successive alla prima non hanno effetto.
+    """
+    if _listener:
+        return
+    formatter = FormatterStrutturato()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+
+    radice = logging.getLogger()
+    for gestore in list(radice.handlers):
+        radice.removeHandler(gestore)
+    radice.setLevel(livello)
+    filtro = FiltroCampionamento(leggi_campionamento(campionamento or os.environ.get("PROVA_LOG_CAMPIONAMENTO")))
+    radice.addHandler(_in_coda([console], filtro))
+    _gestori_diretti.append(("", [console]))
+
+    if FILE_TRACCE:
+        file_tracce = logging.handlers.RotatingFileHandler(
+            FILE_TRACCE, maxBytes=MAX_BYTE_TRACCE, backupCount=FILE_TRACCE_CONSERVATI, encoding='utf-8')
+        file_tracce.setFormatter(formatter)
+        logger_tracce.setLevel(logging.DEBUG)
+        logger_tracce.propagate = False
+        logger_tracce.addHandler(_in_coda([file_tracce]))
+        _gestori_diretti.append(("tracce", [file_tracce]))
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_dopo_fork)
+    atexit.register(chiudi_logging)
+
+
+def chiudi_logging():
+    """Scrive i record ancora in coda e ferma i listener."""
+    while _listener:
+        _listener.pop().stop()
+
+
+def record_scartati():
+    return sum(gestore.scartati for log in (logging.getLogger(), logger_tracce)
+               for gestore in log.handlers if isinstance(gestore, GestoreCoda))
+
+
+def traccia(nome, testo, **valori):
+    """
+    Registra un corpo grande (prompt, risposta grezza) nel file delle tracce, o nel log a livello DEBUG.
+    Il testo non viene formattato se nessuno lo scriverà.
+    """
+    if logger_tracce.isEnabledFor(logging.DEBUG):
+        logger_tracce.debug(f"{nome}:\n{testo}", extra=campi(caratteri=len(testo), **valori))
@@ -0,0 +1,100 @@
+#memoria_conversazione.py
+# Memoria compressa delle conversazioni. Invece degli ultimi tre turni completi, il prompt contiene
+# un riassunto a finestra scorrevole dei turni precedenti (una riga per turno: la domanda e la prima
+# frase della risposta) più l'ultimo turno, il tutto entro un numero fisso di token. Così la lunghezza
+# del prompt, e il tempo di prefill, non crescono con la lunghezza delle risposte.
+# Il riassunto viene aggiornato dopo ogni risposta, fuori dal percorso critico, e salvato nell'archivio
+# delle sessioni (quindi condiviso tra i worker con PROVA_SESSIONI=sqlite).
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Token massimi del contesto storico nel prompt (riassunto + ultimo turno) e dell'ultima risposta
+TOKEN_MASSIMI = int(os.environ.get("PROVA_MEMORIA_TOKEN", "320"))
+TOKEN_ULTIMO_TURNO = int(os.environ.get("PROVA_MEMORIA_TOKEN_ULTIMO", "160"))
+PAROLE_DOMANDA = 30
+PAROLE_RISPOSTA = 40
+# Stima senza tokenizer: circa quattro caratteri per token per i modelli GGUF su testo europeo
+CARATTERI_PER_TOKEN = 4
+
+
+def stima_token(testo):
+    return (len(testo) + CARATTERI_PER_TOKEN - 1) // CARATTERI_PER_TOKEN
+
+
+def _tronca_parole(testo, parole):
+    elenco = testo.split()
+    return " ".join(elenco[:parole]) + ("…" if len(elenco) > parole else "")
+
+
+def _tronca_token(testo, token):
+    massimo = token * CARATTERI_PER_TOKEN
+    if len(testo) <= massimo:
+        return testo
+    return testo[:massimo].rsplit(" ", 1)[0] + "…"
+
+
+def riga_turno(turno):
+    """Riga del riassunto per un turno: la domanda e la prima frase della risposta, entrambe accorciate."""
+    risposta = turno.get("risposta", "").strip()
+    prima_frase = re.split(r"(?<=[.!?])\s", risposta, maxsplit=1)[0]
+    return f"- {_tronca_parole(turno.get('domanda', '').strip(), PAROLE_DOMANDA)} → {_tronca_parole(prima_frase, PAROLE_RISPOSTA)}"
+
+
+def _ultime_entro(righe, token, testo=lambda r: r):
+    """Le righe più recenti la cui lunghezza complessiva resta entro il numero di token indicato."""
+    scelte = []
+    for riga in reversed(righe):
+        token -= stima_token(testo(riga)) + 1
+        if token < 0:
+            break
+        scelte.append(riga)
+    return scelte[::-1]
+
+
+class MemoriaConversazione:
+    """
+    Riassunto per sessione salvato nell'archivio come {"turni": n, "righe": [[indice_turno, riga], ...]}:
+    "turni" è il numero di turni già riassunti, così ogni aggiornamento elabora solo i turni nuovi.
+    """
+
+    def __init__(self, archivio, token_massimi=TOKEN_MASSIMI, token_ultimo_turno=TOKEN_ULTIMO_TURNO):
+        self.archivio = archivio
+        self.token_massimi = token_massimi
+        self.token_ultimo_turno = token_ultimo_turno
+
+    def _riassunto(self, user_id):
+        return self.archivio.riassunto(user_id) or {"turni": 0, "righe": []}
+
+    def aggiorna(self, user_id):
+        """Aggiunge al riassunto i turni nuovi e scarta le righe più vecchie oltre il limite di token."""
+        storia = self.archivio.storia(user_id)
+        riassunto = self._riassunto(user_id)
+        if riassunto["turni"] >= len(storia):
+            return riassunto
+        righe = riassunto["righe"] + [[i, riga_turno(storia[i])] for i in range(riassunto["turni"], len(storia))]
+        riassunto = {"turni": len(storia), "righe": _ultime_entro(righe, self.token_massimi, testo=lambda r: r[1])}
+        self.archivio.salva_riassunto(user_id, riassunto)
+        return riassunto
+
+    def contesto(self, user_id, storia):
+        """
+        Contesto storico per il prompt: riassunto dei turni precedenti e ultimo turno, entro token_massimi.
+        I turni non ancora riassunti (aggiornamento in background non ancora eseguito) vengono riassunti qui.
+        """
+        if not storia:
+            return ""
+        ultimo = len(storia) - 1
+        riassunto = self._riassunto(user_id)
+        righe = [riga for indice, riga in riassunto["righe"] if indice < ultimo]
+        righe += [riga_turno(storia[i]) for i in range(riassunto["turni"], ultimo)]
+
+        ultimo_turno = _tronca_token(
+            f"Domanda: {storia[-1]['domanda']}\nRisposta: {_tronca_token(storia[-1]['risposta'], self.token_ultimo_turno)}",
+            self.token_massimi)
+        righe = _ultime_entro(righe, self.token_massimi - stima_token(ultimo_turno) - 8)
+        if not righe:
+            return ultimo_turno
+        return "Riassunto della conversazione:\n" + "\n".join(righe) + "\n" + ultimo_turno
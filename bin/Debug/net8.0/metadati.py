@@ -0,0 +1,147 @@
+#metadati.py
+# Metadati dei documenti del corpus e ricerca filtrata. All'ingestione ogni articolo PubMed riceve
+# pmid, anno, rivista, tipi di pubblicazione, lingua e le categorie di ListaKeywords.json trovate nel testo.
+# IndiceMetadati tiene, per ogni valore, le righe dell'indice vettoriale che lo hanno: una ricerca filtrata
+# calcola le distanze solo su quelle righe invece di cercare max_search documenti e filtrare dopo.
+#
+# Filtri supportati (tutti facoltativi, combinati in AND):
+#   {"anno_min": 2020, "anno_max": 2024, "categorie": ["diabetes"], "lingue": ["eng"], "tipi": ["Review"]}
+# Dentro una lista i valori sono in OR.
+import os
+import re
+import json
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FILE_CATEGORIE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ListaKeywords.json")
+CHIAVI_FILTRO = ("anno_min", "anno_max", "categorie", "lingue", "tipi")
+
+_espressioni_categorie = None
+_parole_categorie = {}
+_categorie_lock = threading.Lock()
+
+
+def _categorie():
+    """Un'espressione regolare per categoria, costruita una volta dalle parole chiave."""
+    global _espressioni_categorie, _parole_categorie
+    if _espressioni_categorie is None:
+        with _categorie_lock:
+            if _espressioni_categorie is None:
+                try:
+                    with open(FILE_CATEGORIE, 'r', encoding='utf-8') as f:
+                        voci = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Categorie non disponibili ({FILE_CATEGORIE}): {e}")
+                    voci = []
+                _parole_categorie = {voce["category"]: list(voce["keywords"]) for voce in voci if voce.get("keywords")}
+                _espressioni_categorie = {
+                    voce["category"]: re.compile(
+                        r"\b(?:" + "|".join(re.escape(k) for k in voce["keywords"]) + r")\b", re.IGNORECASE)
+                    for voce in voci if voce.get("keywords")
+                }
+    return _espressioni_categorie
+
+
+def categorie_testo(testo):
+    """Categorie di ListaKeywords.json le cui parole chiave compaiono nel testo."""
+    return [categoria for categoria, espressione in _categorie().items() if espressione.search(testo or "")]
+
+
+def parole_chiave_categoria(categoria):
+    """Parole chiave (sinonimi) di una categoria di ListaKeywords.json."""
+    _categorie()
+    return _parole_categorie.get(categoria, [])
+
+
+def normalizza_filtri(filtri):
+    """Tiene solo le chiavi note e non vuote; restituisce None se non resta nessun filtro."""
+    if not filtri:
+        return None
+    normalizzati = {}
+    for chiave in CHIAVI_FILTRO:
+        valore = filtri.get(chiave)
+        if valore is None or valore == [] or valore == "":
+            continue
+        if chiave in ("anno_min", "anno_max"):
+            normalizzati[chiave] = int(valore)
+        else:
+            normalizzati[chiave] = sorted({str(v) for v in ([valore] if isinstance(valore, str) else valore)})
+    return normalizzati or None
+
+
+def documento_soddisfa(doc, filtri):
+    """Indica se un documento rispetta i filtri (documenti senza il metadato richiesto esclusi)."""
+    if not filtri:
+        return True
+    anno = doc.get("anno")
+    if "anno_min" in filtri and (anno is None or anno < filtri["anno_min"]):
+        return False
+    if "anno_max" in filtri and (anno is None or anno > filtri["anno_max"]):
+        return False
+    categorie = doc["categorie"] if "categorie" in doc else categorie_testo(doc.get("text", ""))
+    if "categorie" in filtri and not set(filtri["categorie"]) & set(categorie):
+        return False
+    if "lingue" in filtri and doc.get("lingua") not in filtri["lingue"]:
+        return False
+    if "tipi" in filtri and not set(filtri["tipi"]) & set(doc.get("tipi_pubblicazione", [])):
+        return False
+    return True
+
+
+class IndiceMetadati:
+    """
+    Liste di righe dell'indice vettoriale per anno, categoria, lingua e tipo di pubblicazione.
+    Si costruisce dal corpus in memoria; i documenti senza "categorie" (ingeriti prima dei metadati)
+    vengono classificati dal testo.
+    """
+
+    def __init__(self, documents, id_mapping):
+        per_id = {doc["id"]: doc for doc in documents}
+        self.righe_totali = len(id_mapping)
+        self._anni = np.full(len(id_mapping), -1, dtype=np.int32)
+        liste = {"categorie": {}, "lingue": {}, "tipi": {}}
+        for riga, doc_id in enumerate(id_mapping):
+            doc = per_id.get(doc_id)
+            if doc is None:
+                continue
+            if doc.get("anno") is not None:
+                self._anni[riga] = doc["anno"]
+            categorie = doc["categorie"] if "categorie" in doc else categorie_testo(doc.get("text", ""))
+            valori = {"categorie": categorie, "lingue": [doc["lingua"]] if doc.get("lingua") else [],
+                      "tipi": doc.get("tipi_pubblicazione", [])}
+            for chiave, elenco in valori.items():
+                for valore in elenco:
+                    liste[chiave].setdefault(valore, []).append(riga)
+        self._liste = {chiave: {valore: np.asarray(righe, dtype=np.int64) for valore, righe in per_valore.items()}
+                       for chiave, per_valore in liste.items()}
+
+    def righe(self, filtri):
+        """Righe (ordinate) che rispettano i filtri, oppure None se non c'è nessun filtro."""
+        if not filtri:
+            return None
+        selezione = None
+        for chiave in ("categorie", "lingue", "tipi"):
+            if chiave in filtri:
+                unione = np.unique(np.concatenate(
+                    [self._liste[chiave].get(v, np.zeros(0, dtype=np.int64)) for v in filtri[chiave]]))
+                selezione = unione if selezione is None else np.intersect1d(selezione, unione, assume_unique=True)
+        if "anno_min" in filtri or "anno_max" in filtri:
+            validi = self._anni >= 0
+            if "anno_min" in filtri:
+                validi &= self._anni >= filtri["anno_min"]
+            if "anno_max" in filtri:
+                validi &= self._anni <= filtri["anno_max"]
+            per_anno = np.flatnonzero(validi)
+            selezione = per_anno if selezione is None else np.intersect1d(selezione, per_anno, assume_unique=True)
+        return selezione
+
+    def valori(self):
+        """Valori disponibili per ogni filtro, con il numero di documenti."""
+        anni = self._anni[self._anni >= 0]
+        return {
+            **{chiave: {valore: len(righe) for valore, righe in per_valore.items()} for chiave, per_valore in self._liste.items()},
+            "anni": [int(anni.min()), int(anni.max())] if len(anni) else None,
+        }
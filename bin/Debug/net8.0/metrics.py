@@ -0,0 +1,198 @@
+#metrics.py
+import time
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Bucket predefiniti (in secondi) per le durate degli stadi: dai millisecondi della
+# ricerca FAISS ai minuti di una generazione su CPU
+BUCKET_DURATE = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BUCKET_TOKEN_AL_SECONDO = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _chiave(etichette):
+    return tuple(sorted(etichette.items()))
+
+
+def _formatta_etichette(chiave, extra=None):
+    coppie = list(chiave) + (extra or [])
+    if not coppie:
+        return ""
+    return "{" + ",".join(f'{nome}="{valore}"' for nome, valore in coppie) + "}"
+
+
+class Contatore:
+    """Contatore monotono con etichette, in formato Prometheus 'counter'."""
+
+    tipo = "counter"
+
+    def __init__(self, nome, descrizione):
+        self.nome = nome
+        self.descrizione = descrizione
+        self._valori = {}
+        self._lock = threading.Lock()
+
+    def inc(self, valore=1, **etichette):
+        chiave = _chiave(etichette)
+        with self._lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + valore
+
+    def valore(self, **etichette):
+        return self._valori.get(_chiave(etichette), 0)
+
+    def righe(self):
+        with self._lock:
+            return [f"{self.nome}{_formatta_etichette(k)} {v}" for k, v in self._valori.items()]
+
+
+class Indicatore(Contatore):
+    """Valore istantaneo con etichette, in formato Prometheus 'gauge'."""
+
+    tipo = "gauge"
+
+    def set(self, valore, **etichette):
+        with self._lock:
+            self._valori[_chiave(etichette)] = valore
+
+
+class Istogramma:
+    """Istogramma cumulativo con etichette, in formato Prometheus 'histogram'."""
+
+    tipo = "histogram"
+
+    def __init__(self, nome, descrizione, bucket=BUCKET_DURATE):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.bucket = tuple(bucket)
+        self._serie = {}
+        self._lock = threading.Lock()
+
+    def observe(self, valore, **etichette):
+        chiave = _chiave(etichette)
+        with self._lock:
+            serie = self._serie.get(chiave)
+            if serie is None:
+                serie = self._serie[chiave] = {"conteggi": [0] * len(self.bucket), "somma": 0.0, "totale": 0}
+            for i, limite in enumerate(self.bucket):
+                if valore <= limite:
+                    serie["conteggi"][i] += 1
+            serie["somma"] += valore
+            serie["totale"] += 1
+
+    def righe(self):
+        righe = []
+        with self._lock:
+            for chiave, serie in self._serie.items():
+                for limite, conteggio in zip(self.bucket, serie["conteggi"]):
+                    righe.append(f"{self.nome}_bucket{_formatta_etichette(chiave, [('le', limite)])} {conteggio}")
+                righe.append(f"{self.nome}_bucket{_formatta_etichette(chiave, [('le', '+Inf')])} {serie['totale']}")
+                righe.append(f"{self.nome}_sum{_formatta_etichette(chiave)} {serie['somma']}")
+                righe.append(f"{self.nome}_count{_formatta_etichette(chiave)} {serie['totale']}")
+        return righe
+
+
+_registro = []
+
+
+def _registra(metrica):
+    _registro.append(metrica)
+    return metrica
+
+
+# Metriche del server
+durata_stadio = _registra(Istogramma("prova_durata_stadio_secondi", "Durata di ogni stadio della pipeline"))
+attesa_coda = _registra(Istogramma("prova_attesa_coda_secondi", "Attesa in coda negli executor per stadio"))
+richieste = _registra(Contatore("prova_richieste_totale", "Richieste ricevute per rotta ed esito"))
+cache = _registra(Contatore("prova_cache_totale", "Accessi alle cache per esito (hit/miss)"))
+pubmed_chiamate = _registra(Contatore("prova_pubmed_chiamate_totale", "Chiamate alle API PubMed per tipo ed esito"))
+documenti_corpus = _registra(Indicatore("prova_faiss_documenti", "Numero di vettori nell'indice FAISS"))
+duplicati_scartati = _registra(Contatore("prova_duplicati_scartati_totale", "Documenti scartati all'ingestione come duplicati, per motivo"))
+token_generati = _registra(Contatore("prova_token_generati_totale", "Token generati per modello"))
+generazioni_interrotte = _registra(Contatore("prova_generazioni_interrotte_totale", "Generazioni interrotte in anticipo per modello e motivo"))
+token_al_secondo = _registra(Istogramma("prova_token_al_secondo", "Velocità di decodifica per modello", BUCKET_TOKEN_AL_SECONDO))
+lavori_scartati = _registra(Contatore("prova_lavori_scartati_totale", "Lavori non eseguiti perché la richiesta era scaduta o annullata, per stadio e motivo"))
+richieste_ammesse = _registra(Contatore("prova_ammissione_totale", "Decisioni del controllo di ammissione per corsia ed esito"))
+token_bozza = _registra(Contatore("prova_token_bozza_totale", "Token proposti (esatti) e accettati (stimati) dalla decodifica speculativa, per modello"))
+arricchimenti = _registra(Contatore("prova_arricchimenti_totale", "Arricchimenti PubMed in background per esito"))
+
+
+def esporta_prometheus():
+    """Restituisce tutte le metriche nel formato di testo di Prometheus."""
+    righe = []
+    for metrica in _registro:
+        righe.append(f"# HELP {metrica.nome} {metrica.descrizione}")
+        righe.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+        righe.extend(metrica.righe())
+    return "\n".join(righe) + "\n"
+
+
+class TempiRichiesta:
+    """Raccoglie la durata cumulativa di ogni stadio per una singola richiesta."""
+
+    def __init__(self):
+        self._inizio = time.perf_counter()
+        self._tempi = {}
+        self._lock = threading.Lock()
+
+    def aggiungi(self, stadio, durata):
+        with self._lock:
+            self._tempi[stadio] = self._tempi.get(stadio, 0.0) + durata
+
+    def riepilogo(self):
+        """Durate in millisecondi; gli stadi paralleli possono sommare più del totale."""
+        with self._lock:
+            tempi = {stadio: round(durata * 1000, 1) for stadio, durata in self._tempi.items()}
+        tempi["totale"] = round((time.perf_counter() - self._inizio) * 1000, 1)
+        return tempi
+
+
+# Tempi della richiesta in corso; gli executor propagano il contesto ai thread
+_tempi_correnti = contextvars.ContextVar("tempi_richiesta", default=None)
+
+
+def avvia_tempi_richiesta():
+    """Attiva la raccolta dei tempi per la richiesta corrente e la restituisce."""
+    tempi = TempiRichiesta()
+    _tempi_correnti.set(tempi)
+    return tempi
+
+
+def registra_durata(stadio, durata):
+    """Registra la durata di uno stadio nell'istogramma e nei tempi della richiesta corrente."""
+    durata_stadio.observe(durata, stadio=stadio)
+    tempi = _tempi_correnti.get()
+    if tempi is not None:
+        tempi.aggiungi(stadio, durata)
+
+
+@contextmanager
+def misura(stadio):
+    """Misura la durata del blocco e la registra come stadio."""
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registra_durata(stadio, time.perf_counter() - inizio)
+
+
+def registra_generazione(modello, token, prefill, decode, interruzione=None):
+    """Registra prefill, decodifica e velocità di una generazione LLM."""
+    if interruzione:
+        generazioni_interrotte.inc(modello=modello, motivo=interruzione)
+    registra_durata(f"{modello}_prefill", prefill)
+    registra_durata(f"{modello}_decode", decode)
+    token_generati.inc(token, modello=modello)
+    if decode > 0 and token > 1:
+        token_al_secondo.observe((token - 1) / decode, modello=modello)
+
+
+def cronometrato(stadio):
+    """Decoratore che misura ogni chiamata della funzione come stadio."""
+    def decoratore(funzione):
+        @functools.wraps(funzione)
+        def wrapper(*args, **kwargs):
+            with misura(stadio):
+                return funzione(*args, **kwargs)
+        return wrapper
+    return decoratore
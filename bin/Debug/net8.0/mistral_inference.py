@@ -1,30 +1,25 @@
 #mistral_inference.py
-import os
-from llama_cpp import Llama
+import logging
+from backends import registro
+from metrics import cronometrato, registra_generazione, token_bozza
+from scadenze import controlla_scadenza
 
-# Percorso del modello Mistral in formato GGUF, relativo alla directory corrente
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "mistral-7b-instruct-v0.1.Q4_K_M.gguf")
+logger = logging.getLogger(__name__)
 
-llm = None  # Il modello viene inizializzato una sola volta
+# Rotta del registro dei modelli usata per le domande non mediche
+# (per impostazione predefinita Mistral 7B in formato GGUF tramite llama.cpp)
+ROTTA = "generale"
 
 def initialize_mistral():
-    global llm
-    if llm is None:
-        llm = Llama(
-            model_path=MODEL_PATH,
-            n_ctx=2048,
-            n_threads=8,
-            n_gpu_layers=35,
-            verbose=False
-        )
+    # Il modello viene inizializzato una sola volta dal registro, anche con chiamate concorrenti
+    return registro.get(ROTTA)
 
 def genera_risposta_mistral(domanda: str) -> str:
     return genera_risposta_mistral_con_storia(domanda, storia=[])
 
+@cronometrato("generazione_mistral")
 def genera_risposta_mistral_con_storia(domanda: str, storia: list) -> str:
-    global llm
-    if llm is None:
-        initialize_mistral()
+    backend = initialize_mistral()
 
     storia_testo = ""
     if storia:
@@ -36,20 +31,31 @@ def genera_risposta_mistral_con_storia(domanda: str, storia: list) -> str:
                 blocchi.append(f"Domanda precedente: {dom_prec}\nRisposta precedente: {risp_prec}")
         storia_testo = "\n\n".join(blocchi)
 
-    prompt = (
-        f"[INST] Rispondi in italiano in modo chiaro, conciso e naturale anche se la domanda non è medica.\n\n"
-        f"Domanda: {domanda}\n"
-        f"{storia_testo}\n"
-        f"[/INST]"
+    prompt = backend.costruisci_prompt(
+        "Rispondi in italiano in modo chiaro, conciso e naturale anche se la domanda non è medica.",
+        f"Domanda: {domanda}\n{storia_testo}"
     )
 
-    risposta = llm.create_completion(
-        prompt=prompt,
+    risposta, misure = backend.genera(
+        prompt,
         max_tokens=400,
-        temperature=0.7,
+        temperatura=0.7,
         top_p=0.9,
         frequency_penalty=0.5,
         presence_penalty=0.5,
         stop=["END"]
     )
-    return risposta['choices'][0]['text'].strip()
+    # Con la decodifica speculativa le metriche hanno un nome distinto (es. mistral_prompt_lookup),
+    # così i token/s si confrontano con quelli della decodifica normale
+    nome = f"mistral_{misure['speculativa']}" if misure.get("speculativa") else "mistral"
+    registra_generazione(nome, misure["token"], misure["prefill"], misure["decode"], misure["interruzione"])
+    if misure.get("bozza"):
+        bozza = misure["bozza"]
+        token_bozza.inc(bozza["proposti"], modello=nome, esito="proposti")
+        token_bozza.inc(bozza["accettati"], modello=nome, esito="accettati")
+        if bozza["proposti"]:
+            logger.info(f"Decodifica speculativa: {bozza['accettati']}/{bozza['proposti']} token di bozza accettati "
+                        f"({bozza['accettati'] / bozza['proposti']:.0%})")
+    # Generazione interrotta perché la richiesta è scaduta o il client se n'è andato: la risposta parziale non serve
+    controlla_scadenza()
+    return backend.pulisci(risposta)
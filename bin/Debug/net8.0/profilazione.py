@@ -0,0 +1,318 @@
+#profilazione.py
+# Profilazione delle richieste, in due modalità:
+#   - su richiesta (header X-Profilo: campionamento|cprofile, oppure POST /admin/profilo per le prossime N
+#     richieste): stack campionati ogni 5 ms, o cProfile, per tutti i thread degli stadi che lavorano per la
+#     richiesta e per il processo del reasoner. Il risultato va in PROVA_CARTELLA_PROFILI in formato "folded"
+#     (flamegraph.pl, speedscope, inferno) e, con cprofile, anche .prof (pstats, snakeviz).
+#   - continua: le stesse richieste campionate ogni 50 ms, con costo trascurabile; si conservano solo i
+#     profili delle N richieste più lente.
+# I thread vengono attribuiti alla richiesta tramite contextvars, come i tempi e la scadenza.
+import os
+import sys
+import time
+import heapq
+import pstats
+import cProfile
+import logging
+import itertools
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CARTELLA_PROFILI = os.environ.get("PROVA_CARTELLA_PROFILI", "profili")
+MODALITA = ("campionamento", "cprofile")
+INTERVALLO_SU_RICHIESTA = 0.005
+INTERVALLO_CONTINUO = float(os.environ.get("PROVA_PROFILO_INTERVALLO", "0.05"))
+PROFILO_CONTINUO = os.environ.get("PROVA_PROFILO_CONTINUO", "1") == "1"
+PROFILI_LENTI = int(os.environ.get("PROVA_PROFILI_LENTI", "10"))
+PROFONDITA_MASSIMA = 128
+
+_profilo_corrente = contextvars.ContextVar("profilo_corrente", default=None)
+
+
+def _nome_frame(frame):
+    codice = frame.f_code
+    return f"{codice.co_name} ({os.path.basename(codice.co_filename)}:{codice.co_firstlineno})"
+
+
+def stack_folded(frame, radice):
+    """Stack del frame in formato folded: radice;chiamante;...;funzione."""
+    nomi = []
+    while frame is not None and len(nomi) < PROFONDITA_MASSIMA:
+        nomi.append(_nome_frame(frame))
+        frame = frame.f_back
+    nomi.append(radice)
+    return ";".join(reversed(nomi))
+
+
+def scrivi_folded(percorso, campioni):
+    with open(percorso, 'w', encoding='utf-8') as f:
+        for stack, conteggio in campioni.most_common():
+            f.write(f"{stack} {conteggio}\n")
+
+
+class Campionatore:
+    """
+    Thread unico che campiona gli stack dei thread registrati, ciascuno con l'intervallo del proprio profilo.
+    Senza thread registrati resta fermo.
+    """
+
+    def __init__(self):
+        self._reinizializza()
+        # Dopo un fork (processo del reasoner) il thread di campionamento non esiste più nel figlio
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reinizializza)
+
+    def _reinizializza(self):
+        self._registrati = {}
+        self._lock = threading.Lock()
+        self._risveglio = threading.Event()
+        self._thread = None
+
+    def registra(self, tid, profilo, radice):
+        with self._lock:
+            self._registrati.setdefault(tid, []).append([profilo, radice, 0.0])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._ciclo, name="campionatore-profili", daemon=True)
+                self._thread.start()
+        self._risveglio.set()
+
+    def rimuovi(self, tid, profilo):
+        with self._lock:
+            voci = [v for v in self._registrati.get(tid, []) if v[0] is not profilo]
+            if voci:
+                self._registrati[tid] = voci
+            else:
+                self._registrati.pop(tid, None)
+
+    def _ciclo(self):
+        while True:
+            with self._lock:
+                registrati = {tid: list(voci) for tid, voci in self._registrati.items()}
+            if not registrati:
+                self._risveglio.wait()
+                self._risveglio.clear()
+                continue
+            ora = time.perf_counter()
+            frames = sys._current_frames()
+            for tid, voci in registrati.items():
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                for voce in voci:
+                    profilo, radice, prossimo = voce
+                    if ora >= prossimo:
+                        profilo.aggiungi(stack_folded(frame, radice))
+                        voce[2] = ora + profilo.intervallo
+            del frames
+            time.sleep(min(v[0].intervallo for voci in registrati.values() for v in voci))
+
+
+campionatore = Campionatore()
+
+
+class Profilo:
+    """Profilo di una richiesta: stack campionati (ed eventualmente statistiche cProfile) dei thread che lavorano per lei."""
+
+    _progressivo = itertools.count(1)
+
+    def __init__(self, modalita, rotta=""):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._progressivo)}"
+        self.modalita = modalita
+        self.rotta = rotta
+        self.intervallo = INTERVALLO_CONTINUO if modalita == "continuo" else INTERVALLO_SU_RICHIESTA
+        self.campioni = Counter()
+        self.inizio = time.perf_counter()
+        self.durata = None
+        self._statistiche = None
+        self._lock = threading.Lock()
+
+    @property
+    def su_richiesta(self):
+        return self.modalita != "continuo"
+
+    @contextmanager
+    def thread(self, radice):
+        """Attribuisce al profilo il lavoro del thread corrente per la durata del blocco."""
+        profiler = None
+        if self.modalita == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Da Python 3.12 può essere attivo un solo profiler alla volta: si ripiega sul campionamento
+                profiler = None
+        if profiler is None:
+            campionatore.registra(threading.get_ident(), self, radice)
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.aggiungi_statistiche(profiler)
+            else:
+                campionatore.rimuovi(threading.get_ident(), self)
+
+    def aggiungi(self, stack, conteggio=1):
+        with self._lock:
+            self.campioni[stack] += conteggio
+
+    def aggiungi_statistiche(self, origine):
+        """Unisce statistiche cProfile (un profiler o un file .prof)."""
+        with self._lock:
+            if self._statistiche is None:
+                self._statistiche = pstats.Stats(origine)
+            else:
+                self._statistiche.add(origine)
+
+    def unisci_processo(self, base, radice="reasoner_processo"):
+        """Unisce i file scritti da esegui_profilato in un processo figlio, poi li elimina."""
+        if os.path.exists(base + ".folded"):
+            with open(base + ".folded", 'r', encoding='utf-8') as f:
+                for riga in f:
+                    stack, _, conteggio = riga.rstrip("\n").rpartition(" ")
+                    if stack:
+                        self.aggiungi(f"{radice};{stack}", int(conteggio))
+            os.remove(base + ".folded")
+        if os.path.exists(base + ".prof"):
+            self.aggiungi_statistiche(base + ".prof")
+            os.remove(base + ".prof")
+
+    def percorso_processo(self, cartella=CARTELLA_PROFILI):
+        os.makedirs(cartella, exist_ok=True)
+        return os.path.join(cartella, f"{self.id}-processo-{next(self._progressivo)}")
+
+    def chiudi(self):
+        self.durata = time.perf_counter() - self.inizio
+
+    def scrivi(self, cartella=CARTELLA_PROFILI):
+        """Scrive il profilo su disco e restituisce i percorsi dei file creati."""
+        os.makedirs(cartella, exist_ok=True)
+        base = os.path.join(cartella, self.id)
+        file = []
+        with self._lock:
+            if self.campioni:
+                scrivi_folded(base + ".folded", self.campioni)
+                file.append(base + ".folded")
+            if self._statistiche is not None:
+                self._statistiche.dump_stats(base + ".prof")
+                file.append(base + ".prof")
+        return file
+
+
+class ProfiliLenti:
+    """Conserva su disco i profili continui delle N richieste più lente."""
+
+    def __init__(self, n=PROFILI_LENTI, cartella=os.path.join(CARTELLA_PROFILI, "lenti")):
+        self.n = n
+        self.cartella = cartella
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def proponi(self, profilo):
+        with self._lock:
+            if self.n <= 0 or not profilo.campioni:
+                return
+            if len(self._heap) >= self.n and profilo.durata <= self._heap[0][0]:
+                return
+            voce = (profilo.durata, profilo.id, profilo.rotta, profilo.scrivi(self.cartella))
+            heapq.heappush(self._heap, voce)
+            if len(self._heap) > self.n:
+                for percorso in heapq.heappop(self._heap)[3]:
+                    if os.path.exists(percorso):
+                        os.remove(percorso)
+
+    def elenco(self):
+        with self._lock:
+            return [
+                {"id": id_, "rotta": rotta, "durata": round(durata, 3), "file": [os.path.basename(p) for p in file]}
+                for durata, id_, rotta, file in sorted(self._heap, reverse=True)
+            ]
+
+
+profili_lenti = ProfiliLenti()
+
+# Profilazione attivata da /admin/profilo per le prossime richieste
+_armate = {"richieste": 0, "modalita": "campionamento"}
+_armate_lock = threading.Lock()
+
+
+def arma(richieste, modalita="campionamento"):
+    """Profila su richiesta le prossime `richieste` richieste."""
+    if modalita not in MODALITA:
+        raise ValueError(f"Modalità sconosciuta: {modalita}")
+    with _armate_lock:
+        _armate["richieste"] = max(0, richieste)
+        _armate["modalita"] = modalita
+    return dict(_armate)
+
+
+def modalita_richiesta(header=None):
+    """Modalità per una nuova richiesta: dall'header, da /admin/profilo, continua oppure None."""
+    if header in MODALITA:
+        return header
+    with _armate_lock:
+        if _armate["richieste"] > 0:
+            _armate["richieste"] -= 1
+            return _armate["modalita"]
+    return "continuo" if PROFILO_CONTINUO else None
+
+
+def avvia_profilo(modalita, rotta=""):
+    """Crea il profilo della richiesta corrente e lo restituisce."""
+    profilo = Profilo(modalita, rotta)
+    _profilo_corrente.set(profilo)
+    return profilo
+
+
+def profilo_corrente():
+    return _profilo_corrente.get()
+
+
+def termina_profilo(profilo):
+    """
+    Chiude il profilo. Quelli su richiesta vengono scritti subito, quelli continui solo se
+    sono tra i più lenti. Restituisce i file scritti per la richiesta.
+    """
+    profilo.chiudi()
+    if not profilo.su_richiesta:
+        profili_lenti.proponi(profilo)
+        return []
+    file = profilo.scrivi()
+    logger.info(f"Profilo della richiesta {profilo.rotta} ({profilo.durata:.2f}s) scritto in {', '.join(file) or 'nessun file'}")
+    return file
+
+
+@contextmanager
+def traccia_thread(radice):
+    """Attribuisce il lavoro del thread corrente al profilo della richiesta, se ce n'è uno."""
+    profilo = _profilo_corrente.get()
+    if profilo is None:
+        yield
+        return
+    with profilo.thread(radice):
+        yield
+
+
+def esegui_profilato(modalita, base, funzione, *args):
+    """
+    Target per multiprocessing.Process: esegue la funzione profilandola nel processo figlio e
+    scrive base.folded o base.prof, che il processo principale unisce con Profilo.unisci_processo.
+    """
+    if modalita == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return funzione(*args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(base + ".prof")
+    profilo = Profilo(modalita)
+    try:
+        with profilo.thread("processo"):
+            return funzione(*args)
+    finally:
+        scrivi_folded(base + ".folded", profilo.campioni)
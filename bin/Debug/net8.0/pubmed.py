@@ -3,6 +3,9 @@ import requests
 import xml.etree.ElementTree as ET
 import logging
 import re
+from metrics import misura, pubmed_chiamate
+from scadenze import timeout_rete, controlla_scadenza
+from metadati import categorie_testo
 
 # Configura il logging
 logging.basicConfig(level=logging.INFO)
@@ -28,29 +31,103 @@ def pre_elabora_query(query):
 
     return ' '.join(expanded_keywords)
 
-def search_pubmed(query, max_results=3):
+URL_ESEARCH = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+URL_EFETCH = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+
+def cerca_id_pubmed(query, retmax=100):
+    """Esegue esearch e restituisce gli ID PubMed in ordine di rilevanza (lista vuota in caso di errore)."""
     query_elaborata = pre_elabora_query(query)
     logger.info(f"[PubMed] Query elaborata: {query_elaborata}")
 
-    # Step 1: Cerca ID articoli su PubMed
-    base_url_search = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
     params_search = {
         "db": "pubmed",
         "term": query_elaborata,
-        "retmax": 100,  # cerca più ID per evitare risultati errati
+        "retmax": retmax,  # cerca più ID per evitare risultati errati
         "retmode": "xml",
         "sort": "relevance"
     }
 
     try:
-        response_search = requests.get(base_url_search, params=params_search, timeout=10)
-        response_search.raise_for_status()
+        with misura("pubmed_esearch"):
+            response_search = requests.get(URL_ESEARCH, params=params_search, timeout=timeout_rete(10))
+            response_search.raise_for_status()
+        pubmed_chiamate.inc(tipo="esearch", esito="ok")
     except requests.RequestException as e:
+        pubmed_chiamate.inc(tipo="esearch", esito="errore")
         logger.error(f"[PubMed] Errore nella ricerca: {e}")
         return []
 
     root_search = ET.fromstring(response_search.content)
-    ids = [id_elem.text for id_elem in root_search.findall(".//Id")]
+    return [id_elem.text for id_elem in root_search.findall(".//Id")]
+
+def _anno_pubblicazione(article):
+    """Anno dalla PubDate (Year, oppure le prime quattro cifre di MedlineDate, es. "2019 Jan-Feb")."""
+    anno = article.findtext(".//Journal/JournalIssue/PubDate/Year")
+    if not anno:
+        anno = article.findtext(".//Journal/JournalIssue/PubDate/MedlineDate") or ""
+    trovato = re.match(r"\s*(\d{4})", anno)
+    return int(trovato.group(1)) if trovato else None
+
+def metadati_articolo(article, pmid, testo):
+    """Metadati usati dalla ricerca filtrata (vedi metadati.py)."""
+    return {
+        "pmid": pmid,
+        "anno": _anno_pubblicazione(article),
+        "rivista": (article.findtext(".//Journal/Title") or "").strip() or None,
+        "tipi_pubblicazione": [t.text.strip() for t in article.findall(".//PublicationTypeList/PublicationType") if t.text],
+        "lingua": (article.findtext(".//Article/Language") or "").strip() or None,
+        "categorie": categorie_testo(testo),
+    }
+
+def scarica_articoli(ids):
+    """
+    Esegue una singola efetch per gli ID indicati.
+
+    Returns:
+        list: Coppie (pmid, documento) per gli articoli con abstract significativo, nell'ordine di PubMed.
+    """
+    params_fetch = {
+        "db": "pubmed",
+        "id": ",".join(ids),
+        "retmode": "xml"
+    }
+
+    try:
+        with misura("pubmed_efetch"):
+            response_fetch = requests.get(URL_EFETCH, params=params_fetch, timeout=timeout_rete(10))
+            response_fetch.raise_for_status()
+        pubmed_chiamate.inc(tipo="efetch", esito="ok")
+    except requests.RequestException as e:
+        pubmed_chiamate.inc(tipo="efetch", esito="errore")
+        logger.error(f"[PubMed] Errore nel recupero dettagli: {e}")
+        return []
+
+    root_fetch = ET.fromstring(response_fetch.content)
+    articoli = []
+
+    for article in root_fetch.findall(".//PubmedArticle"):
+        pmid_elem = article.find(".//PMID")
+        title_elem = article.find(".//ArticleTitle")
+        abstract_elem = article.find(".//Abstract/AbstractText")
+
+        title = title_elem.text.strip() if title_elem is not None and title_elem.text else ""
+        abstract = abstract_elem.text.strip() if abstract_elem is not None and abstract_elem.text else ""
+
+        # Aggiungi solo articoli con abstract significativo
+        if abstract and len(abstract) > 60:
+            pmid = pmid_elem.text if pmid_elem is not None else None
+            testo = f"{title}\n\n{abstract}"
+            articoli.append((pmid, {
+                "id": title[:50] if title else "No title",
+                "title": title if title else "No title",
+                "text": testo,
+                **metadati_articolo(article, pmid, testo)
+            }))
+
+    return articoli
+
+def search_pubmed(query, max_results=3):
+    ids = cerca_id_pubmed(query)
 
     if not ids:
         logger.info("[PubMed] Nessun articolo trovato.")
@@ -58,42 +135,13 @@ def search_pubmed(query, max_results=3):
 
     logger.info(f"[PubMed] Trovati {len(ids)} ID da esaminare")
 
-    # Step 2: Recupera i dettagli degli articoli
-    base_url_fetch = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+    # Recupera i dettagli degli articoli a blocchi, fermandosi appena ce ne sono abbastanza
     results = []
     batch_size = 20
     for i in range(0, len(ids), batch_size):
-        id_batch = ids[i:i+batch_size]
-        params_fetch = {
-            "db": "pubmed",
-            "id": ",".join(id_batch),
-            "retmode": "xml"
-        }
-
-        try:
-            response_fetch = requests.get(base_url_fetch, params=params_fetch, timeout=10)
-            response_fetch.raise_for_status()
-        except requests.RequestException as e:
-            logger.error(f"[PubMed] Errore nel recupero dettagli: {e}")
-            continue
-
-        root_fetch = ET.fromstring(response_fetch.content)
-
-        for article in root_fetch.findall(".//PubmedArticle"):
-            title_elem = article.find(".//ArticleTitle")
-            abstract_elem = article.find(".//Abstract/AbstractText")
-
-            title = title_elem.text.strip() if title_elem is not None and title_elem.text else ""
-            abstract = abstract_elem.text.strip() if abstract_elem is not None and abstract_elem.text else ""
-
-            # Aggiungi solo articoli con abstract significativo
-            if abstract and len(abstract) > 60:
-                results.append({
-                    "id": title[:50] if title else "No title",
-                    "title": title if title else "No title",
-                    "text": f"{title}\n\n{abstract}"
-                })
-
+        controlla_scadenza()
+        for _, documento in scarica_articoli(ids[i:i+batch_size]):
+            results.append(documento)
             if len(results) >= max_results:
                 break
 
@@ -102,3 +150,26 @@ def search_pubmed(query, max_results=3):
 
     logger.info(f"[PubMed] Restituiti {len(results)} articoli con abstract validi")
     return results
+
+def search_pubmed_batch(queries, max_results=3, ids_per_query=60, batch_size=200):
+    """
+    Versione di search_pubmed per più query: un'esearch per query (l'API non ne accetta più di una),
+    poi efetch condivise sull'unione degli ID, così gli articoli comuni vengono scaricati una volta sola.
+
+    Returns:
+        list: Per ogni query, la lista dei documenti come restituita da search_pubmed.
+    """
+    ids_per_domanda = []
+    for query in queries:
+        controlla_scadenza()
+        ids_per_domanda.append(cerca_id_pubmed(query)[:ids_per_query])
+    unione = list(dict.fromkeys(pmid for ids in ids_per_domanda for pmid in ids))
+    logger.info(f"[PubMed] {len(queries)} query, {sum(map(len, ids_per_domanda))} ID di cui {len(unione)} distinti")
+
+    articoli = {}
+    for i in range(0, len(unione), batch_size):
+        controlla_scadenza()
+        articoli.update((pmid, documento) for pmid, documento in scarica_articoli(unione[i:i+batch_size]) if pmid)
+
+    # Copie distinte per query: i documenti vengono poi annotati con la similarità
+    return [[dict(articoli[pmid]) for pmid in ids if pmid in articoli][:max_results] for ids in ids_per_domanda]
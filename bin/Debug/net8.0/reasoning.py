@@ -1,85 +1,189 @@
 #reasoning.py
 import os
-import glob
 import logging
 import multiprocessing
-import time
+import threading
 import traceback
-from gpt4all import GPT4All
+import time
+from backends import registro, crea_backend, get_available_models
+from metrics import cronometrato, registra_generazione
+from scadenze import scadenza_corrente, RichiestaAnnullataError
+from risorse import memoria_disponibile
+from profilazione import profilo_corrente, esegui_profilato
+from executors import configurazione_stadio
+from log_asincrono import campi, traccia
 
 # Configurazione del logging per tracciare il flusso del programma
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Variabili globali per il modello
-model = None
-model_path_global = None  # Variabile globale per memorizzare il percorso del modello
+# Rotta del registro dei modelli usata per le domande mediche
+ROTTA = "medica"
+model_path_global = None  # Percorso dell'ultimo modello risolto per la rotta medica
 
-def get_available_models():
-    """
-    Funzione per ottenere tutti i modelli GPT4All disponibili nella cartella dell'utente.
-    Cerca in tre posizioni standard e restituisce i percorsi ai file di modello.
-    """
-    user_home = os.path.expanduser("~")  # Percorso home dell'utente
-    model_dirs = [
-        os.path.join(user_home, "AppData", "Local", "nomic.ai", "GPT4All"),
-        os.path.join(user_home, ".cache", "gpt4all"),
-        os.path.join("models")  # Percorso per modelli locali
-    ]
-
-    available_models = []
-    for model_dir in model_dirs:
-        if os.path.exists(model_dir):  # Se la cartella esiste
-            for ext in [".gguf", ".bin", ".ggml"]:  # Estensioni dei modelli supportati
-                available_models.extend(glob.glob(os.path.join(model_dir, f"*{ext}")))
-    return available_models
+SISTEMA_MEDICO = """Sei un assistente medico. Rispondi sempre in italiano, in modo chiaro, semplice e comprensibile da un paziente.
+IMPORTANTE: Utilizza le informazioni fornite nel contesto clinico per rispondere alla domanda.
+Se il contesto contiene la risposta ed è completa, basati esclusivamente su quelle informazioni."""
 
 def initialize_model(model_name=None):
     """
-    Inizializza il modello GPT4All selezionato. Se il modello è già caricato, restituisce quello esistente.
+    Verifica che esista un modello per la rotta medica e ne memorizza il percorso.
+    Il modello viene caricato solo nel processo worker, tramite il backend configurato nel registro.
     Se non viene trovato nessun modello valido, solleva un'eccezione.
     """
-    global model, model_path_global
-    if model is not None:
-        return model
-
-    models = get_available_models()
-    if not models:
-        raise Exception("Nessun modello GPT4All trovato localmente.")
-
-    # Lista di modelli preferiti, vengono cercati prima
-    preferred_models = ["qwen2.5", "mistral", "orca", "gpt4all-j", "replit"]
-    excluded = ["falcon"]
-
-    candidates = []
-    for name in preferred_models:
-        for m in models:
-            if name in os.path.basename(m).lower() and not any(x in m.lower() for x in excluded):
-                candidates.append(m)
-    if not candidates:
-        candidates = [m for m in models if not any(x in m.lower() for x in excluded)]
-
-    for model_path in candidates:
-        try:
-            logger.info(f"Caricamento modello: {model_path}")
-            model = GPT4All(model_path, allow_download=False)  # Carica il modello senza download
-            model_path_global = model_path  # Salva il percorso del modello
-            return model
-        except Exception as e:
-            logger.warning(f"Errore nel caricamento modello {model_path}: {e}")
+    global model_path_global
+    config = registro.config_risolta(ROTTA)
+    model_path_global = config.get("percorso")
+    return config
+
+# Limiti per richiesta: numero massimo di generazioni e tempo totale dedicato alla generazione
+MAX_TENTATIVI = 2
+BUDGET_GENERAZIONE_SECONDI = 600
+# Ogni quanto il processo principale controlla scadenza e annullamento della richiesta, e quanto
+# attende che il worker si fermi da solo prima di terminarlo
+INTERVALLO_CONTROLLO = 0.25
+MARGINE_ARRESTO = 5
+
+# Ogni processo worker carica l'intero modello: la memoria stimata per processo è la dimensione
+# del file più un margine per contesto e buffer. Il numero di processi contemporanei è limitato
+# dalla RAM disponibile (o da PROVA_MAX_PROCESSI_MODELLO) e non supera i worker dello stadio "generazione"
+FATTORE_MEMORIA_PROCESSO = 1.3
+_posti_processi = None
+_posti_processi_lock = threading.Lock()
+
+def limite_processi(config):
+    """Numero massimo di processi worker contemporanei per la configurazione indicata."""
+    massimo = configurazione_stadio("generazione")["workers"]
+    if os.environ.get("PROVA_MAX_PROCESSI_MODELLO"):
+        return max(1, min(massimo, int(os.environ["PROVA_MAX_PROCESSI_MODELLO"])))
+    percorso = config.get("percorso")
+    memoria = memoria_disponibile()
+    if not percorso or not os.path.exists(percorso) or memoria is None:
+        return massimo
+    per_processo = os.path.getsize(percorso) * FATTORE_MEMORIA_PROCESSO
+    return max(1, min(massimo, int(memoria // per_processo)))
+
+def _posti(config):
+    global _posti_processi
+    if _posti_processi is None:
+        with _posti_processi_lock:
+            if _posti_processi is None:
+                limite = limite_processi(config)
+                logger.info(f"Processi del modello medico contemporanei: al massimo {limite}")
+                _posti_processi = threading.BoundedSemaphore(limite)
+    return _posti_processi
+
+# Validazione durante lo streaming: i primi token vengono controllati per riconoscere subito
+# un'eco del prompt o una risposta vuota, senza attendere la fine della generazione
+FINESTRA_VALIDAZIONE = 24
+MARCATORI_ECO = [
+    "### Istruzioni",
+    "### Domanda dell'utente",
+    "### Contesto clinico",
+    "Domanda dell'utente:",
+    "Contesto clinico (utilizza",
+    "Storia della conversazione:",
+]
+
+class ControlloInizioRisposta:
+    """
+    Controlla l'inizio della risposta durante la generazione; un'istanza per tentativo.
+    Viene chiamato a ogni blocco dello stream, e un blocco può contenere più token (o una stop sequence
+    trattenuta): il conteggio può quindi saltare oltre la finestra, per cui il controllo finale si fa
+    alla prima chiamata con token >= FINESTRA_VALIDAZIONE e poi non si ripete.
+    """
+
+    def __init__(self, finestra=FINESTRA_VALIDAZIONE):
+        self.finestra = finestra
+        self.concluso = False
+
+    def __call__(self, testo, token):
+        """
+        Returns:
+            str: Il motivo dell'interruzione ('eco_prompt' o 'risposta_vuota'), oppure None.
+        """
+        if self.concluso:
+            return None
+        if any(marcatore in testo for marcatore in MARCATORI_ECO):
+            return "eco_prompt"
+        if token >= self.finestra:
+            self.concluso = True
+            if not testo.strip():
+                return "risposta_vuota"
+        return None
+
+def _estrai_risposta(risposta_pulita):
+    """
+    Applica le euristiche di accettazione alla risposta già ripulita dai token speciali.
+
+    Returns:
+        tuple: La risposta (eventualmente ritagliata) e un flag che indica se è accettabile.
+    """
+    # Rilassare i criteri di accettazione delle risposte
+    if len(risposta_pulita) > 30:  # Ridotto da 50 a 30
+        trovato = True
+    else:
+        pattern_possibili = [
+        "### Risposta dettagliata in italiano",
+        "Risposta dettagliata in italiano",
+        "Risposta in italiano:",
+        "Risposta:"
+        ]
+        trovato = False
+        for pattern in pattern_possibili:
+            if pattern in risposta_pulita:
+                parti = risposta_pulita.split(pattern, 1)
+                if len(parti) > 1:
+                    risposta_pulita = parti[1].strip()
+                    trovato = True
+                    break
+
+    # Se la risposta non è sufficientemente dettagliata, verifica che non sia un'eco del prompt
+    if not trovato:
+        prompt_markers = [
+            "### Istruzioni:",
+            "### Domanda dell'utente:",
+            "### Contesto clinico"
+        ]
+        contains_prompt = any(marker in risposta_pulita for marker in prompt_markers)
+
+        if not contains_prompt and len(risposta_pulita) > 20:
+            trovato = True
+        else:
+            if ":" in risposta_pulita:
+                last_part = risposta_pulita.split(":")[-1].strip()
+                if len(last_part) > 20:
+                    risposta_pulita = last_part
+                    trovato = True
+
+    if len(risposta_pulita) > 50:
+        trovato = True
+
+    risposta_pulita = risposta_pulita.strip()
+    return risposta_pulita, trovato and len(risposta_pulita) >= 20
+
+def _prompt_conoscenze_generali(domanda):
+    """Prompt di ripiego che non usa i documenti recuperati."""
+    return f"""### Istruzioni:
+Sei un assistente medico. Rispondi sempre in italiano, in modo chiaro, semplice e comprensibile da un paziente.
+Rispondi basandoti esclusivamente sulle tue conoscenze mediche generali, senza fare riferimento a documenti esterni.
 
-    raise Exception("Nessun modello valido disponibile.")
+### Domanda dell'utente:
+{domanda.strip()}
 
-def _reasoner_worker(domanda, contesti, storia, model_path, queue):
+### Risposta in italiano, semplice e utile per un paziente:"""
+
+def _reasoner_worker(domanda, contesti, storia, config, queue, max_tentativi=MAX_TENTATIVI, budget_secondi=BUDGET_GENERAZIONE_SECONDI, annullamento=None):
     """
     Funzione interna che esegue la generazione della risposta in un processo separato.
-    Si occupa di caricare il modello e rispondere alla domanda considerando contesti e storia.
+    Si occupa di caricare il modello e rispondere alla domanda considerando contesti e storia,
+    entro al massimo `max_tentativi` generazioni e `budget_secondi` secondi.
+    Se `annullamento` (multiprocessing.Event) viene impostato, la generazione si ferma al token successivo.
     """
     try:
-        from gpt4all import GPT4All
-
-        logger.info(f"Processo worker: Caricamento modello da {model_path}")
-        local_model = GPT4All(model_path, allow_download=False)  # Carica il modello nel worker
+        logger.info(f"Processo worker: Caricamento modello da {config.get('percorso', config['backend'])}")
+        backend = crea_backend(config).carica()  # Carica il modello nel worker
+        metriche = []  # Misure di ogni generazione, restituite al processo principale
         blocchi = []  # Lista per contenere i blocchi di contesto
 
         # Gestione del contesto (lista o stringa)
@@ -111,187 +215,221 @@ def _reasoner_worker(domanda, contesti, storia, model_path, queue):
                     parti.append(f"Domanda: {dom_prec}\nRisposta: {risp_prec}")
             storia_testo = "\n".join(parti)
 
-        # Creazione del prompt per il modello
-        prompt = f"""<|im_start|>system
-Sei un assistente medico. Rispondi sempre in italiano, in modo chiaro, semplice e comprensibile da un paziente.
-IMPORTANTE: Utilizza le informazioni fornite nel contesto clinico per rispondere alla domanda.
-Se il contesto contiene la risposta ed è completa, basati esclusivamente su quelle informazioni.
-<|im_start|>user
-Domanda dell'utente:
+        # Creazione del prompt per il modello, nel formato del backend configurato
+        sezione_storia = f"Storia della conversazione:\n{storia_testo.strip()}" if storia_testo else ""
+        utente = f"""Domanda dell'utente:
 {domanda.strip()}
 
 Contesto clinico (utilizza queste informazioni per rispondere):
 {contesto_testo.strip()}
 
-{f"Storia della conversazione:\n{storia_testo.strip()}" if storia_testo else ""}
-<|im_start|>"""
-
-        logger.info("Prompt inviato al Reasoner:\n" + prompt)
-
-        # Generazione della risposta dal modello
-        risposta = local_model.generate(
-            prompt,
-            max_tokens=250,
-            temp=0.7,
-            top_k=40,
-            top_p=0.9,
-            repeat_penalty=1.2,
-            streaming=False
-        )
-
-        logger.info("Risposta grezza dal Reasoner:\n" + risposta)
-
-        # Pulizia e validazione della risposta
-        risposta_pulita = risposta.strip()
-        token_da_rimuovere = ["<|im_start|>", "<|im_end|>", "<|endoftext|>"]
-        for token in token_da_rimuovere:
-            risposta_pulita = risposta_pulita.replace(token, "")
-            
-        # Rilassare i criteri di accettazione delle risposte
-        if len(risposta_pulita) > 30:  # Ridotto da 50 a 30
-            trovato = True
-        else:
-            pattern_possibili = [
-            "### Risposta dettagliata in italiano",
-            "Risposta dettagliata in italiano",
-            "Risposta in italiano:",
-            "Risposta:"
-            ]
-            trovato = False
-            for pattern in pattern_possibili:
-                if pattern in risposta_pulita:
-                    parti = risposta_pulita.split(pattern, 1)
-                    if len(parti) > 1:
-                        risposta_pulita = parti[1].strip()
-                        trovato = True
-                        break
-
-        # Se la risposta non è sufficientemente dettagliata, tenta una seconda generazione
-        if not trovato:
-            prompt_markers = [
-                "### Istruzioni:",
-                "### Domanda dell'utente:",
-                "### Contesto clinico"
-            ]
-            contains_prompt = any(marker in risposta_pulita for marker in prompt_markers)
-
-            if not contains_prompt and len(risposta_pulita) > 20:
-                trovato = True
-            else:
-                if ":" in risposta_pulita:
-                    last_part = risposta_pulita.split(":")[-1].strip()
-                    if len(last_part) > 20:
-                        risposta_pulita = last_part
-                        trovato = True
-
-        if len(risposta_pulita) > 50:
-            trovato = True
-
-        risposta_pulita = risposta_pulita.strip()
-
-        # Se la risposta è troppo breve o malformata, tenta una risposta alternativa
-        if len(risposta_pulita) < 20 or not trovato:
-            logger.warning("Risposta troppo breve o malformata. Rigenero la risposta basandosi sulle conoscenze generali del modello.")
-
-            prompt_generale = f"""### Istruzioni:
-Sei un assistente medico. Rispondi sempre in italiano, in modo chiaro, semplice e comprensibile da un paziente.
-Rispondi basandoti esclusivamente sulle tue conoscenze mediche generali, senza fare riferimento a documenti esterni.
-
-### Domanda dell'utente:
-{domanda.strip()}
-
-### Risposta in italiano, semplice e utile per un paziente:"""
-
-            logger.info("Prompt alternativo inviato al Reasoner:\n" + prompt_generale)
-
-            # Genera una risposta alternativa usando conoscenze generali
-            risposta_generale = local_model.generate(
-                prompt_generale,
-                max_tokens=500,
-                temp=0.7,
+{sezione_storia}""".strip()
+        prompt = backend.costruisci_prompt(SISTEMA_MEDICO, utente)
+
+        # Il prompt completo va solo nelle tracce (file rotante o DEBUG), nel log resta la dimensione
+        logger.info("Prompt inviato al Reasoner", extra=campi(caratteri=len(prompt), blocchi=len(blocchi)))
+        traccia("Prompt inviato al Reasoner", prompt)
+
+        # Tentativi in ordine: risposta basata sul contesto, poi sulle conoscenze generali.
+        # Tempo e numero di tentativi sono limitati da un budget unico per richiesta.
+        scadenza = time.monotonic() + budget_secondi
+        tentativi = [
+            ("contesto", prompt, 250),
+            ("conoscenze_generali", _prompt_conoscenze_generali(domanda), 500),
+        ][:max_tentativi]
+
+        def validatore():
+            controllo_inizio = ControlloInizioRisposta()
+
+            def valida(testo, token):
+                if annullamento is not None and annullamento.is_set():
+                    return "annullata"
+                return controllo_inizio(testo, token)
+            return valida
+
+        for nome, prompt_tentativo, max_tokens in tentativi:
+            if annullamento is not None and annullamento.is_set():
+                logger.warning("Richiesta annullata: interrompo il Reasoner.")
+                break
+            if time.monotonic() >= scadenza:
+                logger.warning("Budget di tempo della richiesta esaurito: nessun altro tentativo.")
+                break
+            if nome != "contesto":
+                logger.info("Prompt alternativo inviato al Reasoner", extra=campi(caratteri=len(prompt_tentativo)))
+                traccia("Prompt alternativo inviato al Reasoner", prompt_tentativo)
+
+            # La risposta viene validata durante lo streaming: eco del prompt o output vuoto
+            # interrompono subito la generazione e si passa al tentativo successivo
+            risposta, misure = backend.genera(
+                prompt_tentativo,
+                validatore=validatore(),
+                scadenza=scadenza,
+                max_tokens=max_tokens,
+                temperatura=0.7,
                 top_k=40,
                 top_p=0.9,
-                repeat_penalty=1.2,
-                streaming=False
+                repeat_penalty=1.2
             )
+            metriche.append(misure)
+            logger.info(f"Risposta grezza dal Reasoner ({nome})",
+                        extra=campi(caratteri=len(risposta), token=misure["token"], interruzione=misure["interruzione"]))
+            traccia(f"Risposta grezza dal Reasoner ({nome})", risposta)
+
+            if misure["interruzione"] in ("eco_prompt", "risposta_vuota"):
+                logger.warning(f"Generazione '{nome}' interrotta dopo {misure['token']} token: {misure['interruzione']}")
+                continue
+
+            risposta_pulita, accettabile = _estrai_risposta(backend.pulisci(risposta))
+            if accettabile:
+                queue.put({"risposta": risposta_pulita, "metriche": metriche})
+                return
+            logger.warning("Risposta troppo breve o malformata. Rigenero la risposta basandosi sulle conoscenze generali del modello.")
 
-            logger.info("Risposta alternativa grezza dal Reasoner:\n" + risposta_generale)
-
-            # Pulizia della risposta alternativa
-            risposta_finale = risposta_generale.strip()
-            for token in token_da_rimuovere:
-                risposta_finale = risposta_finale.replace(token, "")
-
-            risposta_finale = risposta_finale.strip()
-            queue.put(risposta_finale if len(risposta_finale) > 20 else "Mi dispiace, non sono riuscito a trovare una risposta adeguata.")
-        else:
-            queue.put(risposta_pulita)
+        queue.put({"risposta": "Mi dispiace, non sono riuscito a trovare una risposta adeguata.", "metriche": metriche})
 
     except Exception as e:
         traceback_str = traceback.format_exc()
         queue.put(f"Errore interno nel Reasoner:\n{traceback_str}")
 
 
-def genera_risposta(domanda, contesti, timeout=1500):
+def genera_risposta(domanda, contesti, timeout=None):
     """
     Funzione che avvia la generazione della risposta in un processo separato, con timeout.
     """
     return genera_risposta_con_storia(domanda, contesti, storia=[], timeout=timeout)
 
-def genera_risposta_con_storia(domanda, contesti, storia=[], timeout=1500):
+def _attendi_worker(processo, annullamento, limite):
+    """
+    Attende il processo worker controllando periodicamente la scadenza della richiesta.
+    Allo scadere o all'annullamento chiede al worker di fermarsi; se non si ferma entro
+    MARGINE_ARRESTO secondi lo termina.
+
+    Returns:
+        str: Il motivo dell'interruzione, oppure None se il worker è terminato da solo.
+    """
+    richiesta = scadenza_corrente()
+    motivo = None
+    arresto = None
+    while processo.is_alive():
+        processo.join(INTERVALLO_CONTROLLO)
+        if motivo is None:
+            motivo = richiesta.interruzione() if richiesta is not None else None
+            if motivo is None and time.monotonic() >= limite:
+                motivo = "tempo_scaduto"
+            if motivo is not None:
+                annullamento.set()
+                arresto = time.monotonic() + MARGINE_ARRESTO
+        if arresto is not None and time.monotonic() >= arresto and processo.is_alive():
+            processo.terminate()
+            processo.join()
+    return motivo
+
+@cronometrato("generazione_reasoner")
+def genera_risposta_con_storia(domanda, contesti, storia=[], timeout=None):
     """
     Funzione che avvia la generazione della risposta in un processo separato considerando anche la storia delle domande.
+    Il tempo concesso è il minimo tra `timeout` (o BUDGET_GENERAZIONE_SECONDI) e il tempo rimanente della richiesta.
     """
     try:
         # Log per verificare il tipo di contesti e la loro struttura
-        logger.info(f"Tipo di contesti: {type(contesti)}")
-        if isinstance(contesti, list):
-            logger.info(f"Numero di documenti nel contesto: {len(contesti)}")
-            for i, doc in enumerate(contesti[:2]):  # Log dei primi 2 documenti come esempio
-                logger.info(f"Documento {i} - tipo: {type(doc)}")
-                if isinstance(doc, dict):
-                    logger.info(f"Documento {i} - chiavi: {doc.keys()}")
-        
-        global model, model_path_global
-        # Inizializzazione del modello (avviene solo una volta)
-        if model is None:
-            try:
-                initialize_model()
-            except Exception as e:
-                logger.error(f"Errore nell'inizializzazione del modello: {e}")
-                return f"Errore nell'inizializzazione del modello: {e}"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Tipo di contesti: {type(contesti)}")
+            if isinstance(contesti, list):
+                logger.debug(f"Numero di documenti nel contesto: {len(contesti)}")
+                for i, doc in enumerate(contesti[:2]):  # Log dei primi 2 documenti come esempio
+                    logger.debug(f"Documento {i} - tipo: {type(doc)}")
+                    if isinstance(doc, dict):
+                        logger.debug(f"Documento {i} - chiavi: {doc.keys()}")
         
-        # Verifica che il percorso del modello sia stato impostato
-        if model_path_global is None:
-            logger.error("Percorso del modello non disponibile")
-            return "⚠️ Errore: percorso del modello non disponibile"
-            
-        logger.info(f"Processo principale: Usando modello da {model_path_global}")
-                
-        # Coda per la comunicazione tra processi
+        # Configurazione corrente della rotta medica (può cambiare con una sostituzione a caldo)
+        try:
+            config = initialize_model()
+        except Exception as e:
+            logger.error(f"Errore nell'inizializzazione del modello: {e}")
+            return f"Errore nell'inizializzazione del modello: {e}"
+
+        logger.info(f"Processo principale: Usando modello da {config.get('percorso', config['backend'])}")
+
+        richiesta = scadenza_corrente()
+        budget = BUDGET_GENERAZIONE_SECONDI if timeout is None else timeout
+        if richiesta is not None:
+            richiesta.controlla()
+            budget = min(budget, richiesta.rimanente())
+        limite = time.monotonic() + budget
+
+        # Coda per la comunicazione tra processi ed evento per l'annullamento cooperativo
         queue = multiprocessing.Queue()
-        
-        # Creazione e avvio del processo separato per la generazione della risposta
-        processo = multiprocessing.Process(
-            target=_reasoner_worker, 
-            args=(domanda, contesti, storia, model_path_global, queue)
-        )
-        processo.start()
-        processo.join(timeout)
-
-        # Gestione del timeout
-        if processo.is_alive():
-            logger.warning(f"Timeout raggiunto dopo {timeout} secondi")
-            processo.terminate()
-            processo.join()
+        annullamento = multiprocessing.Event()
+
+        # Un posto per processo: senza memoria sufficiente per un altro modello si attende
+        posti = _posti(config)
+        if not posti.acquire(timeout=max(0.0, limite - time.monotonic())):
+            logger.warning("Nessun posto libero per un processo del modello entro la scadenza")
+            return "⚠️ Timeout: la generazione della risposta ha superato il tempo massimo consentito."
+        target = _reasoner_worker
+        args = (domanda, contesti, storia, config, queue, MAX_TENTATIVI, max(0.0, limite - time.monotonic()), annullamento)
+        # Con la profilazione su richiesta attiva viene profilato anche il processo worker
+        profilo = profilo_corrente()
+        base_profilo = None
+        if profilo is not None and profilo.su_richiesta:
+            base_profilo = profilo.percorso_processo()
+            target, args = esegui_profilato, (profilo.modalita, base_profilo, _reasoner_worker) + args
+        try:
+            # Creazione e avvio del processo separato per la generazione della risposta
+            processo = multiprocessing.Process(target=target, args=args)
+            processo.start()
+            motivo = _attendi_worker(processo, annullamento, limite)
+        finally:
+            posti.release()
+            if base_profilo is not None:
+                profilo.unisci_processo(base_profilo)
+
+        if motivo == "client_disconnesso":
+            raise RichiestaAnnullataError(motivo)
+        if motivo is not None and queue.empty():
+            logger.warning(f"Timeout raggiunto dopo {budget:.0f} secondi")
             return "⚠️ Timeout: la generazione della risposta ha superato il tempo massimo consentito."
 
         # Recupero della risposta dalla coda
         if not queue.empty():
             risposta = queue.get()
+            # Il worker restituisce la risposta insieme alle misure di ogni generazione
+            if isinstance(risposta, dict):
+                for misure in risposta.get("metriche", []):
+                    registra_generazione("reasoner", misure["token"], misure["prefill"], misure["decode"], misure.get("interruzione"))
+                risposta = risposta["risposta"]
             return risposta
 
+    except RichiestaAnnullataError:
+        raise
     except Exception as e:
         traceback_str = traceback.format_exc()
         logger.error(f"Errore nella generazione della risposta: {traceback_str}")
         return f"Errore nella generazione della risposta: {traceback_str}"
+
+def verifica_ripiego():
+    """
+    Esegue il worker in-process con il backend stub configurato per produrre una risposta troppo breve:
+    il primo tentativo deve essere scartato e il prompt di ripiego sulle conoscenze generali
+    deve essere generato, senza errori interni.
+    """
+    import queue as coda
+    config = {"backend": "stub", "token": 3, "prefill": 0.0, "token_al_secondo": 1000.0}
+    risultati = coda.Queue()
+    _reasoner_worker("Che cos'è la febbre?", [{"title": "Febbre", "text": "La febbre è un aumento della temperatura."}],
+                     [], config, risultati, max_tentativi=2, budget_secondi=30)
+    esito = risultati.get()
+    generazioni = len(esito["metriche"]) if isinstance(esito, dict) else 0
+    return {
+        "generazioni": generazioni,
+        "risposta": esito["risposta"] if isinstance(esito, dict) else esito,
+        "superata": isinstance(esito, dict) and generazioni == 2,
+    }
+
+if __name__ == "__main__":
+    # python reasoning.py: verifica del ripiego dopo una prima risposta malformata (backend stub, offline)
+    import sys
+    import json
+    esito = verifica_ripiego()
+    print(json.dumps(esito, ensure_ascii=False, indent=2))
+    sys.exit(0 if esito["superata"] else 1)
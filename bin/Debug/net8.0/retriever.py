@@ -1,24 +1,60 @@
 #retriever.py
 import os
 import json
-import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from embedding_onnx import carica_embedder
 from pubmed import search_pubmed
+from metrics import misura, cronometrato, documenti_corpus, duplicati_scartati
+from deduplicazione import filtra_duplicati
+from log_asincrono import campi
+from arricchimento import CodaArricchimento, modalita_richiesta, risultati_accettabili
+from metadati import IndiceMetadati, normalizza_filtri, documento_soddisfa
+from varianti_query import genera_varianti, fondi_rrf
+import vector_store
+import stato_condiviso
 import logging
+import threading
 
 # Configurazione del logging per tracciare le operazioni
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+logger_risultati = logging.getLogger("retriever.risultati")
 
-# Caricamento del modello pre-addestrato per l'encoding delle query e dei documenti
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Modello pre-addestrato per l'encoding delle query e dei documenti, caricato alla prima richiesta
+MODEL_NAME = 'all-MiniLM-L6-v2'
+model = None
+_model_lock = threading.Lock()
 
 # Costanti per i file necessari
 FAISS_INDEX_FILE = "faiss_index.index"
 DOCS_FILE = "documents.json"
 ID_MAP_FILE = "document_ids.json"
 
+# Corpus (indice, documenti, mappatura ID) già letto in questo processo, con la firma dei file da cui
+# proviene. Con più worker le scritture avvengono sotto il blocco su file del corpus e incrementano
+# la versione: gli altri processi se ne accorgono alla ricerca successiva e ricaricano.
+_corpus_cache = None
+_firma_cache = None
+_corpus_lock = threading.Lock()
+
+# Indice dei metadati del corpus in cache, ricostruito quando cambia il corpus (vedi indice_metadati)
+_metadati_cache = (None, None)
+_metadati_lock = threading.Lock()
+
+def get_model():
+    """
+    Restituisce il modello di embedding, caricandolo una sola volta anche con chiamate concorrenti.
+
+    Returns:
+        SentenceTransformer | EmbedderOnnx: Il modello di embedding (vedi PROVA_EMBEDDING).
+    """
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                model = carica_embedder(MODEL_NAME)
+    return model
+
 def get_query_embedding(query):
     """
     Calcola l'embedding (vettore) di una query.
@@ -29,29 +65,80 @@ def get_query_embedding(query):
     Returns:
         numpy.ndarray: Vettore di embedding della query.
     """
-    return model.encode([query]).astype('float32')
+    with misura("embedding_query"):
+        return get_model().encode([query]).astype('float32')
 
-def ensure_faiss_index():
-    """
-    Verifica se esiste un indice FAISS salvato. Se non esiste o è corrotto, ne crea uno nuovo.
-    
-    Returns:
-        faiss.Index: L'indice FAISS.
-    """
-    if os.path.exists(FAISS_INDEX_FILE):
+def firma_corpus():
+    """Versione del corpus e firma dei file: se cambia, il corpus in memoria va ricaricato."""
+    return (stato_condiviso.leggi_versione(), vector_store.firma_indice(FAISS_INDEX_FILE),
+            vector_store.firma_file(DOCS_FILE))
+
+def _memorizza_corpus(index, documents, id_mapping):
+    """Aggiorna il corpus in cache. Va chiamata tenendo il blocco del corpus."""
+    global _corpus_cache, _firma_cache
+    _corpus_cache, _firma_cache = (index, documents, id_mapping), firma_corpus()
+    documenti_corpus.set(index.ntotal)
+
+def _apri_o_crea_indice():
+    """Apre l'indice su disco; se non esiste o è corrotto ne crea uno vuoto. Richiede il blocco del corpus."""
+    if vector_store.esiste_indice(FAISS_INDEX_FILE) or os.path.exists(FAISS_INDEX_FILE):
         try:
-            index = faiss.read_index(FAISS_INDEX_FILE)
-            logger.info(f"Indice FAISS caricato con {index.ntotal} vettori.")
+            index = vector_store.apri_indice(FAISS_INDEX_FILE)
+            logger.info(f"Indice ({vector_store.MODALITA_VETTORI}) caricato con {index.ntotal} vettori.")
             return index
         except Exception as e:
-            logger.warning(f"Indice FAISS corrotto, verrà ricreato: {e}")
-    
-    logger.info("Creazione nuovo indice FAISS vuoto.")
-    dummy = model.encode(["test"]).astype('float32')
-    index = faiss.IndexFlatL2(dummy.shape[1])
-    faiss.write_index(index, FAISS_INDEX_FILE)
+            logger.warning(f"Indice corrotto, verrà ricreato: {e}")
+
+    logger.info(f"Creazione nuovo indice vuoto ({vector_store.MODALITA_VETTORI}).")
+    dummy = get_model().encode(["test"]).astype('float32')
+    index = vector_store.crea_indice(dummy[:0], FAISS_INDEX_FILE, d=dummy.shape[1])
+    stato_condiviso.incrementa_versione()
     return index
 
+def carica_corpus():
+    """
+    Restituisce indice, documenti e mappatura degli ID, rileggendoli dal disco solo se un altro
+    processo (o thread) ha modificato il corpus dall'ultima lettura.
+
+    Returns:
+        tuple: (indice, documenti, mappatura ID). Da trattare in sola lettura.
+    """
+    if _corpus_cache is not None and firma_corpus() == _firma_cache:
+        return _corpus_cache
+
+    with _corpus_lock, stato_condiviso.blocco_corpus():
+        if _corpus_cache is not None and firma_corpus() == _firma_cache:
+            return _corpus_cache
+        index = _apri_o_crea_indice()
+        _memorizza_corpus(index, load_json(DOCS_FILE, []), load_json(ID_MAP_FILE, []))
+        return _corpus_cache
+
+def indice_metadati():
+    """
+    Restituisce l'indice dei metadati del corpus corrente, ricostruendolo solo quando il corpus cambia.
+
+    Returns:
+        IndiceMetadati: Le righe dell'indice vettoriale per anno, categoria, lingua e tipo di pubblicazione.
+    """
+    global _metadati_cache
+    corpus = carica_corpus()
+    if _metadati_cache[0] is not corpus:
+        with _metadati_lock:
+            if _metadati_cache[0] is not corpus:
+                with misura("indice_metadati"):
+                    _metadati_cache = (corpus, IndiceMetadati(corpus[1], corpus[2]))
+    return _metadati_cache[1]
+
+def ensure_faiss_index():
+    """
+    Restituisce l'indice dei vettori nella modalità configurata (PROVA_VETTORI): FAISS float32
+    oppure archivio memory-mapped float16/int8. Se non esiste o è corrotto, ne crea uno nuovo.
+
+    Returns:
+        faiss.Index | vector_store.ArchivioMmap: L'indice dei vettori.
+    """
+    return carica_corpus()[0]
+
 def load_json(file_path, default):
     """
     Carica un file JSON o restituisce un valore predefinito se il file non esiste.
@@ -96,6 +183,7 @@ def get_document_by_index(idx, documents, id_mapping):
     doc_id = id_mapping[idx]
     return next((doc for doc in documents if doc["id"] == doc_id), {"text": "Documento non trovato", "title": "N/A"})
 
+@cronometrato("filtro_rilevanza")
 def filtra_risultati_per_rilevanza(query, results, threshold=0.5):
     """
     Filtra i risultati in base alla similarità con la query.
@@ -108,10 +196,10 @@ def filtra_risultati_per_rilevanza(query, results, threshold=0.5):
     Returns:
         list: I risultati filtrati per rilevanza.
     """
-    logger.info(f"Ricerca con query: {query}")
-    logger.info(f"Soglia di similarità: {threshold}")
+    logger.debug(f"Ricerca con query: {query} (soglia di similarità: {threshold})")
     
     # Calcola l'embedding della query
+    model = get_model()
     query_emb = model.encode([query])[0]
     
     # Filtra i documenti
@@ -145,51 +233,201 @@ def filtra_risultati_per_rilevanza(query, results, threshold=0.5):
     
     return filtered_results
 
-def cerca_documenti(query, k=3, max_search=50, similarity_threshold=0.5):
+def risultati_sufficienti(risultati, k):
     """
-    Cerca i documenti più pertinenti per la query, prima in FAISS e poi su PubMed se necessario.
+    Indica se i risultati locali bastano a rispondere senza interrogare PubMed.
+
+    Args:
+        risultati (list): I risultati già filtrati per rilevanza.
+        k (int): Numero di risultati richiesti.
+
+    Returns:
+        bool: True se i risultati sono sufficienti.
+    """
+    return len(risultati) >= min(3, k)
+
+def log_risultati_finali(top_results):
+    """Registra nel log i documenti che verranno passati al Reasoner."""
+    # Una sola riga per richiesta, sul logger campionato "retriever.risultati"; i titoli completi solo a DEBUG
+    logger_risultati.info(
+        f"→ {len(top_results)} contenuti finali inviati al Reasoner",
+        extra=campi(punteggi=[round(doc.get('similarity', 0), 3) for doc in top_results])
+    )
+    if logger_risultati.isEnabledFor(logging.DEBUG):
+        for i, doc in enumerate(top_results):
+            logger_risultati.debug(f"[{i+1}] TITOLO: {doc.get('title', '')[:80]}... Score: {doc.get('similarity', 0):.3f}")
+
+def cerca_in_faiss(query, max_search=50, similarity_threshold=0.5, filtri=None, storia=None):
+    """
+    Cerca i documenti pertinenti solo nell'indice FAISS locale, senza scritture.
+    Con più varianti della query (vedi varianti_query.py) le varianti vengono codificate in un batch,
+    cercate con un'unica ricerca e i risultati fusi con la RRF.
 
     Args:
         query (str): La query da cercare.
-        k (int): Numero di risultati da restituire.
         max_search (int): Numero massimo di documenti da cercare.
         similarity_threshold (float): Soglia di similarità per il filtro.
+        filtri (dict): Filtri sui metadati (vedi metadati.py): la ricerca avviene solo sulle righe che li rispettano.
+        storia (list): I turni precedenti della conversazione, per la variante dei follow-up.
 
     Returns:
-        tuple: I documenti trovati, un flag che indica se sono stati trovati documenti in FAISS, e un flag per l'aggiornamento di FAISS.
+        list: I documenti FAISS filtrati per rilevanza, ordinati per similarità (per punteggio RRF con più varianti).
     """
-    logger.info(f"Ricerca documenti per la query: '{query}' (cercando {max_search} documenti, top {k} restituiti)")
-    query_emb = get_query_embedding(query)
-    index = ensure_faiss_index()
-    id_mapping = load_json(ID_MAP_FILE, [])
-    documents = load_json(DOCS_FILE, [])
-
-    faiss_results = []
-    if index.ntotal > 0:
-        D, I = index.search(query_emb, min(max_search, index.ntotal))
-        results = [get_document_by_index(i, documents, id_mapping) for i in I[0] if i < len(id_mapping)]
-        valid_results = [r for r in results if "text" in r and "Documento non trovato" not in r["text"]]
-        
-        if valid_results:
-            # Filtra per rilevanza semantica
-            faiss_results = filtra_risultati_per_rilevanza(query, valid_results, similarity_threshold)
-            logger.info(f"→ Trovati {len(valid_results)} documenti da FAISS, {len(faiss_results)} dopo filtro di rilevanza.")
-            
-            # Se i risultati sono sufficienti, restituisci
-            if len(faiss_results) >= min(3, k):
-                top_results = faiss_results[:k]
-                logger.info("→ Contenuti finali inviati al Reasoner:")
-                for i, doc in enumerate(top_results):
-                    logger.info(f"[{i+1}] TITOLO: {doc.get('title', '')[:80]}...\nScore: {doc.get('similarity', 0):.3f}")
-                return top_results, True, False
-            else:
-                logger.info("→ Risultati FAISS insufficienti, cerco anche su PubMed...")
+    varianti = genera_varianti(query, storia)
+    with misura("embedding_query"):
+        query_embs = get_model().encode(varianti, batch_size=len(varianti)).astype('float32')
+    index, documents, id_mapping = carica_corpus()
+
+    if index.ntotal == 0:
+        logger.info("→ Indice FAISS vuoto.")
+        return []
+
+    righe = indice_metadati().righe(normalizza_filtri(filtri))
+    if righe is not None:
+        logger.info(f"→ Ricerca filtrata su {len(righe)} documenti su {index.ntotal}")
+        if len(righe) == 0:
+            return []
+
+    with misura("faiss"):
+        D, I = vector_store.cerca(index, query_embs, min(max_search, index.ntotal), righe)
+    if len(varianti) > 1:
+        fusi = fondi_rrf(I)[:max_search]
+        posizioni = [riga for riga, _ in fusi]
+        punteggi_rrf = {id_mapping[riga]: punteggio for riga, punteggio in fusi if riga < len(id_mapping)}
+        logger.debug(f"→ Varianti della query: {varianti}")
     else:
-        logger.info("→ Indice FAISS vuoto. Ricerca su PubMed...")
+        posizioni, punteggi_rrf = I[0], None
+    # Copie dei documenti: il corpus in cache è condiviso e il filtro vi aggiunge la similarità
+    results = [dict(get_document_by_index(i, documents, id_mapping)) for i in posizioni if 0 <= i < len(id_mapping)]
+    valid_results = [r for r in results if "text" in r and "Documento non trovato" not in r["text"]]
 
-    # Cerca su PubMed
-    nuovi_documenti = search_pubmed(query, max_results=max_search)
+    if not valid_results:
+        return []
+
+    # Filtra per rilevanza semantica
+    if punteggi_rrf is None:
+        faiss_results = filtra_risultati_per_rilevanza(query, valid_results, similarity_threshold)
+    else:
+        faiss_results = filtra_per_varianti(query_embs, valid_results, similarity_threshold)
+        for doc in faiss_results:
+            doc["rrf"] = punteggi_rrf.get(doc.get("id"), 0.0)
+        faiss_results.sort(key=lambda x: x["rrf"], reverse=True)
+    logger.info(f"→ Trovati {len(valid_results)} documenti da FAISS ({len(varianti)} varianti della query), "
+                f"{len(faiss_results)} dopo filtro di rilevanza.")
+    return faiss_results
+
+def filtra_per_varianti(query_embs, docs, threshold=0.5):
+    """
+    Filtro di rilevanza per una ricerca con più varianti: i testi vengono codificati in un unico batch
+    e la similarità di un documento è la massima tra quelle con le varianti.
+
+    Returns:
+        list: I documenti con similarità almeno pari alla soglia, nell'ordine ricevuto.
+    """
+    testi = [doc.get("text", "").strip() for doc in docs]
+    validi = [i for i, testo in enumerate(testi) if testo not in ["no abstract available", "no abstract", ""]]
+    if not validi:
+        return []
+    with misura("embedding_documenti"):
+        doc_embs = get_model().encode([testi[i] for i in validi], batch_size=64).astype('float32')
+    doc_embs /= np.clip(np.linalg.norm(doc_embs, axis=1, keepdims=True), 1e-12, None)
+    query_embs = query_embs / np.clip(np.linalg.norm(query_embs, axis=1, keepdims=True), 1e-12, None)
+    similarita = (doc_embs @ query_embs.T).max(axis=1)
+
+    filtrati = []
+    for i, similarity in zip(validi, similarita):
+        if similarity >= threshold:
+            docs[i]['similarity'] = float(similarity)
+            filtrati.append(docs[i])
+    return filtrati
+
+def filtra_risultati_batch(query_embs, candidati, threshold=0.5):
+    """
+    Come filtra_risultati_per_rilevanza, ma per più query insieme: ogni testo distinto
+    viene codificato una sola volta, in un unico batch.
+
+    Args:
+        query_embs (numpy.ndarray): Gli embedding delle query, uno per riga.
+        candidati (list): Per ogni query, la lista dei documenti da filtrare.
+        threshold (float): La soglia di similarità.
+
+    Returns:
+        list: Per ogni query, i documenti filtrati e ordinati per similarità decrescente.
+    """
+    testi = list(dict.fromkeys(
+        doc.get("text", "").strip() for docs in candidati for doc in docs
+        if doc.get("text", "").strip() not in ["no abstract available", "no abstract", ""]
+    ))
+    if not testi:
+        return [[] for _ in candidati]
+
+    with misura("embedding_documenti"):
+        doc_embs = get_model().encode(testi, batch_size=64).astype('float32')
+    posizioni = {testo: i for i, testo in enumerate(testi)}
+    doc_embs /= np.clip(np.linalg.norm(doc_embs, axis=1, keepdims=True), 1e-12, None)
+    query_embs = query_embs / np.clip(np.linalg.norm(query_embs, axis=1, keepdims=True), 1e-12, None)
+
+    risultati = []
+    for query_emb, docs in zip(query_embs, candidati):
+        filtrati = []
+        for doc in docs:
+            posizione = posizioni.get(doc.get("text", "").strip())
+            if posizione is None:
+                continue
+            similarity = float(np.dot(query_emb, doc_embs[posizione]))
+            if similarity >= threshold:
+                doc['similarity'] = similarity
+                filtrati.append(doc)
+        filtrati.sort(key=lambda x: x.get('similarity', 0), reverse=True)
+        risultati.append(filtrati)
+    return risultati
+
+def cerca_in_faiss_batch(queries, max_search=50, similarity_threshold=0.5):
+    """
+    Cerca più query nell'indice locale con un'unica codifica e un'unica index.search.
+
+    Args:
+        queries (list): Le query da cercare.
+        max_search (int): Numero massimo di documenti da cercare per query.
+        similarity_threshold (float): Soglia di similarità per il filtro.
+
+    Returns:
+        tuple: Per ogni query i documenti filtrati (come cerca_in_faiss), e gli embedding delle query.
+    """
+    with misura("embedding_query"):
+        query_embs = get_model().encode(list(queries), batch_size=64).astype('float32')
+    index, documents, id_mapping = carica_corpus()
+
+    if index.ntotal == 0 or not queries:
+        return [[] for _ in queries], query_embs
+
+    with misura("faiss"):
+        D, I = index.search(query_embs, min(max_search, index.ntotal))
+    candidati = [
+        [dict(get_document_by_index(i, documents, id_mapping)) for i in riga if 0 <= i < len(id_mapping)]
+        for riga in I
+    ]
+    candidati = [[r for r in docs if "Documento non trovato" not in r.get("text", "")] for docs in candidati]
+    risultati = filtra_risultati_batch(query_embs, candidati, similarity_threshold)
+    logger.info(f"→ Ricerca FAISS in batch: {len(queries)} query, {sum(map(len, risultati))} documenti dopo filtro di rilevanza.")
+    return risultati, query_embs
 
+def integra_con_pubmed(query, faiss_results, nuovi_documenti, k=3, similarity_threshold=0.5, filtri=None):
+    """
+    Filtra i documenti scaricati da PubMed, li aggiunge all'indice FAISS e li combina con i risultati locali.
+    Con `filtri` tutti i documenti rilevanti entrano nel corpus, ma vengono restituiti solo quelli che li rispettano.
+
+    Args:
+        query (str): La query cercata.
+        faiss_results (list): I risultati già ottenuti da FAISS.
+        nuovi_documenti (list): I documenti restituiti da search_pubmed.
+        k (int): Numero di risultati da restituire.
+        similarity_threshold (float): Soglia di similarità per il filtro.
+        filtri (dict): Filtri sui metadati dei documenti da restituire.
+
+    Returns:
+        tuple: I documenti trovati, un flag che indica se sono stati trovati documenti in FAISS, e un flag per l'aggiornamento di FAISS.
+    """
     if not nuovi_documenti:
         logger.info("→ Nessun risultato da PubMed.")
         return faiss_results[:k] if faiss_results else [], len(faiss_results) > 0, False
@@ -202,43 +440,161 @@ def cerca_documenti(query, k=3, max_search=50, similarity_threshold=0.5):
         logger.info("→ Nessun documento rilevante da PubMed.")
         return faiss_results[:k] if faiss_results else [], len(faiss_results) > 0, False
 
-    # Aggiorna l'indice FAISS con i nuovi documenti
-    nuovi_embeddings = model.encode([d["text"] for d in nuovi_documenti_filtrati]).astype('float32')
-    index.add(nuovi_embeddings)
+    aggiungi_al_corpus(nuovi_documenti_filtrati)
+    filtri = normalizza_filtri(filtri)
+    if filtri:
+        nuovi_documenti_filtrati = [doc for doc in nuovi_documenti_filtrati if documento_soddisfa(doc, filtri)]
+    return combina_risultati(faiss_results, nuovi_documenti_filtrati, k), len(faiss_results) > 0, True
 
-    # Aggiungi i nuovi documenti e la mappatura degli ID
-    aggiunti = 0
-    for doc in nuovi_documenti_filtrati:
-        if doc.get("id") and doc["id"] not in id_mapping and doc.get("text", "").strip():
-            documents.append(doc)
-            id_mapping.append(doc["id"])
-            aggiunti += 1
+def aggiungi_al_corpus(nuovi_documenti):
+    """
+    Calcola gli embedding dei documenti e li aggiunge all'indice, ai documenti e alla mappatura degli ID.
+
+    Args:
+        nuovi_documenti (list): I documenti da aggiungere, già filtrati.
+
+    Returns:
+        int: Il numero di documenti nuovi aggiunti.
+    """
+    # Calcola gli embedding dei nuovi documenti
+    with misura("embedding_documenti"):
+        nuovi_embeddings = get_model().encode([d.get("text", "") for d in nuovi_documenti]).astype('float32')
+
+    # Un solo scrittore alla volta tra tutti i processi: rilegge lo stato più recente dal disco,
+    # lo aggiorna e incrementa la versione. Le ricerche in corso continuano sulla copia in cache.
+    with _corpus_lock, stato_condiviso.blocco_corpus():
+        index = _apri_o_crea_indice()
+        id_mapping = load_json(ID_MAP_FILE, [])
+        documents = load_json(DOCS_FILE, [])
+
+        # Scarta ID già presenti e quasi-duplicati (SimHash o embedding troppo vicini):
+        # all'indice vanno solo i vettori dei documenti accettati, allineati con la mappatura degli ID
+        with misura("deduplicazione"):
+            accettati, scartati = filtra_duplicati(nuovi_documenti, nuovi_embeddings, documents, index)
+        for motivo in scartati.values():
+            duplicati_scartati.inc(motivo=motivo)
+        if not accettati:
+            logger.info(f"→ Nessun documento nuovo da aggiungere ({len(scartati)} duplicati scartati)")
+            return 0
+
+        index.add(nuovi_embeddings[accettati])
+        for i in accettati:
+            documents.append(nuovi_documenti[i])
+            id_mapping.append(nuovi_documenti[i]["id"])
 
-    save_json(documents, DOCS_FILE)
-    save_json(id_mapping, ID_MAP_FILE)
-    faiss.write_index(index, FAISS_INDEX_FILE)
+        with misura("scrittura_indice"):
+            save_json(documents, DOCS_FILE)
+            save_json(id_mapping, ID_MAP_FILE)
+            vector_store.salva_indice(index, FAISS_INDEX_FILE)
+            stato_condiviso.incrementa_versione()
+        _memorizza_corpus(index, documents, id_mapping)
 
-    logger.info(f"→ FAISS aggiornato con {aggiunti} nuovi documenti. Totale vettori: {index.ntotal}")
+    logger.info(f"→ FAISS aggiornato con {len(accettati)} nuovi documenti ({len(scartati)} duplicati scartati). "
+                f"Totale vettori: {index.ntotal}")
+    return len(accettati)
 
-    # Combina i risultati da FAISS e PubMed, eliminando duplicati
+def combina_risultati(faiss_results, nuovi_documenti, k):
+    """Combina i risultati da FAISS e PubMed, eliminando duplicati, e restituisce i primi k per similarità."""
     combined_results = faiss_results.copy()
     existing_ids = {doc["id"] for doc in combined_results}
-    
-    for doc in nuovi_documenti_filtrati:
+
+    for doc in nuovi_documenti:
         if doc["id"] not in existing_ids:
             combined_results.append(doc)
             existing_ids.add(doc["id"])
-    
+
     # Ordina i risultati combinati per similarità
     combined_results.sort(key=lambda x: x.get('similarity', 0), reverse=True)
     top_results = combined_results[:k]
-    
+
     # Log dei risultati finali
-    logger.info("→ Contenuti finali inviati al Reasoner:")
-    for i, doc in enumerate(top_results):
-        logger.info(f"[{i+1}] TITOLO: {doc.get('title', '')[:80]}...\nScore: {doc.get('similarity', 0):.3f}")
+    log_risultati_finali(top_results)
 
-    return top_results, len(faiss_results) > 0, True
+    return top_results
+
+def integra_batch(query_embs, faiss_results, nuovi_documenti, k=3, similarity_threshold=0.5):
+    """
+    Come integra_con_pubmed per più query: filtra i documenti PubMed di tutte le query in un batch
+    e aggiunge al corpus la loro unione con un'unica scrittura dell'indice.
+
+    Args:
+        query_embs (numpy.ndarray): Gli embedding delle query, uno per riga.
+        faiss_results (list): Per ogni query, i risultati già ottenuti da FAISS.
+        nuovi_documenti (list): Per ogni query, i documenti restituiti da PubMed.
+        k (int): Numero di risultati da restituire per query.
+        similarity_threshold (float): Soglia di similarità per il filtro.
+
+    Returns:
+        list: Per ogni query, la tupla restituita da integra_con_pubmed.
+    """
+    filtrati = filtra_risultati_batch(query_embs, nuovi_documenti, similarity_threshold)
+    unione = list({doc["id"]: doc for docs in filtrati for doc in docs if doc.get("id")}.values())
+    if unione:
+        aggiungi_al_corpus(unione)
+    return [
+        (combina_risultati(faiss, nuovi, k), len(faiss) > 0, bool(nuovi)) if nuovi
+        else (faiss[:k], len(faiss) > 0, False)
+        for faiss, nuovi in zip(faiss_results, filtrati)
+    ]
+
+def arricchisci_corpus(query, max_search=50, similarity_threshold=0.5):
+    """
+    Scarica da PubMed i documenti per la query e aggiunge al corpus quelli rilevanti.
+    Eseguita in background da coda_arricchimento.
+
+    Returns:
+        int: Il numero di documenti nuovi aggiunti.
+    """
+    nuovi_documenti = search_pubmed(query, max_results=max_search)
+    filtrati = filtra_risultati_per_rilevanza(query, nuovi_documenti, similarity_threshold) if nuovi_documenti else []
+    return aggiungi_al_corpus(filtrati) if filtrati else 0
+
+coda_arricchimento = CodaArricchimento(arricchisci_corpus)
+
+def servi_localmente(query, faiss_results, k, arricchimento=None):
+    """
+    In modalità asincrona, se i risultati locali superano la soglia più bassa, accoda l'arricchimento
+    PubMed della query e restituisce i risultati da usare subito; altrimenti None.
+    """
+    if modalita_richiesta(arricchimento) != "asincrona" or not risultati_accettabili(faiss_results):
+        return None
+    logger.info(f"→ Risultati FAISS parziali, rispondo subito e arricchisco in background ({coda_arricchimento.accoda(query)})")
+    top_results = faiss_results[:k]
+    log_risultati_finali(top_results)
+    return top_results
+
+def cerca_documenti(query, k=3, max_search=50, similarity_threshold=0.5, arricchimento=None, filtri=None, storia=None):
+    """
+    Cerca i documenti più pertinenti per la query, prima in FAISS e poi su PubMed se necessario.
+
+    Args:
+        query (str): La query da cercare.
+        k (int): Numero di risultati da restituire.
+        max_search (int): Numero massimo di documenti da cercare.
+        similarity_threshold (float): Soglia di similarità per il filtro.
+        arricchimento (str): "sincrona" o "asincrona" (vedi arricchimento.py); None per quella configurata.
+        filtri (dict): Filtri sui metadati (anno, categorie, lingue, tipi di pubblicazione; vedi metadati.py).
+        storia (list): I turni precedenti della conversazione (vedi varianti_query.py).
+
+    Returns:
+        tuple: I documenti trovati, un flag che indica se sono stati trovati documenti in FAISS, e un flag per l'aggiornamento di FAISS.
+    """
+    logger.info(f"Ricerca documenti per la query: '{query}' (cercando {max_search} documenti, top {k} restituiti)")
+    faiss_results = cerca_in_faiss(query, max_search, similarity_threshold, filtri, storia)
+
+    # Se i risultati sono sufficienti, restituisci
+    if risultati_sufficienti(faiss_results, k):
+        top_results = faiss_results[:k]
+        log_risultati_finali(top_results)
+        return top_results, True, False
+
+    top_results = servi_localmente(query, faiss_results, k, arricchimento)
+    if top_results is not None:
+        return top_results, True, False
+
+    logger.info("→ Risultati FAISS insufficienti, cerco anche su PubMed...")
+    nuovi_documenti = search_pubmed(query, max_results=max_search)
+    return integra_con_pubmed(query, faiss_results, nuovi_documenti, k, similarity_threshold, filtri)
 
 # Alias per compatibilità
 search = cerca_documenti
@@ -0,0 +1,296 @@
+#risorse.py
+# Governatore delle risorse CPU. Ripartisce i core dell'host tra i componenti che creano thread propri:
+# embedding (torch o ONNX Runtime), FAISS (OpenMP), llama.cpp (rotta "generale") e GPT4All (rotta "medica").
+# Senza ripartizione ogni libreria usa tutti i core e le richieste concorrenti si contendono la CPU.
+#
+# Uso:
+#   python risorse.py mostra                  # ripartizione in uso
+#   python risorse.py autotune                # misura le configurazioni sull'host e scrive risorse.json
+#   python risorse.py autotune --componenti embedding,faiss
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from executors import configurazione_stadio
+from stato_condiviso import NUM_WORKERS
+
+logger = logging.getLogger(__name__)
+
+FILE_RISORSE = os.environ.get("PROVA_FILE_RISORSE", "risorse.json")
+COMPONENTI = ("embedding", "faiss", "generale", "medica")
+
+_risorse = None
+_risorse_lock = threading.Lock()
+
+
+def core_disponibili():
+    """Core utilizzabili da questo processo: quelli assegnati all'host divisi tra i worker del server."""
+    try:
+        core = len(os.sched_getaffinity(0))
+    except AttributeError:
+        core = os.cpu_count() or 1
+    return max(1, core // max(1, NUM_WORKERS))
+
+
+def memoria_disponibile():
+    """Byte di RAM disponibili (psutil se installato, altrimenti /proc/meminfo), oppure None se non misurabile."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo", 'r', encoding='utf-8') as f:
+            for riga in f:
+                if riga.startswith("MemAvailable:"):
+                    return int(riga.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def ripartizione_predefinita(core=None):
+    """
+    Un quarto dei core (almeno uno per worker dello stadio "embedding") va a embedding e FAISS,
+    il resto alla generazione. Lo stadio "generazione" ha un solo worker, quindi le due rotte
+    non generano mai contemporaneamente e possono usare la stessa quota.
+    """
+    core = core or core_disponibili()
+    workers_embedding = configurazione_stadio("embedding")["workers"]
+    riservati = min(core, max(workers_embedding, core // 4))
+    per_worker = max(1, riservati // workers_embedding)
+    generazione = max(1, core - riservati)
+    return {
+        "core": core,
+        "thread": {"embedding": per_worker, "faiss": per_worker, "generale": generazione, "medica": generazione},
+        "n_gpu_layers": 0,
+    }
+
+
+def carica_risorse(percorso=FILE_RISORSE):
+    """Ripartizione in uso: quella predefinita, aggiornata con i valori di risorse.json se presente."""
+    global _risorse
+    if _risorse is None:
+        with _risorse_lock:
+            if _risorse is None:
+                risorse = ripartizione_predefinita()
+                if os.path.exists(percorso):
+                    with open(percorso, 'r', encoding='utf-8') as f:
+                        salvate = json.load(f)
+                    risorse["thread"].update(salvate.get("thread", {}))
+                    risorse["n_gpu_layers"] = salvate.get("n_gpu_layers", risorse["n_gpu_layers"])
+                    logger.info(f"Ripartizione delle risorse caricata da {percorso}")
+                _risorse = risorse
+    return _risorse
+
+
+def thread_per(componente):
+    """Numero di thread assegnati al componente."""
+    return carica_risorse()["thread"][componente]
+
+
+def completa_config(rotta, config):
+    """
+    Inserisce nella configurazione di una rotta i thread (e i layer GPU per llama.cpp) decisi
+    dal governatore, solo dove modelli.json non li specifica esplicitamente.
+    """
+    config = dict(config)
+    risorse = carica_risorse()
+    if config.get("n_threads") is None and rotta in risorse["thread"]:
+        config["n_threads"] = risorse["thread"][rotta]
+    if config.get("backend") == "llama_cpp" and config.get("n_gpu_layers") is None:
+        config["n_gpu_layers"] = risorse["n_gpu_layers"]
+    return config
+
+
+def applica_thread_librerie():
+    """Imposta i thread di torch e di FAISS/OpenMP. Va chiamata all'avvio, prima di caricare i modelli."""
+    risorse = carica_risorse()
+    try:
+        import torch
+        torch.set_num_threads(risorse["thread"]["embedding"])
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Possibile solo prima del primo uso del pool inter-op
+            pass
+    except ImportError:
+        pass
+    try:
+        import faiss
+        faiss.omp_set_num_threads(risorse["thread"]["faiss"])
+    except ImportError:
+        pass
+    logger.info(f"Risorse: {risorse['core']} core, thread {risorse['thread']}, n_gpu_layers {risorse['n_gpu_layers']}")
+    return risorse
+
+
+def candidati(massimo):
+    """Numeri di thread da provare: potenze di due fino a `massimo`, più `massimo` stesso."""
+    valori = {1, massimo}
+    t = 2
+    while t < massimo:
+        valori.add(t)
+        t *= 2
+    return sorted(valori)
+
+
+def scegli_migliore(misure, tolleranza=0.05):
+    """Il valore con il throughput più alto; a parità (entro la tolleranza) quello con meno thread."""
+    massimo = max(misure.values())
+    return min(t for t, valore in misure.items() if valore >= massimo * (1 - tolleranza))
+
+
+def autotune_embedding(core, ripetizioni):
+    """Frasi al secondo con tanti client concorrenti quanti i worker dello stadio "embedding"."""
+    import retriever
+    from embedding_onnx import EmbedderOnnx
+    from stub_backends import carica_domande
+
+    frasi = [coppia["en"] for coppia in carica_domande()]
+    workers = configurazione_stadio("embedding")["workers"]
+    modello = retriever.get_model()
+    misure = {}
+    for t in candidati(max(1, core // workers)):
+        if isinstance(modello, EmbedderOnnx):
+            # I thread di ONNX Runtime si fissano alla creazione della sessione
+            modello = EmbedderOnnx(retriever.MODEL_NAME, thread=t)
+        else:
+            import torch
+            torch.set_num_threads(t)
+        modello.encode(frasi[:2])
+        inizio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda _: [modello.encode([f]) for f in frasi * ripetizioni], range(workers)))
+        misure[t] = workers * len(frasi) * ripetizioni / (time.perf_counter() - inizio)
+        logger.info(f"embedding: {t} thread -> {misure[t]:.1f} frasi/s")
+    return {"thread": scegli_migliore(misure)}, misure
+
+
+def autotune_faiss(core, ripetizioni):
+    """Ricerche al secondo su un indice piatto grande almeno quanto il corpus attuale."""
+    import faiss
+    import numpy as np
+    import retriever
+
+    dimensione, vettori = 384, 20000
+    if os.path.exists(retriever.FAISS_INDEX_FILE):
+        index = faiss.read_index(retriever.FAISS_INDEX_FILE)
+        dimensione, vettori = index.d, max(vettori, index.ntotal)
+    generatore = np.random.default_rng(0)
+    index = faiss.IndexFlatL2(dimensione)
+    index.add(generatore.standard_normal((vettori, dimensione), dtype=np.float32))
+    query = generatore.standard_normal((1, dimensione), dtype=np.float32)
+
+    misure = {}
+    for t in candidati(core):
+        faiss.omp_set_num_threads(t)
+        index.search(query, 50)
+        inizio = time.perf_counter()
+        for _ in range(ripetizioni * 20):
+            index.search(query, 50)
+        misure[t] = ripetizioni * 20 / (time.perf_counter() - inizio)
+        logger.info(f"faiss: {t} thread -> {misure[t]:.1f} ricerche/s")
+    return {"thread": scegli_migliore(misure)}, misure
+
+
+def autotune_generazione(rotta, core, ripetizioni):
+    """Token al secondo in decodifica per ogni numero di thread (e di layer GPU per llama.cpp)."""
+    from backends import registro, crea_backend
+
+    config = registro.config_risolta(rotta)
+    layer_gpu = [None]
+    if config["backend"] == "llama_cpp":
+        layer_gpu = [0]
+        try:
+            import llama_cpp
+            if llama_cpp.llama_supports_gpu_offload():
+                layer_gpu.append(-1)
+        except (ImportError, AttributeError):
+            pass
+
+    prompt = "Explain in a few sentences why regular physical activity is good for health."
+    misure = {}
+    for gpu in layer_gpu:
+        for t in candidati(core):
+            prova = {**config, "n_threads": t}
+            if gpu is not None:
+                prova["n_gpu_layers"] = gpu
+            backend = crea_backend(prova).carica()
+            try:
+                velocita = []
+                for _ in range(ripetizioni):
+                    _, metriche = backend.genera(backend.costruisci_prompt("", prompt), max_tokens=32, temperatura=0.0)
+                    velocita.append(metriche["token"] / max(metriche["decode"], 1e-6))
+            finally:
+                backend.scarica()
+            misure[(t, gpu)] = sum(velocita) / len(velocita)
+            logger.info(f"{rotta}: {t} thread, n_gpu_layers {gpu} -> {misure[(t, gpu)]:.2f} token/s")
+
+    migliore_t, migliore_gpu = max(misure, key=misure.get)
+    # A parità di layer GPU preferisce meno thread
+    migliore_t = scegli_migliore({t: v for (t, gpu), v in misure.items() if gpu == migliore_gpu})
+    scelta = {"thread": migliore_t}
+    if migliore_gpu is not None:
+        scelta["n_gpu_layers"] = migliore_gpu
+    return scelta, {f"{t}" + ("" if gpu is None else f"/gpu{gpu}"): v for (t, gpu), v in misure.items()}
+
+
+def autotune(componenti, ripetizioni=3, percorso=FILE_RISORSE):
+    """
+    Misura le configurazioni dei componenti richiesti e salva la migliore in risorse.json.
+    Embedding e FAISS vengono misurati per primi: la generazione usa i core che restano.
+    """
+    risorse = ripartizione_predefinita()
+    core = risorse["core"]
+    misure = {}
+    for componente in componenti:
+        try:
+            if componente == "embedding":
+                scelta, misure[componente] = autotune_embedding(core, ripetizioni)
+            elif componente == "faiss":
+                scelta, misure[componente] = autotune_faiss(core, ripetizioni)
+            else:
+                riservati = risorse["thread"]["embedding"] * configurazione_stadio("embedding")["workers"]
+                scelta, misure[componente] = autotune_generazione(componente, max(1, core - riservati), ripetizioni)
+        except Exception as e:
+            logger.warning(f"Autotune di '{componente}' non riuscito, resta il valore predefinito: {e}")
+            continue
+        risorse["thread"][componente] = scelta["thread"]
+        if "n_gpu_layers" in scelta:
+            risorse["n_gpu_layers"] = scelta["n_gpu_layers"]
+
+    risorse["misure"] = {c: {str(k): round(v, 2) for k, v in m.items()} for c, m in misure.items()}
+    risorse["data"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    with open(percorso, 'w', encoding='utf-8') as f:
+        json.dump(risorse, f, indent=2)
+    logger.info(f"Configurazione salvata in {percorso}: thread {risorse['thread']}, n_gpu_layers {risorse['n_gpu_layers']}")
+    return risorse
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Ripartizione dei core tra embedding, FAISS e modelli LLM")
+    parser.add_argument("comando", choices=["mostra", "autotune"])
+    parser.add_argument("--componenti", default=",".join(COMPONENTI))
+    parser.add_argument("--ripetizioni", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.comando == "mostra":
+        print(json.dumps(carica_risorse(), indent=2))
+        return
+    componenti = [c for c in args.componenti.split(",") if c]
+    sconosciuti = set(componenti) - set(COMPONENTI)
+    if sconosciuti:
+        sys.exit(f"Componenti sconosciuti: {', '.join(sorted(sconosciuti))}")
+    autotune(componenti, args.ripetizioni)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#scadenze.py
+# Scadenze delle richieste e annullamento cooperativo. Ogni richiesta riceve una Scadenza, propagata
+# come i tempi della richiesta (contextvars) fino ai thread degli stadi. Traduzione, PubMed e generazione
+# la consultano: i lavori in coda di una richiesta scaduta o abbandonata vengono scartati, le chiamate
+# di rete usano al massimo il tempo rimanente e le generazioni si fermano al token successivo.
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Tempo massimo per richiesta; il client desktop rinuncia dopo 20 minuti, oltre il lavoro è sprecato
+SCADENZA_PREDEFINITA = float(os.environ.get("PROVA_SCADENZA_SECONDI", "1200"))
+SCADENZA_BATCH = float(os.environ.get("PROVA_SCADENZA_BATCH_SECONDI", "3600"))
+# Ogni quanto controllare se il client ha chiuso la connessione
+INTERVALLO_CONTROLLO = 0.5
+
+_scadenza_corrente = contextvars.ContextVar("scadenza_corrente", default=None)
+
+
+class RichiestaAnnullataError(Exception):
+    """Sollevata quando la richiesta è scaduta ('tempo_scaduto') o il client si è disconnesso ('client_disconnesso')."""
+
+    def __init__(self, motivo):
+        super().__init__(f"Richiesta interrotta: {motivo}")
+        self.motivo = motivo
+
+
+class Scadenza:
+    """Istante limite di una richiesta più un segnale di annullamento, consultabili da qualsiasi thread."""
+
+    def __init__(self, secondi=SCADENZA_PREDEFINITA):
+        self.istante = time.monotonic() + secondi
+        self.motivo = None
+        self._annullata = threading.Event()
+
+    def annulla(self, motivo="client_disconnesso"):
+        if not self._annullata.is_set():
+            self.motivo = motivo
+            self._annullata.set()
+
+    @property
+    def annullata(self):
+        return self._annullata.is_set()
+
+    def rimanente(self):
+        return max(0.0, self.istante - time.monotonic())
+
+    def interruzione(self):
+        """Il motivo per cui il lavoro della richiesta va interrotto, oppure None."""
+        if self._annullata.is_set():
+            return self.motivo
+        if time.monotonic() >= self.istante:
+            return "tempo_scaduto"
+        return None
+
+    def controlla(self):
+        motivo = self.interruzione()
+        if motivo:
+            raise RichiestaAnnullataError(motivo)
+
+    def timeout(self, massimo):
+        """Timeout da usare per un'operazione bloccante: al più `massimo`, al più il tempo rimanente."""
+        self.controlla()
+        return min(massimo, self.rimanente())
+
+
+class ScadenzaSpeculativa(Scadenza):
+    """
+    Scadenza di un lavoro speculativo (es. prefetch PubMed): segue quella della richiesta, ma può
+    essere annullata da sola quando il risultato non serve più, senza annullare la richiesta.
+    """
+
+    def __init__(self, padre=None):
+        super().__init__(SCADENZA_PREDEFINITA if padre is None else padre.rimanente())
+        self.padre = padre
+
+    @property
+    def annullata(self):
+        return self._annullata.is_set() or (self.padre is not None and self.padre.annullata)
+
+    def interruzione(self):
+        motivo = super().interruzione()
+        if motivo is None and self.padre is not None:
+            motivo = self.padre.interruzione()
+        return motivo
+
+
+def imposta_scadenza(scadenza):
+    """Imposta la scadenza consultata dal contesto corrente (e dai thread degli stadi che avvierà)."""
+    _scadenza_corrente.set(scadenza)
+
+
+def avvia_scadenza(secondi=SCADENZA_PREDEFINITA):
+    """Crea la scadenza della richiesta corrente e la restituisce."""
+    scadenza = Scadenza(secondi)
+    _scadenza_corrente.set(scadenza)
+    return scadenza
+
+
+def scadenza_corrente():
+    return _scadenza_corrente.get()
+
+
+def controlla_scadenza():
+    """Solleva RichiestaAnnullataError se la richiesta corrente è scaduta o annullata."""
+    scadenza = _scadenza_corrente.get()
+    if scadenza is not None:
+        scadenza.controlla()
+
+
+def timeout_rete(massimo):
+    """Timeout per una chiamata di rete della richiesta corrente (massimo se non c'è una scadenza)."""
+    scadenza = _scadenza_corrente.get()
+    return massimo if scadenza is None else scadenza.timeout(massimo)
+
+
+def secondi_da_header(valore, massimo=SCADENZA_PREDEFINITA):
+    """Legge la scadenza indicata dal client (header X-Scadenza-Secondi), limitata a `massimo`."""
+    try:
+        return min(massimo, max(0.0, float(valore))) if valore else massimo
+    except ValueError:
+        return massimo
+
+
+async def _attendi_disconnessione(request, scadenza):
+    while not scadenza.annullata:
+        if await request.is_disconnected():
+            logger.warning("Client disconnesso: annullo il lavoro della richiesta")
+            scadenza.annulla("client_disconnesso")
+            return
+        await asyncio.sleep(INTERVALLO_CONTROLLO)
+
+
+def sorveglia_client(request, scadenza):
+    """Avvia il controllo della connessione del client; il task restituito va annullato a fine richiesta."""
+    return asyncio.ensure_future(_attendi_disconnessione(request, scadenza))
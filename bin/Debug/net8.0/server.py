@@ -1,28 +1,51 @@
 # server.py
 import asyncio
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from retriever import cerca_documenti
+from retriever import cerca_documenti, servi_localmente, coda_arricchimento, cerca_in_faiss, cerca_in_faiss_batch, integra_con_pubmed, integra_batch, risultati_sufficienti, log_risultati_finali, get_model, ensure_faiss_index, indice_metadati, FAISS_INDEX_FILE
+from vector_store import esiste_indice
+from stato_condiviso import crea_archivio_sessioni, leggi_versione, NUM_WORKERS
+from memoria_conversazione import MemoriaConversazione
+from cache_ricerche import cache_ricerche, chiave_ricerca
+from snapshot import ripristina_all_avvio
+from arricchimento import modalita_richiesta as modalita_arricchimento
+from risorse import applica_thread_librerie, carica_risorse
+from pubmed import search_pubmed, search_pubmed_batch
 from reasoning import genera_risposta, initialize_model
 from create_faiss_index import create_faiss_index
 from deep_translator import GoogleTranslator
-from sentence_transformers import SentenceTransformer, util
-from mistral_inference import genera_risposta_mistral
+from sentence_transformers import util
+from embedding_onnx import carica_embedder, BACKEND_EMBEDDING
+from mistral_inference import genera_risposta_mistral, initialize_mistral
+from backends import registro
+from executors import esegui_in_stadio, statistiche_stadi, chiudi_stadi, configurazione_stadio, imposta_corsia, StadioSaturoError
+from ammissione import ammissione, AmmissioneRifiutataError
+from profilazione import avvia_profilo, termina_profilo, modalita_richiesta, arma, profili_lenti, CARTELLA_PROFILI, MODALITA
+from scadenze import avvia_scadenza, imposta_scadenza, scadenza_corrente, ScadenzaSpeculativa, sorveglia_client, secondi_da_header, timeout_rete, RichiestaAnnullataError, SCADENZA_PREDEFINITA, SCADENZA_BATCH
+from warmup import registra_componente, avvia_warmup, stato_componenti, componenti_pronti, componenti_in_errore, caricamento_terminato
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
+from metrics import misura, cronometrato, esporta_prometheus, avvia_tempi_richiesta, richieste, cache
+from typing import Optional
+import numpy as np
+import json
+import hashlib
+import threading
 import uvicorn
 import logging
 import traceback
 import os
 import re
 import torch
-import sys
+from log_asincrono import configura_logging, campi
 
-sys.stdout.reconfigure(line_buffering=True)
-
-
-# Logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Logging: coda non bloccante al posto di basicConfig e di stdout con line buffering
+configura_logging()
 logger = logging.getLogger(__name__)
+logger_classificazione = logging.getLogger("classificazione")
+# La pre-classificazione del testo originale ha metrica e categoria di log proprie
+logger_preclassificazione = logging.getLogger("classificazione.preliminare")
 
 # FastAPI setup
 app = FastAPI(title="Medical AI Assistant")
@@ -35,8 +58,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Modello semantico multilingua
-embedder = SentenceTransformer("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+# Rotte profilate: con l'header X-Profilo (o dopo POST /admin/profilo) in modo dettagliato,
+# altrimenti con il campionatore continuo a bassa frequenza
+ROTTE_PROFILATE = {"/generate", "/search"}
+
+@app.middleware("http")
+async def profila_richieste(request: Request, call_next):
+    modalita = modalita_richiesta(request.headers.get("X-Profilo")) if request.url.path in ROTTE_PROFILATE else None
+    if modalita is None:
+        return await call_next(request)
+    # Il profilo viene propagato all'endpoint e ai thread degli stadi tramite contextvars
+    profilo = avvia_profilo(modalita, request.url.path)
+    try:
+        risposta = await call_next(request)
+    finally:
+        file = termina_profilo(profilo)
+    if file:
+        risposta.headers["X-Profilo-File"] = ",".join(os.path.basename(f) for f in file)
+    return risposta
+
+# Modello semantico multilingua, caricato in modo pigro (vedi get_embedder)
+EMBEDDER_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+embedder = None
+_embedder_lock = threading.RLock()
 
 # Frasi di esempio per classificazione - ESPANSIONE SIGNIFICATIVA
 medical_examples = [
@@ -131,25 +175,104 @@ non_medical_examples = [
 # Combina gli esempi con etichette
 labeled_examples = [(esempio, 1) for esempio in medical_examples] + [(esempio, 0) for esempio in non_medical_examples]
 
-# Crea gli embedding per tutti gli esempi
+# Gli embedding degli esempi vengono calcolati una volta e salvati su disco (vedi get_esempi_embeddings)
 all_examples = [example for example, _ in labeled_examples]
-all_embeddings = embedder.encode(all_examples, convert_to_tensor=True)
+all_embeddings = None
 
 # Salva le etichette per recuperarle facilmente
 example_labels = [label for _, label in labeled_examples]
 
-# Stato conversazione per utente
-user_context = {}
+# Stato conversazione per utente (condiviso tra i worker se PROVA_SESSIONI=sqlite)
+user_context = crea_archivio_sessioni()
+# Riassunto compresso di ogni conversazione, usato nel prompt al posto dei turni completi
+memoria = MemoriaConversazione(user_context)
+
+def get_embedder():
+    """Restituisce il modello semantico multilingua, caricandolo alla prima chiamata."""
+    global embedder
+    if embedder is None:
+        with _embedder_lock:
+            if embedder is None:
+                embedder = carica_embedder(EMBEDDER_NAME)
+    return embedder
+
+def _percorso_cache_esempi(embedder):
+    """
+    Il file di cache dipende dal modello, dal backend effettivamente caricato (anche dopo il ripiego
+    da ONNX a PyTorch) e dal testo degli esempi, così si invalida da solo.
+    """
+    backend = getattr(embedder, "backend_embedding", BACKEND_EMBEDDING)
+    impronta = hashlib.sha1("\n".join([EMBEDDER_NAME, backend] + all_examples).encode("utf-8")).hexdigest()[:12]
+    return f"cache_esempi_{impronta}.npy"
+
+def get_esempi_embeddings():
+    """
+    Restituisce gli embedding degli esempi di classificazione.
+    Vengono calcolati una sola volta, salvati in un file .npy e poi letti come array memory-mapped.
+    """
+    global all_embeddings
+    if all_embeddings is None:
+        with _embedder_lock:
+            if all_embeddings is None:
+                modello = get_embedder()
+                percorso = _percorso_cache_esempi(modello)
+                cache.inc(cache="esempi_classificatore", esito="hit" if os.path.exists(percorso) else "miss")
+                if not os.path.exists(percorso):
+                    logger.info("Calcolo degli embedding degli esempi di classificazione...")
+                    embeddings = modello.encode(all_examples, convert_to_numpy=True).astype('float32')
+                    # Scrittura atomica: con più worker un altro processo potrebbe leggere il file a metà
+                    temporaneo = f"{percorso}.{os.getpid()}.tmp"
+                    with open(temporaneo, 'wb') as f:
+                        np.save(f, embeddings)
+                    try:
+                        os.replace(temporaneo, percorso)
+                    except OSError:
+                        # Un altro worker lo ha già scritto e lo tiene mappato (Windows)
+                        os.remove(temporaneo)
+                # mmap in copy-on-write: nessuna copia in memoria e tensore torch senza avvisi
+                mappati = np.load(percorso, mmap_mode='c')
+                all_embeddings = torch.from_numpy(mappati)
+    return all_embeddings
+
+class FiltriRicerca(BaseModel):
+    anno_min: Optional[int] = None
+    anno_max: Optional[int] = None
+    categorie: Optional[list[str]] = None  # categorie di ListaKeywords.json
+    lingue: Optional[list[str]] = None  # codici PubMed, es. "eng"
+    tipi: Optional[list[str]] = None  # tipi di pubblicazione, es. "Review"
+
+    def come_dict(self):
+        return {chiave: valore for chiave, valore in self.dict().items() if valore is not None} or None
 
 class DomandaRequest(BaseModel):
     domanda: str
     num_results: int = 5
+    includi_tempi: bool = False  # Se True la risposta include i tempi di ogni stadio (ms)
+    arricchimento: Optional[str] = None  # "sincrona" o "asincrona" (PubMed in background); None per PROVA_ARRICCHIMENTO
+    filtri: Optional[FiltriRicerca] = None  # Limita la ricerca ai documenti con questi metadati
 
 class RispostaResponse(BaseModel):
     risposta: str
     documenti_utilizzati: list
+    tempi: Optional[dict] = None
+
+class BatchRequest(BaseModel):
+    domande: list[str]
+    num_results: int = 5
+
+class ProfiloRequest(BaseModel):
+    richieste: int = 1
+    modalita: str = "campionamento"  # "campionamento" o "cprofile"
+
+# Limiti di /generate/batch: domande per richiesta e domande per chiamata di traduzione
+MAX_DOMANDE_BATCH = 200
+DOMANDE_PER_TRADUZIONE = 10
+
+# Attesa massima di una traduzione, come per le chiamate PubMed
+TIMEOUT_TRADUZIONE = 10
 
 # Traduzione
+@cronometrato("traduzione")
 def traduci_testo(text, src='auto', target='en'):
     try:
         return GoogleTranslator(source=src, target=target).translate(text)
@@ -157,6 +280,14 @@ def traduci_testo(text, src='auto', target='en'):
         logger.warning(f"Errore nella traduzione: {e}")
         return text
 
+@cronometrato("traduzione_batch")
+def traduci_batch(testi, src='auto', target='en'):
+    try:
+        return GoogleTranslator(source=src, target=target).translate_batch(testi)
+    except Exception as e:
+        logger.warning(f"Errore nella traduzione in batch, traduco una domanda alla volta: {e}")
+        return [traduci_testo(testo, src, target) for testo in testi]
+
 # Pulizia risposta
 import re
 
@@ -174,8 +305,8 @@ def pulisci_risposta(text, domanda_utente=None):
     Returns:
         str: Testo pulito.
     """
-    # Rimuovi token speciali e prefissi comuni
-    text = text.replace("<|im_start|>", "").replace("<|im_end|>", "").replace("Assistant:", "").strip()
+    # I token speciali del modello sono già rimossi dal backend (BackendGenerazione.pulisci)
+    text = text.replace("Assistant:", "").strip()
 
     # Se c'è "Risposta:", taglia tutto prima
     match = re.search(r"(?i)\bRisposta:\s*", text)
@@ -194,6 +325,7 @@ def pulisci_risposta(text, domanda_utente=None):
 
 
 # Correzione grammaticale in italiano
+@cronometrato("traduzione_risposta")
 def correggi_risposta_italiana(testo):
     try:
         if re.search(r'[àèéìòù]', testo.lower()):
@@ -205,30 +337,59 @@ def correggi_risposta_italiana(testo):
 
 # Contesto utente
 def get_user_context(user_id):
-    if user_id not in user_context:
-        user_context[user_id] = []
-    return user_context[user_id]
+    return user_context.storia(user_id)
+
+def update_user_context(user_id, domanda, risposta, domanda_tradotta=None):
+    # La traduzione serve alla ricerca con più varianti per i follow-up (vedi varianti_query.py)
+    user_context.aggiungi(user_id, domanda, risposta, domanda_tradotta)
+    # Il riassunto si aggiorna dopo la risposta, fuori dal percorso critico; se l'aggiornamento
+    # viene scartato, il turno mancante viene riassunto al prossimo aggiornamento o nel prompt stesso
+    avvia_in_background("memoria", memoria.aggiorna, user_id).add_done_callback(_esito_memoria)
 
-def update_user_context(user_id, domanda, risposta):
-    contesto = get_user_context(user_id)
-    contesto.append({"domanda": domanda, "risposta": risposta})
+def _esito_memoria(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Aggiornamento del riassunto di conversazione non eseguito: {task.exception()}")
 
 # Classificazione migliorata - considera anche esempi non medici e usa voto di maggioranza
+@cronometrato("classificazione")
 def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5):
     """
     Classifica una domanda come medica o non medica usando un approccio semantico.
-    
+
     Args:
         translated_question: La domanda tradotta in inglese
         history: Storico delle conversazioni
         soglia: Soglia di similarità per la classificazione diretta
         k: Numero di esempi simili da considerare per il voto di maggioranza
-        
+
     Returns:
         Boolean: True se la domanda è medica, False altrimenti
     """
+    return _classifica_e_registra(logger_classificazione, translated_question, history, soglia, k)
+
+@cronometrato("preclassificazione")
+def preclassifica_domanda(domanda, history, soglia=0.65, k=5):
+    """
+    Pre-classificazione della domanda originale (non tradotta), eseguita mentre la traduzione è in corso.
+    Stessa logica di classifica_domanda_con_storia, misurata e registrata separatamente.
+    """
+    return _classifica_e_registra(logger_preclassificazione, domanda, history, soglia, k)
+
+def _classifica_e_registra(log, domanda, history, soglia, k):
+    # I passaggi del ragionamento finiscono in un'unica riga, sul logger campionato indicato
+    passi = []
+    is_medical = _classifica_domanda_con_storia(domanda, history, soglia, k, passi)
+    log.info(
+        "Classificazione: " + " | ".join(passi),
+        extra=campi(esito="medica" if is_medical else "non_medica", con_storia=bool(history))
+    )
+    return is_medical
+
+def _classifica_domanda_con_storia(translated_question, history, soglia, k, passi):
     # Calcola embedding della domanda attuale per classificazione generale
+    embedder = get_embedder()
     question_embedding = embedder.encode([translated_question], convert_to_tensor=True)
+    all_embeddings = get_esempi_embeddings().to(question_embedding.device)
     
     # Calcola similarità con tutti gli esempi (medici e non)
     cos_scores = util.pytorch_cos_sim(question_embedding, all_embeddings)[0]
@@ -251,8 +412,8 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
     max_similarity = cos_scores[max_idx].item()
     
     # Logging dettagliato
-    logger.info(f"Esempio più simile: '{max_example}' (etichetta: {'medica' if max_label == 1 else 'non medica'}, similarità: {max_similarity:.3f})")
-    logger.info(f"Classificazione diretta: {'medical' if medical_score >= 0.5 else 'non-medical'} (score: {medical_score:.3f})")
+    passi.append(f"Esempio più simile: '{max_example}' (etichetta: {'medica' if max_label == 1 else 'non medica'}, similarità: {max_similarity:.3f})")
+    passi.append(f"Classificazione diretta: {'medical' if medical_score >= 0.5 else 'non-medical'} (score: {medical_score:.3f})")
     
     # Verifica semantica tra domanda attuale e precedente se esiste una storia
     if history:
@@ -262,7 +423,7 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
         
         # Calcola similarità semantica tra domanda corrente e precedente
         semantic_similarity = util.pytorch_cos_sim(question_embedding, prev_embedding)[0][0].item()
-        logger.info(f"Similarità semantica con domanda precedente: {semantic_similarity:.3f}")
+        passi.append(f"Similarità semantica con domanda precedente: {semantic_similarity:.3f}")
         
         # Verifica se la domanda attuale è semanticamente più vicina alla categoria medica o non medica
         # Utilizziamo gli esempi medici e non medici già classificati per creare centroidi semantici
@@ -277,17 +438,17 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
         non_medical_similarities = [cos_scores[i].item() for i in non_medical_examples_indices]
         avg_non_medical_similarity = sum(non_medical_similarities) / len(non_medical_similarities) if non_medical_similarities else 0
         
-        logger.info(f"Similarità media con esempi medici: {avg_medical_similarity:.3f}")
-        logger.info(f"Similarità media con esempi non medici: {avg_non_medical_similarity:.3f}")
+        passi.append(f"Similarità media con esempi medici: {avg_medical_similarity:.3f}")
+        passi.append(f"Similarità media con esempi non medici: {avg_non_medical_similarity:.3f}")
         
         # Se la domanda è chiaramente più simile agli esempi non medici
         # e c'è una differenza significativa, la consideriamo non medica
         if avg_non_medical_similarity > avg_medical_similarity + 0.1:
-            logger.info("Domanda semanticamente più vicina agli esempi non medici")
+            passi.append("Domanda semanticamente più vicina agli esempi non medici")
             is_new_topic = True
             # Se siamo sicuri che è un argomento non medico, restituisci False
             if avg_non_medical_similarity > 0.5 and avg_medical_similarity < 0.4:
-                logger.info("Domanda chiaramente non medica in base al confronto semantico")
+                passi.append("Domanda chiaramente non medica in base al confronto semantico")
                 return False
         else:
             is_new_topic = False
@@ -295,12 +456,12 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
         # Se la domanda corrente ha bassa similarità semantica con la precedente
         # ma non siamo sicuri della classificazione, procedi con altri controlli
         if semantic_similarity < 0.3:
-            logger.info("Domanda semanticamente diversa dalla precedente - potrebbe essere un nuovo argomento")
+            passi.append("Domanda semanticamente diversa dalla precedente - potrebbe essere un nuovo argomento")
             
             # Se la similarità con la domanda precedente è molto bassa
             # e la similarità con esempi non medici è maggiore, considerala un cambio argomento
             if semantic_similarity < 0.2 and avg_non_medical_similarity > avg_medical_similarity:
-                logger.info("Probabile cambio di argomento verso topic non medico")
+                passi.append("Probabile cambio di argomento verso topic non medico")
                 return False
     
     # Gestione di domande molto brevi e ambigue (follow-up)
@@ -308,7 +469,7 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
         is_semantically_similar = semantic_similarity >= 0.3 if 'semantic_similarity' in locals() else False
         
         if is_semantically_similar:
-            logger.info("Domanda molto breve rilevata e semanticamente simile - potrebbe essere un follow-up")
+            passi.append("Domanda molto breve rilevata e semanticamente simile - potrebbe essere un follow-up")
             
             # Frasi comuni di follow-up in inglese
             followup_patterns = [
@@ -334,26 +495,26 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
                 prev_total_weight = sum(score.item() for score in prev_top_k_scores)
                 prev_medical_score = prev_weighted_sum / prev_total_weight if prev_total_weight > 0 else 0
                 
-                logger.info(f"Rilevato probabile follow-up - la domanda precedente era {'MEDICA' if prev_medical_score >= 0.6 else 'NON MEDICA'} con score {prev_medical_score:.3f}")
+                passi.append(f"Rilevato probabile follow-up - la domanda precedente era {'MEDICA' if prev_medical_score >= 0.6 else 'NON MEDICA'} con score {prev_medical_score:.3f}")
                 
                 # Per domande molto brevi come "perché?", "come?", "e poi?", ecc.
                 if len(translated_question.split()) <= 3:
-                    logger.info("Domanda estremamente corta - probabilmente è un follow-up diretto")
+                    passi.append("Domanda estremamente corta - probabilmente è un follow-up diretto")
                     return prev_medical_score >= 0.5
                     
                 # Per domande che sembrano follow-up ma sono un po' più lunghe
                 if is_followup and prev_medical_score >= 0.6:
-                    logger.info("Domanda precedente era chiaramente medica e questa è un follow-up - mantengo classificazione MEDICA")
+                    passi.append("Domanda precedente era chiaramente medica e questa è un follow-up - mantengo classificazione MEDICA")
                     return True
                 elif is_followup and prev_medical_score <= 0.4:
-                    logger.info("Domanda precedente era chiaramente NON medica e questa è un follow-up - mantengo classificazione NON MEDICA")
+                    passi.append("Domanda precedente era chiaramente NON medica e questa è un follow-up - mantengo classificazione NON MEDICA")
                     return False
         else:
-            logger.info("Domanda breve ma non semanticamente simile alla precedente - probabile nuovo argomento")
+            passi.append("Domanda breve ma non semanticamente simile alla precedente - probabile nuovo argomento")
     
     # Se la similarità massima è molto bassa, potrebbe essere una domanda ambigua
     if max_similarity < 0.3:
-        logger.info("Bassa similarità con tutti gli esempi - classificazione potenzialmente incerta")
+        passi.append("Bassa similarità con tutti gli esempi - classificazione potenzialmente incerta")
     
     # Ottiene una risposta binaria basata sul punteggio calcolato all'inizio
     is_medical = medical_score >= 0.5
@@ -361,7 +522,7 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
     # Considera il contesto solo se la risposta è ambigua (vicino alla soglia)
     # e se c'è alta similarità semantica con la domanda precedente
     if 0.4 <= medical_score <= 0.6 and history and 'semantic_similarity' in locals() and semantic_similarity >= 0.3:
-        logger.info("Controllo contesto per classificazione ambigua...")
+        passi.append("Controllo contesto per classificazione ambigua...")
         
         # Se la domanda precedente era chiaramente medica, aumenta la probabilità
         if prev_medical_score >= 0.7:
@@ -381,92 +542,443 @@ def classifica_domanda_con_storia(translated_question, history, soglia=0.65, k=5
             combined_total_weight = sum(score.item() for score in combined_top_k_scores)
             combined_medical_score = combined_weighted_sum / combined_total_weight if combined_total_weight > 0 else 0
             
-            logger.info(f"Classificazione con contesto: {'medical' if combined_medical_score >= 0.5 else 'non-medical'} (score: {combined_medical_score:.3f})")
+            passi.append(f"Classificazione con contesto: {'medical' if combined_medical_score >= 0.5 else 'non-medical'} (score: {combined_medical_score:.3f})")
             return combined_medical_score >= 0.5
         else:
-            logger.info("Contesto precedente non chiaramente medico: mantengo classificazione diretta.")
+            passi.append("Contesto precedente non chiaramente medico: mantengo classificazione diretta.")
     
     return is_medical
 
-# Esecuzione asincrona
-async def esegui_in_background(funzione, *args):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, funzione, *args)
+@cronometrato("classificazione_batch")
+def classifica_domande(testi, k=5):
+    """
+    Classificazione diretta (senza storia) di più domande con un'unica codifica:
+    stessa media ponderata delle etichette dei k esempi più simili di classifica_domanda_con_storia.
+
+    Returns:
+        list: True per ogni domanda medica.
+    """
+    embeddings = get_embedder().encode(testi, convert_to_tensor=True)
+    esempi = get_esempi_embeddings().to(embeddings.device)
+    cos_scores = util.pytorch_cos_sim(embeddings, esempi)
+    top_k_scores, top_k_indices = torch.topk(cos_scores, k=min(k, len(all_examples)), dim=1)
+    top_k_scores = top_k_scores.cpu()
+    top_k_labels = torch.tensor(example_labels, dtype=top_k_scores.dtype)[top_k_indices.cpu()]
+    total_weight = top_k_scores.sum(dim=1)
+    medical_scores = torch.where(total_weight > 0, (top_k_scores * top_k_labels).sum(dim=1) / total_weight, torch.zeros_like(total_weight))
+    return [score >= 0.5 for score in medical_scores.tolist()]
+
+# Esecuzione asincrona, ogni funzione gira nell'executor dedicato al suo stadio
+async def esegui_in_background(stadio, funzione, *args):
+    return await esegui_in_stadio(stadio, funzione, *args)
+
+def avvia_in_background(stadio, funzione, *args):
+    """Avvia subito una funzione bloccante come task asyncio, senza attenderne il risultato."""
+    return asyncio.ensure_future(esegui_in_background(stadio, funzione, *args))
+
+def avvia_speculativo(stadio, funzione, *args):
+    """
+    Come avvia_in_background, ma il lavoro ha una scadenza propria: annulla() la imposta, così una
+    funzione già in esecuzione su un thread (es. search_pubmed) si ferma al controllo successivo
+    invece di completare le sue chiamate di rete.
+    """
+    scadenza = ScadenzaSpeculativa(scadenza_corrente())
+
+    async def esegui():
+        # Il task ha una copia del contesto: la scadenza speculativa vale solo per questo lavoro
+        imposta_scadenza(scadenza)
+        return await esegui_in_background(stadio, funzione, *args)
+
+    task = asyncio.ensure_future(esegui())
+    task.scadenza = scadenza
+    return task
+
+def annulla(*tasks):
+    """Annulla i task speculativi il cui risultato non serve più, fermando anche il lavoro già avviato."""
+    for task in tasks:
+        if task is not None and not task.done():
+            if getattr(task, "scadenza", None) is not None:
+                task.scadenza.annulla("speculazione_inutile")
+            task.cancel()
+
+async def recupera_documenti(domanda_tradotta, k, task_faiss=None, task_pubmed=None, max_search=50, arricchimento=None, filtri=None, storia=None):
+    """
+    Combina la ricerca FAISS e il prefetch PubMed, eventualmente già avviati in modo speculativo.
+
+    Se FAISS restituisce abbastanza risultati il prefetch PubMed viene annullato,
+    altrimenti i documenti scaricati vengono integrati nell'indice. In modalità di arricchimento
+    asincrona, risultati locali parziali ma accettabili vengono restituiti subito e PubMed
+    prosegue in background (vedi arricchimento.py).
+
+    Returns:
+        tuple: I documenti trovati, flag FAISS e flag di aggiornamento dell'indice.
+    """
+    if task_faiss is None:
+        task_faiss = avvia_in_background("embedding", cerca_in_faiss, domanda_tradotta, max_search, 0.5, filtri, storia)
+    # In modalità asincrona PubMed serve solo se i risultati locali non bastano: nessun prefetch
+    if task_pubmed is None and modalita_arricchimento(arricchimento) == "sincrona":
+        task_pubmed = avvia_speculativo("rete", search_pubmed, domanda_tradotta, max_search)
+
+    try:
+        faiss_results = await task_faiss
+        if risultati_sufficienti(faiss_results, k):
+            annulla(task_pubmed)
+            top_results = faiss_results[:k]
+            log_risultati_finali(top_results)
+            return top_results, True, False
+
+        top_results = servi_localmente(domanda_tradotta, faiss_results, k, arricchimento)
+        if top_results is not None:
+            annulla(task_pubmed)
+            return top_results, True, False
+
+        logger.info("→ Risultati FAISS insufficienti, uso i risultati PubMed...")
+        if task_pubmed is None:
+            task_pubmed = avvia_in_background("rete", search_pubmed, domanda_tradotta, max_search)
+        nuovi_documenti = await task_pubmed
+        return await esegui_in_background("indice", integra_con_pubmed, domanda_tradotta, faiss_results, nuovi_documenti, k, 0.5, filtri)
+    except BaseException:
+        annulla(task_faiss, task_pubmed)
+        raise
+
+def risposta_sovraccarico(errore):
+    """Errore HTTP 503 restituito quando uno stadio della pipeline è saturo."""
+    logger.warning(f"Richiesta rifiutata: {errore}")
+    return HTTPException(
+        status_code=503,
+        detail=f"Server sovraccarico (stadio {errore.stadio}), riprova tra poco.",
+        headers={"Retry-After": str(errore.riprova_tra)},
+    )
+
+def risposta_troppe_richieste(errore):
+    """Errore HTTP 429 restituito subito dal controllo di ammissione, prima di qualsiasi elaborazione."""
+    logger.warning(f"Richiesta non ammessa: {errore}")
+    return HTTPException(
+        status_code=429,
+        detail="Troppe richieste in elaborazione, riprova tra poco.",
+        headers={"Retry-After": str(errore.riprova_tra)},
+    )
+
+def risposta_interrotta(errore):
+    """Errore HTTP per una richiesta scaduta (504) o abbandonata dal client (499, che nessuno leggerà)."""
+    if errore.motivo == "client_disconnesso":
+        logger.info("Richiesta abbandonata dal client: lavoro annullato")
+        return HTTPException(status_code=499, detail="Richiesta annullata dal client.")
+    logger.warning("Richiesta scaduta prima del completamento")
+    return HTTPException(status_code=504, detail="Tempo massimo della richiesta superato.")
+
+def avvia_controlli_richiesta(http_request, massimo=SCADENZA_PREDEFINITA):
+    """
+    Crea la scadenza della richiesta (header X-Scadenza-Secondi, limitato dalla configurazione)
+    e avvia il controllo della disconnessione del client.
+
+    Returns:
+        tuple: La scadenza e il task di controllo, da annullare a fine richiesta.
+    """
+    scadenza = avvia_scadenza(secondi_da_header(http_request.headers.get("X-Scadenza-Secondi"), massimo))
+    return scadenza, sorveglia_client(http_request, scadenza)
+
+async def attendi_traduzione(task, testo):
+    """
+    Attende la traduzione al più TIMEOUT_TRADUZIONE secondi (e non oltre la scadenza della richiesta):
+    GoogleTranslator non accetta un timeout, quindi in caso di ritardo si prosegue con il testo originale.
+    """
+    try:
+        return await asyncio.wait_for(task, timeout_rete(TIMEOUT_TRADUZIONE))
+    except asyncio.TimeoutError:
+        logger.warning("Traduzione troppo lenta, proseguo con il testo originale")
+        return testo
 
 @app.post("/generate", response_model=RispostaResponse)
-async def generate(request: DomandaRequest):
+async def generate(request: DomandaRequest, http_request: Request):
+    # Ammissione prima di qualsiasi lavoro: in sovraccarico la risposta 429 è immediata
+    try:
+        biglietto = ammissione.entra("interattiva")
+    except AmmissioneRifiutataError as e:
+        richieste.inc(rotta="/generate", esito="non_ammessa")
+        raise risposta_troppe_richieste(e)
+    task_faiss = task_pubmed = None
+    tempi = avvia_tempi_richiesta()
+    _, sorveglianza = avvia_controlli_richiesta(http_request)
     try:
         domanda_originale = request.domanda.strip()
         logger.info(f"Domanda ricevuta: {domanda_originale}")
+        filtri = request.filtri.come_dict() if request.filtri else None
         user_id = "user_1"
         contesto_utente = get_user_context(user_id)
 
-        domanda_tradotta = await esegui_in_background(traduci_testo, domanda_originale, 'it', 'en')
-        is_medica = classifica_domanda_con_storia(domanda_tradotta, contesto_utente)
-        
+        # Stadio 1: traduzione e pre-classificazione del testo italiano in parallelo
+        # (l'embedder è multilingua, quindi la domanda originale è già classificabile)
+        task_traduzione = avvia_in_background("rete", traduci_testo, domanda_originale, 'it', 'en')
+        task_preclassificazione = avvia_in_background("embedding", preclassifica_domanda, domanda_originale, contesto_utente)
+
+        domanda_tradotta = await attendi_traduzione(task_traduzione, domanda_originale)
+        pre_medica = task_preclassificazione.result() if task_preclassificazione.done() and not task_preclassificazione.exception() else True
+        annulla(task_preclassificazione)
+
+        # Stadio 2: classificazione della traduzione, con FAISS e prefetch PubMed speculativi
+        if pre_medica:
+            task_faiss = avvia_in_background("embedding", cerca_in_faiss, domanda_tradotta, 50, 0.5, filtri, contesto_utente)
+            if modalita_arricchimento(request.arricchimento) == "sincrona":
+                task_pubmed = avvia_speculativo("rete", search_pubmed, domanda_tradotta, 50)
+        is_medica = await esegui_in_background("embedding", classifica_domanda_con_storia, domanda_tradotta, contesto_utente)
+
         # Log la decisione finale
         logger.info(f"Decisione finale: La domanda '{domanda_originale}' è {'MEDICA' if is_medica else 'NON MEDICA'}")
 
-        contesto_storico = ""
-        if contesto_utente:
-            ultimi = contesto_utente[-3:]
-            contesto_storico = "\n".join([f"Domanda: {x['domanda']}\nRisposta: {x['risposta']}" for x in ultimi])
+        # Riassunto dei turni precedenti più l'ultimo turno, entro PROVA_MEMORIA_TOKEN token
+        contesto_storico = memoria.contesto(user_id, contesto_utente)
 
         if is_medica:
             logger.info("Avvio ricerca FAISS/PubMed...")
-            documenti, da_faiss, aggiornato = await esegui_in_background(cerca_documenti, domanda_tradotta, request.num_results)
+            documenti, da_faiss, aggiornato = await recupera_documenti(domanda_tradotta, request.num_results, task_faiss, task_pubmed, arricchimento=request.arricchimento, filtri=filtri, storia=contesto_utente)
+            task_faiss = task_pubmed = None
 
-            if not documenti and not os.path.exists("faiss_index.index"):
+            if not documenti and not esiste_indice(FAISS_INDEX_FILE):
                 logger.info("Indice FAISS mancante. Lo creo...")
-                await esegui_in_background(create_faiss_index)
-                documenti, da_faiss, aggiornato = await esegui_in_background(cerca_documenti, domanda_tradotta, request.num_results)
+                await esegui_in_background("indice", create_faiss_index)
+                documenti, da_faiss, aggiornato = await esegui_in_background("indice", cerca_documenti, domanda_tradotta, request.num_results, 50, 0.5, request.arricchimento, filtri, contesto_utente)
 
             if documenti:
                 logger.info(f"Trovati {len(documenti)} documenti - Fonte: {'FAISS' if da_faiss else 'PubMed'}")
                 if aggiornato:
                     logger.info("Indice FAISS aggiornato con nuovi dati da PubMed.")
                 prompt = f"{contesto_storico}\nDomanda: {domanda_originale}\nRisposta:"
-                risposta = await esegui_in_background(genera_risposta, prompt, documenti)
+                risposta = await esegui_in_background("generazione", genera_risposta, prompt, documenti)
                 risposta = pulisci_risposta(risposta)
                 if not risposta or risposta == "La risposta è stata:":
                     risposta = "Mi scuso, non sono riuscito a trovare una risposta adeguata. Ti consiglio di consultare un esperto."
-                update_user_context(user_id, domanda_originale, risposta)
+                update_user_context(user_id, domanda_originale, risposta, domanda_tradotta)
+                richieste.inc(rotta="/generate", esito="medica")
                 return {
                     "risposta": risposta,
-                    "documenti_utilizzati": [{"id": d.get("id", ""), "title": d.get("title", "")} for d in documenti]
+                    "documenti_utilizzati": [{"id": d.get("id", ""), "title": d.get("title", "")} for d in documenti],
+                    "tempi": tempi.riepilogo() if request.includi_tempi else None
                 }
             else:
                 logger.warning("Nessun documento rilevante trovato.")
                 risposta = "Non ho trovato informazioni mediche rilevanti. Ti consiglio di consultare un medico."
-                update_user_context(user_id, domanda_originale, risposta)
-                return {"risposta": risposta, "documenti_utilizzati": []}
+                update_user_context(user_id, domanda_originale, risposta, domanda_tradotta)
+                richieste.inc(rotta="/generate", esito="nessun_documento")
+                return {"risposta": risposta, "documenti_utilizzati": [], "tempi": tempi.riepilogo() if request.includi_tempi else None}
         else:
+            # La ricerca speculativa non serve per le domande non mediche
+            annulla(task_faiss, task_pubmed)
             logger.info("Uso modello Mistral per domanda non medica.")
             prompt = f"{contesto_storico}\nDomanda: {domanda_originale}\nRisposta:"
-            risposta_raw = await esegui_in_background(genera_risposta_mistral, prompt)
-            risposta_tradotta = await esegui_in_background(correggi_risposta_italiana, pulisci_risposta(risposta_raw))
+            risposta_raw = await esegui_in_background("generazione", genera_risposta_mistral, prompt)
+            risposta_tradotta = await esegui_in_background("rete", correggi_risposta_italiana, pulisci_risposta(risposta_raw))
             if not risposta_tradotta or risposta_tradotta == "La risposta è stata:":
                 risposta_tradotta = "Mi dispiace, non sono riuscito a generare una risposta adeguata."
-            update_user_context(user_id, domanda_originale, risposta_tradotta)
+            update_user_context(user_id, domanda_originale, risposta_tradotta, domanda_tradotta)
+            richieste.inc(rotta="/generate", esito="non_medica")
             return {
                 "risposta": risposta_tradotta,
-                "documenti_utilizzati": []
+                "documenti_utilizzati": [],
+                "tempi": tempi.riepilogo() if request.includi_tempi else None
             }
 
+    except StadioSaturoError as e:
+        richieste.inc(rotta="/generate", esito="rifiutata")
+        raise risposta_sovraccarico(e)
+    except RichiestaAnnullataError as e:
+        richieste.inc(rotta="/generate", esito=e.motivo)
+        raise risposta_interrotta(e)
     except Exception as e:
+        richieste.inc(rotta="/generate", esito="errore")
         logger.error(f"Errore nella generazione: {e}")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Errore durante l'elaborazione della domanda.")
+    finally:
+        annulla(task_faiss, task_pubmed, sorveglianza)
+        biglietto.rilascia()
+
+async def prepara_batch(domande, k):
+    """
+    Prima fase di /generate/batch: traduzione, classificazione e retrieval di tutte le domande insieme.
+    Le traduzioni vengono eseguite a lotti in parallelo, la ricerca FAISS con un'unica index.search,
+    e le domande senza risultati locali sufficienti condividono le chiamate PubMed e una sola scrittura dell'indice.
+
+    Returns:
+        tuple: Per ogni domanda, il flag medica e i documenti recuperati.
+    """
+    lotti = [domande[i:i + DOMANDE_PER_TRADUZIONE] for i in range(0, len(domande), DOMANDE_PER_TRADUZIONE)]
+    tradotte = [testo for lotto in await asyncio.gather(
+        *(esegui_in_background("rete", traduci_batch, lotto, 'it', 'en') for lotto in lotti)) for testo in lotto]
+    mediche = await esegui_in_background("embedding", classifica_domande, tradotte)
+
+    indici_medici = [i for i, medica in enumerate(mediche) if medica]
+    documenti = [[] for _ in domande]
+    if indici_medici:
+        query = [tradotte[i] for i in indici_medici]
+        faiss_results, query_embs = await esegui_in_background("embedding", cerca_in_faiss_batch, query)
+        mancanti = [j for j, risultati in enumerate(faiss_results) if not risultati_sufficienti(risultati, k)]
+        for j, risultati in enumerate(faiss_results):
+            documenti[indici_medici[j]] = risultati[:k]
+
+        if mancanti:
+            logger.info(f"→ {len(mancanti)} domande del batch con risultati FAISS insufficienti, cerco su PubMed...")
+            nuovi = await esegui_in_background("rete", search_pubmed_batch, [query[j] for j in mancanti], 50)
+            integrati = await esegui_in_background(
+                "indice", integra_batch, query_embs[mancanti], [faiss_results[j] for j in mancanti], nuovi, k)
+            for j, (top_results, _, _) in zip(mancanti, integrati):
+                documenti[indici_medici[j]] = top_results
+
+    logger.info(f"Batch preparato: {len(domande)} domande, {len(indici_medici)} mediche")
+    return mediche, documenti
+
+async def _rispondi_batch(indice, domanda, medica, documenti, limite):
+    """Genera la risposta di una domanda del batch; gli errori vengono riportati nel risultato."""
+    risultato = {
+        "indice": indice,
+        "domanda": domanda,
+        "medica": medica,
+        "documenti_utilizzati": [{"id": d.get("id", ""), "title": d.get("title", "")} for d in documenti],
+    }
+    try:
+        prompt = f"\nDomanda: {domanda}\nRisposta:"
+        if medica and not documenti:
+            risposta = "Non ho trovato informazioni mediche rilevanti. Ti consiglio di consultare un medico."
+            esito = "nessun_documento"
+        elif medica:
+            async with limite:
+                risposta = pulisci_risposta(await esegui_in_background("generazione", genera_risposta, prompt, documenti))
+            if not risposta or risposta == "La risposta è stata:":
+                risposta = "Mi scuso, non sono riuscito a trovare una risposta adeguata. Ti consiglio di consultare un esperto."
+            esito = "medica"
+        else:
+            async with limite:
+                risposta_raw = await esegui_in_background("generazione", genera_risposta_mistral, prompt)
+            risposta = await esegui_in_background("rete", correggi_risposta_italiana, pulisci_risposta(risposta_raw))
+            if not risposta or risposta == "La risposta è stata:":
+                risposta = "Mi dispiace, non sono riuscito a generare una risposta adeguata."
+            esito = "non_medica"
+        risultato["risposta"] = risposta
+    except StadioSaturoError as e:
+        risultato["errore"] = f"Server sovraccarico (stadio {e.stadio})"
+        esito = "rifiutata"
+    except RichiestaAnnullataError as e:
+        risultato["errore"] = "Tempo massimo del batch superato." if e.motivo == "tempo_scaduto" else "Batch annullato dal client."
+        esito = e.motivo
+    except Exception as e:
+        logger.error(f"Errore nella domanda {indice} del batch: {e}")
+        risultato["errore"] = "Errore durante l'elaborazione della domanda."
+        esito = "errore"
+    richieste.inc(rotta="/generate/batch", esito=esito)
+    return risultato
+
+async def risposte_batch(domande, mediche, documenti):
+    """
+    Seconda fase di /generate/batch: distribuisce le generazioni sui worker dello stadio "generazione"
+    e restituisce i risultati nell'ordine in cui vengono completati. Il batch non tiene in coda più
+    richieste dei worker disponibili, così le richieste interattive non trovano la coda piena.
+    """
+    limite = asyncio.Semaphore(configurazione_stadio("generazione")["workers"])
+    tasks = [asyncio.ensure_future(_rispondi_batch(i, domande[i], mediche[i], documenti[i], limite)) for i in range(len(domande))]
+    try:
+        for completato in asyncio.as_completed(tasks):
+            yield await completato
+    finally:
+        annulla(*tasks)
+
+@app.post("/generate/batch")
+async def generate_batch(request: BatchRequest, http_request: Request):
+    domande = [domanda.strip() for domanda in request.domande]
+    if not domande:
+        raise HTTPException(status_code=400, detail="Nessuna domanda nel batch.")
+    if len(domande) > MAX_DOMANDE_BATCH:
+        raise HTTPException(status_code=413, detail=f"Al massimo {MAX_DOMANDE_BATCH} domande per batch.")
+    logger.info(f"Batch ricevuto: {len(domande)} domande")
+
+    try:
+        biglietto = ammissione.entra("batch")
+    except AmmissioneRifiutataError as e:
+        richieste.inc(rotta="/generate/batch", esito="non_ammessa")
+        raise risposta_troppe_richieste(e)
+
+    # Tutto il lavoro del batch, compresi i task creati durante lo streaming, usa la corsia a bassa priorità.
+    # La scadenza vale per l'intero batch; durante lo streaming la disconnessione
+    # viene rilevata da StreamingResponse, che chiude il generatore delle righe
+    imposta_corsia("batch")
+    scadenza, sorveglianza = avvia_controlli_richiesta(http_request, SCADENZA_BATCH)
+    preparato = False
+    try:
+        mediche, documenti = await prepara_batch(domande, request.num_results)
+        preparato = True
+    except StadioSaturoError as e:
+        richieste.inc(rotta="/generate/batch", esito="rifiutata")
+        raise risposta_sovraccarico(e)
+    except RichiestaAnnullataError as e:
+        richieste.inc(rotta="/generate/batch", esito=e.motivo)
+        raise risposta_interrotta(e)
+    except Exception as e:
+        richieste.inc(rotta="/generate/batch", esito="errore")
+        logger.error(f"Errore nella preparazione del batch: {e}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Errore durante l'elaborazione del batch.")
+    finally:
+        annulla(sorveglianza)
+        if not preparato:
+            biglietto.rilascia()
+
+    async def righe():
+        completato = False
+        try:
+            async for risultato in risposte_batch(domande, mediche, documenti):
+                yield json.dumps(risultato, ensure_ascii=False) + "\n"
+            completato = True
+        finally:
+            # Generatore chiuso prima della fine: il client ha chiuso la connessione
+            if not completato:
+                scadenza.annulla("client_disconnesso")
+            biglietto.rilascia()
+
+    # Una riga JSON per domanda, inviata appena la risposta è pronta
+    # A fine risposta il biglietto viene rilasciato anche se il generatore delle righe non è mai partito
+    return StreamingResponse(righe(), media_type="application/x-ndjson", background=BackgroundTask(biglietto.rilascia))
 
 @app.post("/search")
-async def search_only(request: DomandaRequest):
+async def search_only(request: DomandaRequest, http_request: Request):
+    tempi = avvia_tempi_richiesta()
+    _, sorveglianza = avvia_controlli_richiesta(http_request)
     try:
-        domanda_tradotta = await esegui_in_background(traduci_testo, request.domanda, 'it', 'en')
-        documenti, _, _ = await esegui_in_background(cerca_documenti, domanda_tradotta, request.num_results)
-        return {"documenti": documenti}
+        # Le ricerche già eseguite sulla stessa versione del corpus vengono servite dalla cache
+        filtri = request.filtri.come_dict() if request.filtri else None
+        chiave = chiave_ricerca(request.domanda, request.num_results, filtri)
+        versione = leggi_versione()
+        documenti = cache_ricerche.get(chiave, versione) if versione >= 0 else None
+        if documenti is not None:
+            richieste.inc(rotta="/search", esito="cache")
+            risultato = {"documenti": documenti}
+            if request.includi_tempi:
+                risultato["tempi"] = tempi.riepilogo()
+            return risultato
+
+        domanda_tradotta = await attendi_traduzione(avvia_in_background("rete", traduci_testo, request.domanda, 'it', 'en'), request.domanda)
+        documenti, _, aggiornato = await recupera_documenti(domanda_tradotta, request.num_results, arricchimento=request.arricchimento, filtri=filtri)
+        # Se la ricerca ha aggiunto documenti al corpus, il risultato vale per la nuova versione.
+        # I risultati vuoti non vengono memorizzati: possono dipendere da un errore temporaneo di PubMed
+        if aggiornato:
+            versione = leggi_versione()
+        if documenti and versione >= 0:
+            cache_ricerche.put(chiave, versione, documenti)
+        richieste.inc(rotta="/search", esito="ok")
+        risultato = {"documenti": documenti}
+        if request.includi_tempi:
+            risultato["tempi"] = tempi.riepilogo()
+        return risultato
+    except StadioSaturoError as e:
+        richieste.inc(rotta="/search", esito="rifiutata")
+        raise risposta_sovraccarico(e)
+    except RichiestaAnnullataError as e:
+        richieste.inc(rotta="/search", esito=e.motivo)
+        raise risposta_interrotta(e)
     except Exception as e:
+        richieste.inc(rotta="/search", esito="errore")
         logger.error(f"Errore nella ricerca: {e}")
         raise HTTPException(status_code=500, detail="Errore durante la ricerca dei documenti.")
+    finally:
+        annulla(sorveglianza)
 
 @app.get("/")
 async def root():
@@ -475,10 +987,139 @@ async def root():
         "status": "online",
         "endpoints": [
             {"path": "/generate", "method": "POST", "description": "Genera una risposta"},
-            {"path": "/search", "method": "POST", "description": "Cerca documenti"}
+            {"path": "/generate/batch", "method": "POST", "description": "Risposte a più domande, in streaming JSONL"},
+            {"path": "/search", "method": "POST", "description": "Cerca documenti"},
+            {"path": "/filtri", "method": "GET", "description": "Valori disponibili per i filtri sui metadati"},
+            {"path": "/health", "method": "GET", "description": "Stato del processo e dei componenti"},
+            {"path": "/ready", "method": "GET", "description": "Prontezza delle singole rotte (503 in caricamento, 500 se è terminato con errori)"},
+            {"path": "/stadi", "method": "GET", "description": "Statistiche degli executor per stadio"},
+            {"path": "/risorse", "method": "GET", "description": "Ripartizione dei core tra i componenti"},
+            {"path": "/metrics", "method": "GET", "description": "Metriche in formato Prometheus"},
+            {"path": "/admin/modelli", "method": "GET", "description": "Modelli configurati per rotta"},
+            {"path": "/admin/modelli/{rotta}", "method": "POST", "description": "Sostituisce a caldo il modello di una rotta"},
+            {"path": "/admin/profilo", "method": "POST", "description": "Profila le prossime richieste"},
+            {"path": "/admin/profili", "method": "GET", "description": "Profili salvati e richieste più lente"}
         ]
     }
 
+# Componenti caricati in background all'avvio e componenti richiesti da ogni rotta
+registra_componente("classificatore", get_esempi_embeddings)
+registra_componente("embedder_retriever", get_model)
+def prepara_indice():
+    # Un nodo nuovo parte dallo snapshot PROVA_SNAPSHOT_AVVIO, se indicato, invece che da un corpus vuoto
+    ripristina_all_avvio()
+    return ensure_faiss_index()
+
+registra_componente("indice_faiss", prepara_indice)
+registra_componente("reasoner", initialize_model)
+registra_componente("mistral", initialize_mistral)
+
+COMPONENTI_ROTTE = {
+    "/generate/batch": ["classificatore", "embedder_retriever", "indice_faiss", "reasoner"],
+    "/search": ["embedder_retriever", "indice_faiss"],
+    "/generate": ["classificatore", "embedder_retriever", "indice_faiss", "reasoner"],
+}
+# Componenti facoltativi: la rotta è pronta anche senza, ma senza Mistral falliscono le sole risposte
+# non mediche (che lo caricano alla prima domanda, come prima del warm-up)
+COMPONENTI_FACOLTATIVI = {
+    "/generate/batch": ["mistral"],
+    "/generate": ["mistral"],
+}
+
+@app.on_event("startup")
+async def startup():
+    # I thread di torch e FAISS vanno fissati prima di caricare i modelli
+    applica_thread_librerie()
+    # Il caricamento avviene in thread separati: la porta è in ascolto da subito
+    avvia_warmup()
+
+@app.get("/health")
+async def health():
+    return {"status": "online", "componenti": stato_componenti()}
+
+@app.get("/ready")
+async def ready():
+    rotte = {rotta: componenti_pronti(nomi) for rotta, nomi in COMPONENTI_ROTTE.items()}
+    pronto = all(rotte.values())
+    # Un componente in errore non si riprende da solo: a caricamento finito non si risponde più 503,
+    # così il client smette di attendere e mostra l'errore (le rotte pronte restano utilizzabili).
+    # "errore" comprende anche i componenti facoltativi, che non rendono la rotta non pronta
+    errore = componenti_in_errore()
+    if pronto:
+        status_code = 200
+    elif errore and caricamento_terminato():
+        status_code = 500
+    else:
+        status_code = 503
+    return JSONResponse(
+        status_code=status_code,
+        content={"pronto": pronto, "rotte": rotte, "facoltativi": COMPONENTI_FACOLTATIVI, "errore": errore,
+                 "componenti": stato_componenti()},
+    )
+
+@app.get("/admin/modelli")
+async def modelli():
+    return registro.descrizione()
+
+@app.post("/admin/modelli/{rotta}")
+async def sostituisci_modello(rotta: str, config: dict):
+    """
+    Sostituisce a caldo il modello di una rotta ('medica' o 'generale'), ad esempio
+    {"backend": "llama_cpp", "modello": "...gguf", "n_threads": 4, "n_ctx": 4096, "n_batch": 256}.
+    """
+    if rotta not in registro.descrizione():
+        raise HTTPException(status_code=404, detail=f"Rotta sconosciuta: {rotta}")
+    try:
+        # La rotta medica carica il modello nel processo worker, qui basta verificarne il file
+        backend = await esegui_in_background("amministrazione", registro.sostituisci, rotta, config, rotta != "medica")
+        return backend.descrizione()
+    except (FileNotFoundError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/admin/profilo")
+async def profila_prossime(request: ProfiloRequest):
+    """Attiva la profilazione dettagliata per le prossime richieste a /generate e /search di questo worker."""
+    if request.modalita not in MODALITA:
+        raise HTTPException(status_code=400, detail=f"Modalità sconosciuta: {request.modalita}")
+    return arma(request.richieste, request.modalita)
+
+@app.get("/admin/profili")
+async def profili():
+    su_richiesta = sorted(f for f in os.listdir(CARTELLA_PROFILI) if f.endswith((".folded", ".prof"))) if os.path.isdir(CARTELLA_PROFILI) else []
+    return {"su_richiesta": su_richiesta, "lenti": profili_lenti.elenco()}
+
+@app.get("/admin/profili/{nome}")
+async def scarica_profilo(nome: str):
+    for cartella in (CARTELLA_PROFILI, profili_lenti.cartella):
+        percorso = os.path.join(cartella, os.path.basename(nome))
+        if os.path.isfile(percorso):
+            return FileResponse(percorso, filename=os.path.basename(nome))
+    raise HTTPException(status_code=404, detail=f"Profilo non trovato: {nome}")
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(esporta_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stadi")
+async def stadi():
+    return {**statistiche_stadi(), "cache_ricerche": cache_ricerche.statistiche(), "ammissione": ammissione.statistiche(),
+            "arricchimento": coda_arricchimento.statistiche()}
+
+@app.get("/filtri")
+async def filtri_disponibili():
+    # Valori dei metadati presenti nel corpus, con il numero di documenti per valore
+    return await esegui_in_background("indice", lambda: indice_metadati().valori())
+
+@app.get("/risorse")
+async def risorse():
+    return carica_risorse()
+
+@app.on_event("shutdown")
+async def shutdown():
+    chiudi_stadi()
+
 if __name__ == "__main__":
     logger.info("Avvio del server FastAPI...")
-    uvicorn.run("server:app", host="127.0.0.1", port=5000)
\ No newline at end of file
+    # Con PROVA_WORKERS > 1 ogni worker è un processo separato con i propri modelli:
+    # indice e sessioni restano coerenti tramite stato_condiviso
+    uvicorn.run("server:app", host="127.0.0.1", port=5000, workers=NUM_WORKERS)
\ No newline at end of file
@@ -0,0 +1,288 @@
+#snapshot.py
+# Snapshot del corpus di retrieval in un unico file (tar non compresso) con:
+#   - manifest.json: versione del formato, modello di embedding, dimensione, conteggi e checksum SHA-256
+#   - vettori.npy: gli embedding float32, nell'ordine della mappatura degli ID
+#   - documents.json e document_ids.json
+# Il ripristino non ricalcola gli embedding: i vettori vengono letti tramite memory-map direttamente
+# dal file dello snapshot e scritti nell'indice della modalità configurata (PROVA_VETTORI).
+#
+# Uso:
+#   python snapshot.py esporta [percorso]          (predefinito: snapshot/corpus-v<versione>-<data>.tar)
+#   python snapshot.py importa percorso [--senza-backup] [--non-verificare]
+#   python snapshot.py verifica percorso
+#   python snapshot.py elenca
+# All'avvio del server, PROVA_SNAPSHOT_AVVIO=percorso ripristina lo snapshot se il corpus locale non esiste.
+import io
+import os
+import sys
+import json
+import time
+import tarfile
+import hashlib
+import logging
+import argparse
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMATO = 1
+CARTELLA_SNAPSHOT = os.environ.get("PROVA_CARTELLA_SNAPSHOT", "snapshot")
+SNAPSHOT_AVVIO = os.environ.get("PROVA_SNAPSHOT_AVVIO", "")
+FILE_MANIFEST = "manifest.json"
+FILE_VETTORI = "vettori.npy"
+BYTE_PER_BLOCCO = 1 << 20
+
+
+class SnapshotNonValidoError(Exception):
+    """Snapshot corrotto, di un formato sconosciuto o incompatibile con il modello di embedding in uso."""
+
+
+def _sha256(f):
+    h = hashlib.sha256()
+    for blocco in iter(lambda: f.read(BYTE_PER_BLOCCO), b""):
+        h.update(blocco)
+    return h.hexdigest()
+
+
+def _aggiungi(tar, nome, percorso=None, dati=None):
+    info = tarfile.TarInfo(nome)
+    info.mtime = int(time.time())
+    if dati is not None:
+        info.size = len(dati)
+        tar.addfile(info, io.BytesIO(dati))
+    else:
+        info.size = os.path.getsize(percorso)
+        with open(percorso, 'rb') as f:
+            tar.addfile(info, f)
+
+
+def percorso_predefinito(versione, suffisso=""):
+    return os.path.join(CARTELLA_SNAPSHOT, f"corpus-v{versione}-{time.strftime('%Y%m%d-%H%M%S')}{suffisso}.tar")
+
+
+def esporta(percorso=None, suffisso=""):
+    """
+    Scrive lo snapshot del corpus corrente, letto sotto il blocco del corpus così che
+    vettori, documenti e mappatura degli ID siano coerenti tra loro.
+
+    Returns:
+        tuple: Il percorso dello snapshot e il suo manifest.
+    """
+    import retriever
+    import stato_condiviso
+    from embedding_onnx import BACKEND_EMBEDDING
+
+    with tempfile.TemporaryDirectory() as cartella:
+        file = {
+            FILE_VETTORI: os.path.join(cartella, FILE_VETTORI),
+            retriever.DOCS_FILE: os.path.join(cartella, retriever.DOCS_FILE),
+            retriever.ID_MAP_FILE: os.path.join(cartella, retriever.ID_MAP_FILE),
+        }
+        with stato_condiviso.blocco_corpus():
+            index = retriever.ensure_faiss_index()
+            vettori = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+            documenti = retriever.load_json(retriever.DOCS_FILE, [])
+            id_mapping = retriever.load_json(retriever.ID_MAP_FILE, [])
+            if len(id_mapping) != len(vettori):
+                raise SnapshotNonValidoError(f"Corpus non allineato: {len(vettori)} vettori e {len(id_mapping)} ID")
+            versione = stato_condiviso.leggi_versione()
+            np.save(file[FILE_VETTORI], np.ascontiguousarray(vettori, dtype=np.float32))
+            retriever.save_json(documenti, file[retriever.DOCS_FILE])
+            retriever.save_json(id_mapping, file[retriever.ID_MAP_FILE])
+
+        # Lo snapshot viene scritto dalle copie temporanee, senza tenere il blocco del corpus
+        manifest = {
+            "formato": FORMATO,
+            "creato": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "versione_corpus": versione,
+            "modello_embedding": retriever.MODEL_NAME,
+            "backend_embedding": BACKEND_EMBEDDING,
+            "dimensione": int(vettori.shape[1]),
+            "vettori": int(vettori.shape[0]),
+            "documenti": len(documenti),
+            "file": {},
+        }
+        for nome, origine in file.items():
+            with open(origine, 'rb') as f:
+                manifest["file"][nome] = {"sha256": _sha256(f), "byte": os.path.getsize(origine)}
+
+        percorso = percorso or percorso_predefinito(versione, suffisso)
+        os.makedirs(os.path.dirname(os.path.abspath(percorso)), exist_ok=True)
+        temporaneo = percorso + ".tmp"
+        # Il manifest è il primo elemento, così leggerlo non richiede di scorrere tutto il file
+        with tarfile.open(temporaneo, 'w') as tar:
+            _aggiungi(tar, FILE_MANIFEST, dati=json.dumps(manifest, indent=2).encode('utf-8'))
+            for nome, origine in file.items():
+                _aggiungi(tar, nome, origine)
+        os.replace(temporaneo, percorso)
+
+    logger.info(f"Snapshot scritto in {percorso}: {manifest['vettori']} vettori, {manifest['documenti']} documenti")
+    return percorso, manifest
+
+
+def leggi_manifest(percorso):
+    try:
+        with tarfile.open(percorso, 'r:') as tar:
+            manifest = json.load(tar.extractfile(FILE_MANIFEST))
+    except (tarfile.TarError, KeyError, ValueError) as e:
+        raise SnapshotNonValidoError(f"{percorso}: manifest illeggibile ({e})")
+    if manifest.get("formato") != FORMATO:
+        raise SnapshotNonValidoError(f"{percorso}: formato {manifest.get('formato')} non supportato (atteso {FORMATO})")
+    return manifest
+
+
+def verifica(percorso):
+    """Controlla formato e checksum di tutti i file dello snapshot. Restituisce il manifest."""
+    manifest = leggi_manifest(percorso)
+    with tarfile.open(percorso, 'r:') as tar:
+        for nome, atteso in manifest["file"].items():
+            try:
+                contenuto = tar.extractfile(nome)
+            except KeyError:
+                raise SnapshotNonValidoError(f"{percorso}: manca {nome}")
+            if _sha256(contenuto) != atteso["sha256"]:
+                raise SnapshotNonValidoError(f"{percorso}: checksum errato per {nome}")
+    return manifest
+
+
+def mappa_vettori(percorso):
+    """
+    Vettori dello snapshot come np.memmap in sola lettura sul file tar stesso: il tar non è compresso,
+    quindi vettori.npy è una sequenza contigua di byte a partire da offset_data.
+    """
+    with tarfile.open(percorso, 'r:') as tar:
+        info = tar.getmember(FILE_VETTORI)
+    with open(percorso, 'rb') as f:
+        f.seek(info.offset_data)
+        versione = np.lib.format.read_magic(f)
+        leggi_header = np.lib.format.read_array_header_1_0 if versione == (1, 0) else np.lib.format.read_array_header_2_0
+        forma, fortran, dtype = leggi_header(f)
+        inizio = f.tell()
+    if fortran:
+        raise SnapshotNonValidoError(f"{percorso}: vettori in ordine Fortran non supportati")
+    if forma[0] == 0:
+        return np.zeros(forma, dtype=dtype)
+    return np.memmap(percorso, dtype=dtype, mode='r', offset=inizio, shape=forma)
+
+
+def _controlla_compatibilita(manifest):
+    import retriever
+    from embedding_onnx import BACKEND_EMBEDDING
+
+    if manifest["modello_embedding"] != retriever.MODEL_NAME:
+        raise SnapshotNonValidoError(
+            f"Snapshot calcolato con {manifest['modello_embedding']}, il server usa {retriever.MODEL_NAME}")
+    if manifest.get("backend_embedding") != BACKEND_EMBEDDING:
+        logger.warning(f"Snapshot calcolato con il backend {manifest.get('backend_embedding')}, "
+                       f"il server usa {BACKEND_EMBEDDING}: vettori equivalenti a meno di piccole differenze numeriche")
+
+
+def _scrivi_atomico(tar, nome, destinazione):
+    temporaneo = destinazione + ".tmp"
+    with tar.extractfile(nome) as origine, open(temporaneo, 'wb') as f:
+        for blocco in iter(lambda: origine.read(BYTE_PER_BLOCCO), b""):
+            f.write(blocco)
+    os.replace(temporaneo, destinazione)
+
+
+def importa(percorso, backup=True, verifica_checksum=True):
+    """
+    Sostituisce il corpus corrente con quello dello snapshot, senza ricalcolare gli embedding.
+    Con backup=True il corpus corrente viene prima salvato come snapshot, per poter tornare indietro.
+
+    Returns:
+        dict: Il manifest dello snapshot ripristinato, con il percorso dell'eventuale backup.
+    """
+    import retriever
+    import vector_store
+    import stato_condiviso
+
+    manifest = verifica(percorso) if verifica_checksum else leggi_manifest(percorso)
+    _controlla_compatibilita(manifest)
+    vettori = mappa_vettori(percorso)
+    if vettori.shape != (manifest["vettori"], manifest["dimensione"]):
+        raise SnapshotNonValidoError(f"{percorso}: vettori di forma {vettori.shape}, attesi {manifest['vettori']}")
+
+    inizio = time.perf_counter()
+    with stato_condiviso.blocco_corpus():
+        copia = None
+        if backup and vector_store.esiste_indice(retriever.FAISS_INDEX_FILE):
+            copia, _ = esporta(suffisso="-backup")
+        with tarfile.open(percorso, 'r:') as tar:
+            _scrivi_atomico(tar, retriever.DOCS_FILE, retriever.DOCS_FILE)
+            _scrivi_atomico(tar, retriever.ID_MAP_FILE, retriever.ID_MAP_FILE)
+        vector_store.elimina_indice(retriever.FAISS_INDEX_FILE)
+        vector_store.crea_indice(vettori, retriever.FAISS_INDEX_FILE, d=manifest["dimensione"])
+        stato_condiviso.incrementa_versione()
+
+    logger.info(f"Snapshot {percorso} ripristinato in {time.perf_counter() - inizio:.2f}s: "
+                f"{manifest['vettori']} vettori, {manifest['documenti']} documenti")
+    return {**manifest, "backup": copia}
+
+
+def ripristina_all_avvio(percorso=SNAPSHOT_AVVIO):
+    """
+    Ripristina lo snapshot indicato da PROVA_SNAPSHOT_AVVIO se il corpus locale non esiste ancora
+    (nuovo nodo). Con più worker lo fa solo il primo: gli altri trovano il corpus già presente.
+    """
+    import retriever
+    import vector_store
+    import stato_condiviso
+
+    if not percorso:
+        return None
+    with stato_condiviso.blocco_corpus():
+        if vector_store.esiste_indice(retriever.FAISS_INDEX_FILE) or os.path.exists(retriever.DOCS_FILE):
+            logger.info(f"Corpus locale già presente: snapshot {percorso} non ripristinato")
+            return None
+        return importa(percorso, backup=False)
+
+
+def elenca(cartella=CARTELLA_SNAPSHOT):
+    """Snapshot presenti nella cartella, dal più recente, con i dati principali del manifest."""
+    if not os.path.isdir(cartella):
+        return []
+    elenco = []
+    for nome in sorted(os.listdir(cartella), reverse=True):
+        if not nome.endswith(".tar"):
+            continue
+        try:
+            manifest = leggi_manifest(os.path.join(cartella, nome))
+        except SnapshotNonValidoError as e:
+            elenco.append({"file": nome, "errore": str(e)})
+            continue
+        elenco.append({"file": nome, **{chiave: manifest[chiave] for chiave in
+                                        ("creato", "versione_corpus", "modello_embedding", "vettori", "documenti")}})
+    return elenco
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Snapshot, esportazione e ripristino del corpus")
+    parser.add_argument("comando", choices=["esporta", "importa", "verifica", "elenca"])
+    parser.add_argument("percorso", nargs="?")
+    parser.add_argument("--senza-backup", action="store_true", help="Non salvare il corpus corrente prima di importare")
+    parser.add_argument("--non-verificare", action="store_true", help="Salta il controllo dei checksum")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        if args.comando == "esporta":
+            percorso, manifest = esporta(args.percorso)
+            risultato = {**manifest, "percorso": percorso}
+        elif args.comando == "elenca":
+            risultato = elenca()
+        elif not args.percorso:
+            sys.exit(f"Il comando {args.comando} richiede il percorso dello snapshot")
+        elif args.comando == "verifica":
+            risultato = verifica(args.percorso)
+        else:
+            risultato = importa(args.percorso, backup=not args.senza_backup, verifica_checksum=not args.non_verificare)
+    except SnapshotNonValidoError as e:
+        sys.exit(str(e))
+    print(json.dumps(risultato, indent=2))
+
+
+if __name__ == "__main__":
+    main()
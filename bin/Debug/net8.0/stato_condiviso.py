@@ -0,0 +1,212 @@
+#stato_condiviso.py
+# Stato condiviso tra più processi worker del server:
+#   - blocco su file per serializzare le scritture del corpus (indice, documenti, mappatura ID)
+#   - contatore di versione del corpus, che i processi lettori controllano per ricaricare l'indice
+#   - archivio delle sessioni di conversazione (in memoria oppure SQLite condiviso)
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+FILE_BLOCCO = "corpus.lock"
+FILE_VERSIONE = "corpus.versione"
+FILE_SESSIONI = "sessioni.db"
+
+# Numero di processi worker di uvicorn; con più di un worker le sessioni devono essere condivise
+NUM_WORKERS = int(os.environ.get("PROVA_WORKERS", "1"))
+TIPO_SESSIONI = os.environ.get("PROVA_SESSIONI", "sqlite" if NUM_WORKERS > 1 else "memoria")
+
+if os.name == "nt":
+    import msvcrt
+
+    def _blocca(f):
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                time.sleep(0.01)
+
+    def _sblocca(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _blocca(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _sblocca(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class BloccoFile:
+    """
+    Blocco esclusivo tra processi (e tra thread dello stesso processo) basato su un file.
+    È rientrante per il thread che lo detiene, così funzioni che lo usano possono chiamarsi a vicenda.
+    """
+
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self._lock = threading.RLock()
+        self._profondita = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._profondita == 0:
+            try:
+                self._file = open(self.percorso, "a+b")
+                _blocca(self._file)
+            except Exception:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                raise
+        self._profondita += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._profondita -= 1
+        if self._profondita == 0:
+            try:
+                _sblocca(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self._lock.release()
+        return False
+
+
+_blocco_corpus = None
+_blocco_corpus_lock = threading.Lock()
+
+
+def blocco_corpus():
+    """Blocco che protegge le scritture dei file del corpus nella cartella corrente."""
+    global _blocco_corpus
+    percorso = os.path.abspath(FILE_BLOCCO)
+    with _blocco_corpus_lock:
+        if _blocco_corpus is None or _blocco_corpus.percorso != percorso:
+            _blocco_corpus = BloccoFile(percorso)
+        return _blocco_corpus
+
+
+def leggi_versione():
+    """Versione corrente del corpus (0 se mai scritto, -1 se il file è in fase di scrittura)."""
+    try:
+        with open(FILE_VERSIONE, "r", encoding="utf-8") as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError):
+        return -1
+
+
+def incrementa_versione():
+    """Incrementa la versione del corpus. Va chiamata tenendo il blocco del corpus."""
+    versione = max(leggi_versione(), 0) + 1
+    with open(FILE_VERSIONE, "w", encoding="utf-8") as f:
+        f.write(str(versione))
+    return versione
+
+
+class SessioniMemoria:
+    """Storia delle conversazioni nella memoria del processo (un solo worker)."""
+
+    def __init__(self):
+        self._dati = {}
+        self._riassunti = {}
+        self._lock = threading.Lock()
+
+    def storia(self, user_id):
+        with self._lock:
+            return list(self._dati.get(user_id, []))
+
+    def aggiungi(self, user_id, domanda, risposta, domanda_tradotta=None):
+        with self._lock:
+            self._dati.setdefault(user_id, []).append(
+                {"domanda": domanda, "risposta": risposta, "domanda_tradotta": domanda_tradotta})
+
+    def riassunto(self, user_id):
+        """Riassunto della conversazione salvato da memoria_conversazione, o None."""
+        with self._lock:
+            return self._riassunti.get(user_id)
+
+    def salva_riassunto(self, user_id, riassunto):
+        with self._lock:
+            self._riassunti[user_id] = riassunto
+
+
+class SessioniSqlite:
+    """Storia delle conversazioni in un database SQLite condiviso da tutti i worker."""
+
+    def __init__(self, percorso=FILE_SESSIONI):
+        self.percorso = percorso
+        with self._connessione() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS turni ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, "
+                "domanda TEXT NOT NULL, risposta TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS turni_utente ON turni (user_id, id)")
+            # Database creati prima della traduzione salvata nei turni
+            if "domanda_tradotta" not in {colonna[1] for colonna in conn.execute("PRAGMA table_info(turni)")}:
+                try:
+                    conn.execute("ALTER TABLE turni ADD COLUMN domanda_tradotta TEXT")
+                except sqlite3.OperationalError:
+                    pass  # aggiunta nel frattempo da un altro worker
+            conn.execute("CREATE TABLE IF NOT EXISTS riassunti (user_id TEXT PRIMARY KEY, dati TEXT NOT NULL)")
+
+    @contextmanager
+    def _connessione(self):
+        # Una connessione per operazione: sicura tra thread, SQLite gestisce la concorrenza tra processi
+        conn = sqlite3.connect(self.percorso, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def storia(self, user_id):
+        with self._connessione() as conn:
+            righe = conn.execute(
+                "SELECT domanda, risposta, domanda_tradotta FROM turni WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+        return [{"domanda": domanda, "risposta": risposta, "domanda_tradotta": tradotta} for domanda, risposta, tradotta in righe]
+
+    def aggiungi(self, user_id, domanda, risposta, domanda_tradotta=None):
+        with self._connessione() as conn:
+            conn.execute("INSERT INTO turni (user_id, domanda, risposta, domanda_tradotta) VALUES (?, ?, ?, ?)",
+                         (user_id, domanda, risposta, domanda_tradotta))
+
+    def riassunto(self, user_id):
+        """Riassunto della conversazione salvato da memoria_conversazione, o None."""
+        with self._connessione() as conn:
+            riga = conn.execute("SELECT dati FROM riassunti WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(riga[0]) if riga else None
+
+    def salva_riassunto(self, user_id, riassunto):
+        with self._connessione() as conn:
+            conn.execute("INSERT OR REPLACE INTO riassunti (user_id, dati) VALUES (?, ?)",
+                         (user_id, json.dumps(riassunto, ensure_ascii=False)))
+
+
+def crea_archivio_sessioni(tipo=TIPO_SESSIONI):
+    """Crea l'archivio delle sessioni indicato da PROVA_SESSIONI ("memoria" o "sqlite")."""
+    if tipo == "sqlite":
+        logger.info(f"Sessioni condivise su SQLite ({FILE_SESSIONI})")
+        return SessioniSqlite()
+    if tipo != "memoria":
+        raise ValueError(f"Archivio sessioni sconosciuto: {tipo}")
+    if NUM_WORKERS > 1:
+        logger.warning("Sessioni in memoria con più worker: ogni processo vedrà una storia diversa")
+    return SessioniMemoria()
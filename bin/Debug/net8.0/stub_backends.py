@@ -0,0 +1,102 @@
+#stub_backends.py
+# Backend finti e deterministici per eseguire benchmark e test di carico senza rete né modelli LLM.
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def carica_fixture(nome, binario=False):
+    """Legge un file dalla cartella fixtures."""
+    with open(os.path.join(FIXTURES_DIR, nome), "rb" if binario else "r", **({} if binario else {"encoding": "utf-8"})) as f:
+        return f.read()
+
+
+def carica_domande():
+    """Coppie di domande italiano/inglese usate dai benchmark."""
+    return json.loads(carica_fixture("domande_benchmark.json"))
+
+
+class RispostaFinta:
+    """Risposta HTTP minima compatibile con l'uso che pubmed.py fa di requests."""
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f"HTTP {self.status_code}")
+
+
+class PubMedRegistrato:
+    """
+    Sostituto di requests.get che rigioca le risposte esearch/efetch salvate in fixtures.
+    Il ritardo simula la latenza di rete in modo deterministico.
+    """
+
+    def __init__(self, ritardo=0.0):
+        self.ritardo = ritardo
+        self.esearch = carica_fixture("pubmed_esearch.xml", binario=True)
+        self.efetch = carica_fixture("pubmed_efetch.xml", binario=True)
+        self.chiamate = 0
+
+    def __call__(self, url, params=None, timeout=None, **kwargs):
+        self.chiamate += 1
+        if self.ritardo:
+            time.sleep(self.ritardo)
+        if "esearch" in url:
+            return RispostaFinta(self.esearch)
+        if "efetch" in url:
+            return RispostaFinta(self.efetch)
+        return RispostaFinta(b"", status_code=404)
+
+
+class TraduttoreFinto:
+    """Traduttore deterministico: usa le coppie note delle fixtures, altrimenti restituisce il testo."""
+
+    def __init__(self, ritardo=0.05):
+        self.ritardo = ritardo
+        self.traduzioni = {}
+        for coppia in carica_domande():
+            self.traduzioni[coppia["it"]] = coppia["en"]
+
+    def traduci(self, text, src='auto', target='en'):
+        if self.ritardo:
+            time.sleep(self.ritardo)
+        if target == 'en':
+            return self.traduzioni.get(text.strip(), text)
+        return text
+
+
+def installa_stub(server, ritardo_rete=0.05, llm_prefill=0.2, llm_token_al_secondo=20.0):
+    """
+    Sostituisce nel modulo server (e nei moduli che usa) traduttore e PubMed con i backend finti
+    e assegna a entrambe le rotte il backend di generazione stub. Gli embedding e FAISS restano reali.
+    """
+    import types
+    import requests
+    import pubmed
+    from backends import registro
+    from metrics import cronometrato
+
+    traduttore = TraduttoreFinto(ritardo=ritardo_rete)
+
+    # Solo pubmed.py vede il requests finto: il client del test di carico resta reale
+    pubmed.requests = types.SimpleNamespace(
+        get=PubMedRegistrato(ritardo=ritardo_rete),
+        RequestException=requests.RequestException,
+    )
+    server.traduci_testo = cronometrato("traduzione")(traduttore.traduci)
+    server.traduci_batch = cronometrato("traduzione_batch")(
+        lambda testi, src='auto', target='en': [traduttore.traduci(testo, src, target) for testo in testi])
+    server.correggi_risposta_italiana = lambda testo: testo
+    # Entrambe le rotte usano il backend stub del registro dei modelli
+    for rotta in ("medica", "generale"):
+        registro.sostituisci(rotta, {"backend": "stub", "prefill": llm_prefill, "token_al_secondo": llm_token_al_secondo})
+    logger.info("Backend finti installati: traduttore, PubMed registrato, backend stub")
@@ -0,0 +1,40 @@
+#test_cache_ricerche.py
+# Test di cache_ricerche.py: gli elementi scadono quando cambia la versione del corpus.
+#   python -m pytest -q test_cache_ricerche.py
+from cache_ricerche import CacheVersionata, chiave_ricerca
+from metrics import cache
+
+
+def test_elemento_valido_per_la_stessa_versione():
+    memoria = CacheVersionata("test-hit")
+    memoria.put("chiave", 3, ["risultato"])
+    assert memoria.get("chiave", 3) == ["risultato"]
+    assert cache.valore(cache="test-hit", esito="hit") == 1
+
+
+def test_elemento_scaduto_dopo_un_cambio_di_versione():
+    memoria = CacheVersionata("test-scaduta")
+    memoria.put("chiave", 3, ["risultato"])
+
+    assert memoria.get("chiave", 4) is None
+    assert cache.valore(cache="test-scaduta", esito="scaduta") == 1
+    # L'elemento scaduto viene rimosso: anche la versione vecchia ora è un miss
+    assert memoria.statistiche()["elementi"] == 0
+    assert memoria.get("chiave", 3) is None
+    assert cache.valore(cache="test-scaduta", esito="miss") == 1
+
+
+def test_capacita_scarta_l_elemento_meno_recente():
+    memoria = CacheVersionata("test-lru", capacita=2)
+    memoria.put("a", 1, "A")
+    memoria.put("b", 1, "B")
+    memoria.get("a", 1)
+    memoria.put("c", 1, "C")
+    assert memoria.get("b", 1) is None
+    assert memoria.get("a", 1) == "A"
+    assert memoria.get("c", 1) == "C"
+
+
+def test_chiave_ricerca_normalizza_la_domanda():
+    assert chiave_ricerca("  Metformin   dose? ", 5) == chiave_ricerca("metformin dose", 5)
+    assert chiave_ricerca("metformin dose", 5, {"anno": 2020}) != chiave_ricerca("metformin dose", 5)
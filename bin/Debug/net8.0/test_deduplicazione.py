@@ -0,0 +1,116 @@
+#test_deduplicazione.py
+# Test di deduplicazione.py: bande del SimHash, motivi di scarto di filtra_duplicati e trova_duplicati.
+#   python -m pytest -q test_deduplicazione.py
+import random
+import numpy as np
+
+from deduplicazione import (BIT_SIMHASH, IndiceSimHash, SOGLIA_HAMMING, distanza_hamming,
+                            filtra_duplicati, firma_documento, simhash, trova_duplicati)
+
+ABSTRACT = ("Metformin remains the first line therapy for type 2 diabetes in adults, "
+            "with a favourable safety profile and a low risk of hypoglycaemia.")
+ALTRO_ABSTRACT = ("Beta blockers reduce mortality after myocardial infarction "
+                  "and are recommended in patients with reduced ejection fraction.")
+
+
+class IndiceFinto:
+    """Indice esatto sui vettori del corpus, con la stessa interfaccia di FAISS (distanze L2 al quadrato)."""
+
+    def __init__(self, vettori):
+        self.vettori = np.asarray(vettori, dtype=np.float32)
+        self.ntotal = len(self.vettori)
+
+    def search(self, query, k):
+        distanze = ((query[:, None, :] - self.vettori[None, :, :]) ** 2).sum(axis=2)
+        righe = np.argsort(distanze, axis=1)[:, :k]
+        return np.take_along_axis(distanze, righe, axis=1), righe
+
+
+def _cambia_bit(firma, bit):
+    for b in bit:
+        firma ^= 1 << b
+    return firma
+
+
+def test_bande_trovano_le_firme_entro_la_soglia():
+    generatore = random.Random(0)
+    for _ in range(200):
+        firma = generatore.getrandbits(BIT_SIMHASH)
+        indice = IndiceSimHash()
+        indice.aggiungi(firma, "doc")
+        vicina = _cambia_bit(firma, generatore.sample(range(BIT_SIMHASH), SOGLIA_HAMMING))
+        assert distanza_hamming(firma, vicina) == SOGLIA_HAMMING
+        assert indice.cerca(vicina) == "doc"
+
+
+def test_bande_ignorano_le_firme_oltre_la_soglia():
+    firma = random.Random(1).getrandbits(BIT_SIMHASH)
+    indice = IndiceSimHash()
+    indice.aggiungi(firma, "doc")
+    # Bit tutti nella prima banda: le altre tre coincidono, ma la distanza supera la soglia
+    lontana = _cambia_bit(firma, range(SOGLIA_HAMMING + 1))
+    assert indice.cerca(lontana) is None
+
+
+def test_simhash_ignora_maiuscole_e_punteggiatura():
+    assert simhash(ABSTRACT) == simhash(ABSTRACT.upper().replace(",", ";"))
+    assert distanza_hamming(simhash(ABSTRACT), simhash(ALTRO_ABSTRACT)) > SOGLIA_HAMMING
+
+
+def test_firma_documento_salvata_nel_documento():
+    doc = {"id": "a", "text": ABSTRACT}
+    firma = firma_documento(doc)
+    assert doc["simhash"] == format(firma, "016x")
+    assert firma_documento(doc) == firma
+
+
+def test_filtra_duplicati_motivi():
+    esistenti = [{"id": "esistente", "text": ABSTRACT}]
+    candidati = [
+        {"id": "", "text": "testo senza id"},
+        {"id": "senza-testo", "text": "  "},
+        {"id": "esistente", "text": "testo nuovo con un id già presente"},
+        {"id": "copia", "text": ABSTRACT.upper()},
+        {"id": "riformulato", "text": "the same content in other words"},
+        {"id": "nuovo", "text": ALTRO_ABSTRACT},
+    ]
+    embeddings = np.eye(len(candidati), 8, dtype=np.float32)
+    embeddings[4] = [1, 0, 0, 0, 0, 0, 0, 0.01]
+    index = IndiceFinto([[1, 0, 0, 0, 0, 0, 0, 0]])
+
+    accettati, scartati = filtra_duplicati(candidati, embeddings, esistenti, index)
+
+    assert accettati == [5]
+    assert scartati == {0: "vuoto", 1: "vuoto", 2: "id", 3: "simhash", 4: "embedding"}
+
+
+def test_filtra_duplicati_nello_stesso_batch():
+    candidati = [
+        {"id": "a", "text": ABSTRACT},
+        {"id": "a", "text": ALTRO_ABSTRACT},
+        {"id": "b", "text": ABSTRACT + "."},
+        {"id": "c", "text": ALTRO_ABSTRACT},
+        {"id": "d", "text": "a paraphrase of the previous abstract"},
+    ]
+    embeddings = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1], [0, 1, 0], [0.01, 1, 0]], dtype=np.float32)
+
+    accettati, scartati = filtra_duplicati(candidati, embeddings, [], None)
+
+    assert accettati == [0, 3]
+    assert scartati == {1: "id", 2: "simhash", 4: "embedding"}
+
+
+def test_trova_duplicati_mantiene_la_prima_occorrenza():
+    documenti = [
+        {"id": "a", "text": ABSTRACT},
+        {"id": "b", "text": ALTRO_ABSTRACT},
+        {"id": "c", "text": ABSTRACT.lower()},
+        {"id": "b", "text": "stesso id di un documento precedente"},
+        {"id": "d", "text": "a paraphrase of the second abstract"},
+        {"id": "e", "text": "an unrelated document"},
+    ]
+    embeddings = np.eye(len(documenti), dtype=np.float32)
+    embeddings[4] = embeddings[1]
+
+    # Blocchi piccoli: i duplicati si trovano anche tra blocchi diversi
+    assert trova_duplicati(documenti, embeddings, righe_per_blocco=2) == [None, None, 0, 1, 1, None]
@@ -0,0 +1,59 @@
+#test_memoria_conversazione.py
+# Test di memoria_conversazione.py: il contesto per il prompt resta entro TOKEN_MASSIMI.
+#   python -m pytest -q test_memoria_conversazione.py
+import pytest
+
+from memoria_conversazione import TOKEN_MASSIMI, MemoriaConversazione, stima_token
+from stato_condiviso import SessioniMemoria
+
+RISPOSTA_LUNGA = " ".join(["The recommended dose depends on renal function and body weight."] * 40)
+
+
+def _conversazione(turni, risposta=RISPOSTA_LUNGA):
+    archivio = SessioniMemoria()
+    for i in range(turni):
+        archivio.aggiungi("utente", f"Question number {i} about metformin and its side effects?", risposta)
+    return archivio
+
+
+@pytest.mark.parametrize("turni", [1, 2, 5, 30])
+def test_contesto_entro_token_massimi_dopo_aggiorna(turni):
+    archivio = _conversazione(turni)
+    memoria = MemoriaConversazione(archivio)
+    memoria.aggiorna("utente")
+
+    contesto = memoria.contesto("utente", archivio.storia("utente"))
+
+    assert 0 < stima_token(contesto) <= TOKEN_MASSIMI
+    assert f"Question number {turni - 1} " in contesto
+
+
+def test_aggiorna_tiene_le_righe_piu_recenti():
+    archivio = _conversazione(30)
+    memoria = MemoriaConversazione(archivio)
+
+    riassunto = memoria.aggiorna("utente")
+
+    assert riassunto["turni"] == 30
+    assert riassunto["righe"][-1][0] == 29
+    assert sum(stima_token(riga) + 1 for _, riga in riassunto["righe"]) <= TOKEN_MASSIMI
+    assert archivio.riassunto("utente") == riassunto
+
+
+def test_contesto_entro_il_limite_con_turni_non_ancora_riassunti():
+    archivio = _conversazione(10)
+    memoria = MemoriaConversazione(archivio, token_massimi=120, token_ultimo_turno=60)
+    memoria.aggiorna("utente")
+    # Turni arrivati dopo l'ultimo aggiornamento in background
+    for i in range(10, 20):
+        archivio.aggiungi("utente", f"Follow-up {i}?", RISPOSTA_LUNGA)
+
+    contesto = memoria.contesto("utente", archivio.storia("utente"))
+
+    assert stima_token(contesto) <= 120
+    assert "Follow-up 19?" in contesto
+    assert "Follow-up 18?" in contesto
+
+
+def test_contesto_vuoto_senza_storia():
+    assert MemoriaConversazione(SessioniMemoria()).contesto("utente", []) == ""
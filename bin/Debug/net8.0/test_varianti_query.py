@@ -0,0 +1,35 @@
+#test_varianti_query.py
+# Test della fusione RRF di varianti_query.py.
+#   python -m pytest -q test_varianti_query.py
+import numpy as np
+import pytest
+
+from varianti_query import RRF_K, fondi_rrf
+
+
+def test_fondi_rrf_premia_i_documenti_trovati_da_piu_varianti():
+    indici = np.array([[5, 7, 9],
+                       [7, 5, -1],
+                       [7, 9, -1]])
+
+    fusi = fondi_rrf(indici)
+
+    assert [riga for riga, _ in fusi] == [7, 5, 9]
+    assert fusi[0][1] == pytest.approx(1 / (RRF_K + 2) + 2 / (RRF_K + 1))
+    assert [punteggio for _, punteggio in fusi] == sorted((p for _, p in fusi), reverse=True)
+
+
+def test_fondi_rrf_ignora_le_posizioni_vuote():
+    assert fondi_rrf(np.array([[-1, -1], [3, -1]])) == [(3, pytest.approx(1 / (RRF_K + 1)))]
+    assert fondi_rrf(np.full((2, 3), -1)) == []
+
+
+def test_fondi_rrf_una_sola_variante_mantiene_l_ordine():
+    assert [riga for riga, _ in fondi_rrf(np.array([[4, 2, 8, 1]]))] == [4, 2, 8, 1]
+
+
+def test_fondi_rrf_costante_piccola_favorisce_le_prime_posizioni():
+    # Primo per una variante contro terzo per due: con k piccolo vince la prima posizione
+    indici = np.array([[1, 5, 2], [3, 6, 2]])
+    assert [riga for riga, _ in fondi_rrf(indici, rrf_k=0)][:3] == [1, 3, 2]
+    assert fondi_rrf(indici)[0][0] == 2
@@ -0,0 +1,73 @@
+#varianti_query.py
+# Ricerca con più varianti della stessa domanda. Oltre alla query originale si cercano:
+#   - la domanda precedente unita a quella corrente, se quest'ultima è un breve follow-up
+#     ("and the side effects?"), così il retriever vede il contesto della conversazione
+#   - le sole parole chiave della query (come per PubMed), con i sinonimi delle categorie di
+#     ListaKeywords.json che vi compaiono
+# Le varianti vengono codificate in un unico batch e cercate con un'unica index.search su una matrice
+# di query; le liste di risultati vengono fuse con la Reciprocal Rank Fusion (RRF).
+import os
+from metadati import categorie_testo, parole_chiave_categoria
+
+# Numero massimo di varianti, originale compresa (1 = sola query originale, come prima)
+NUM_VARIANTI = int(os.environ.get("PROVA_VARIANTI_QUERY", "4"))
+# Una domanda con al massimo queste parole è trattata come follow-up della precedente
+PAROLE_FOLLOW_UP = 6
+SINONIMI_PER_CATEGORIA = 3
+# Costante della RRF: punteggio = somma su tutte le varianti di 1 / (RRF_K + posizione)
+RRF_K = 60
+
+
+def genera_varianti(query, storia=None, massimo=NUM_VARIANTI):
+    """
+    Varianti della query per la ricerca, la prima è sempre la query originale.
+
+    Args:
+        query (str): La query (già tradotta in inglese).
+        storia (list): I turni precedenti della conversazione; della domanda precedente si usa
+            la traduzione ("domanda_tradotta"), se salvata.
+        massimo (int): Numero massimo di varianti.
+
+    Returns:
+        list: Le varianti distinte.
+    """
+    # Import locale: pubmed dipende da requests, che la fusione RRF non richiede
+    from pubmed import pre_elabora_query
+
+    varianti = [query]
+    precedente = storia[-1].get("domanda_tradotta") if storia else None
+    if precedente and len(query.split()) <= PAROLE_FOLLOW_UP:
+        varianti.append(f"{precedente} {query}")
+
+    parole_chiave = pre_elabora_query(query)
+    if parole_chiave:
+        varianti.append(parole_chiave)
+        presenti = set(parole_chiave.split())
+        sinonimi = [parola for categoria in categorie_testo(query)
+                    for parola in [p for p in parole_chiave_categoria(categoria) if p not in presenti][:SINONIMI_PER_CATEGORIA]]
+        if sinonimi:
+            varianti.append(f"{parole_chiave} {' '.join(sinonimi)}")
+
+    distinte = {}
+    for variante in varianti:
+        distinte.setdefault(variante.strip().lower(), variante.strip())
+    return list(distinte.values())[:max(1, massimo)]
+
+
+def fondi_rrf(indici, rrf_k=RRF_K):
+    """
+    Fonde con la Reciprocal Rank Fusion i risultati di index.search per più varianti.
+
+    Args:
+        indici (numpy.ndarray): Matrice delle righe trovate, una riga della matrice per variante (-1 = nessun risultato).
+        rrf_k (int): Costante della RRF.
+
+    Returns:
+        list: Le righe dell'indice ordinate per punteggio RRF decrescente, con il punteggio.
+    """
+    punteggi = {}
+    for risultati in indici:
+        for posizione, riga in enumerate(risultati):
+            if riga >= 0:
+                punteggi[int(riga)] = punteggi.get(int(riga), 0.0) + 1.0 / (rrf_k + posizione + 1)
+    return sorted(punteggi.items(), key=lambda voce: voce[1], reverse=True)
@@ -0,0 +1,287 @@
+#vector_store.py
+# Archivio dei vettori del corpus. Oltre all'indice FAISS float32 (modalità "faiss", predefinita)
+# supporta un archivio su file memory-mapped a precisione ridotta:
+#   - "float16": metà della memoria, perdita di precisione trascurabile
+#   - "int8": un quarto della memoria, quantizzazione scalare con una scala per vettore
+# Con l'archivio memory-mapped tutti i processi condividono la page cache del sistema operativo,
+# quindi la memoria residente di ogni worker resta quasi costante al crescere del corpus.
+import os
+import sys
+import json
+import logging
+import argparse
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODALITA_VETTORI = os.environ.get("PROVA_VETTORI", "faiss")
+MODALITA_SUPPORTATE = ("faiss", "float16", "int8")
+
+# Righe dequantizzate per blocco durante la ricerca: limita la memoria temporanea per query
+RIGHE_PER_BLOCCO = 65536
+
+
+def percorsi_archivio(index_path, precisione):
+    """File che compongono l'archivio memory-mapped associato a un indice."""
+    base = os.path.splitext(index_path)[0]
+    return {
+        "vettori": f"{base}.{precisione}.vec",
+        "scale": f"{base}.{precisione}.scale",
+        "meta": f"{base}.{precisione}.json",
+    }
+
+
+class ArchivioMmap:
+    """
+    Vettori salvati in un file binario in sola aggiunta e letti tramite memory-map.
+
+    Espone la stessa interfaccia minima di un indice FAISS usata dal retriever
+    (d, ntotal, search, add). I file vengono solo estesi, mai riscritti: così i processi
+    che li hanno già mappati (anche su Windows) non bloccano le scritture.
+    """
+
+    def __init__(self, index_path, precisione, d):
+        if precisione not in ("float16", "int8"):
+            raise ValueError(f"Precisione non supportata: {precisione}")
+        self.index_path = index_path
+        self.precisione = precisione
+        self.d = d
+        self.percorsi = percorsi_archivio(index_path, precisione)
+        self._dtype = np.float16 if precisione == "float16" else np.int8
+        self._vettori = None
+        self._scale = None
+        self.ntotal = 0
+        self._mappa()
+
+    @classmethod
+    def apri(cls, index_path, precisione):
+        with open(percorsi_archivio(index_path, precisione)["meta"], 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(index_path, precisione, meta["d"])
+
+    @classmethod
+    def crea(cls, index_path, precisione, d):
+        """Crea un archivio vuoto (sovrascrivendo quello esistente)."""
+        percorsi = percorsi_archivio(index_path, precisione)
+        for chiave in ("vettori", "scale"):
+            open(percorsi[chiave], 'wb').close()
+        with open(percorsi["meta"], 'w', encoding='utf-8') as f:
+            json.dump({"d": d, "precisione": precisione}, f)
+        return cls(index_path, precisione, d)
+
+    def _mappa(self):
+        """Mappa in memoria le righe complete presenti su disco."""
+        righe = os.path.getsize(self.percorsi["vettori"]) // (self.d * np.dtype(self._dtype).itemsize)
+        if self.precisione == "int8":
+            righe = min(righe, os.path.getsize(self.percorsi["scale"]) // 4)
+        self.ntotal = righe
+        if righe == 0:
+            self._vettori = np.zeros((0, self.d), dtype=self._dtype)
+            self._scale = np.zeros((0,), dtype=np.float32)
+            return
+        self._vettori = np.memmap(self.percorsi["vettori"], dtype=self._dtype, mode='r', shape=(righe, self.d))
+        if self.precisione == "int8":
+            self._scale = np.memmap(self.percorsi["scale"], dtype=np.float32, mode='r', shape=(righe,))
+
+    def _quantizza(self, vettori):
+        if self.precisione == "float16":
+            return vettori.astype(np.float16), None
+        scale = np.abs(vettori).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        codici = np.clip(np.rint(vettori / scale[:, None]), -127, 127).astype(np.int8)
+        return codici, scale.astype(np.float32)
+
+    def _blocco(self, inizio, fine):
+        """Dequantizza in float32 le righe [inizio, fine)."""
+        blocco = np.asarray(self._vettori[inizio:fine], dtype=np.float32)
+        if self.precisione == "int8":
+            blocco *= np.asarray(self._scale[inizio:fine])[:, None]
+        return blocco
+
+    def _righe(self, posizioni):
+        """Dequantizza in float32 le righe indicate (solo quelle vengono lette dal disco)."""
+        blocco = np.asarray(self._vettori[posizioni], dtype=np.float32)
+        if self.precisione == "int8":
+            blocco *= np.asarray(self._scale[posizioni])[:, None]
+        return blocco
+
+    def add(self, vettori):
+        """Aggiunge vettori float32 in coda ai file e aggiorna la mappatura."""
+        vettori = np.ascontiguousarray(vettori, dtype=np.float32)
+        codici, scale = self._quantizza(vettori)
+        # Le scale vengono scritte prima: una riga è visibile solo quando esistono entrambe
+        if scale is not None:
+            with open(self.percorsi["scale"], 'ab') as f:
+                f.write(scale.tobytes())
+        with open(self.percorsi["vettori"], 'ab') as f:
+            f.write(codici.tobytes())
+        self._mappa()
+
+    def reconstruct_n(self, inizio, n):
+        return self._blocco(inizio, inizio + n)
+
+    def search(self, query, k, righe=None):
+        """
+        Ricerca esaustiva per distanza L2 al quadrato, come IndexFlatL2.
+        Con `righe` (array ordinato di posizioni) le distanze vengono calcolate solo su quelle righe.
+
+        Returns:
+            tuple: (distanze, indici), entrambi di forma (numero_query, k); -1 dove mancano risultati.
+        """
+        query = np.ascontiguousarray(query, dtype=np.float32)
+        n_query = query.shape[0]
+        migliori_d = np.full((n_query, k), np.inf, dtype=np.float32)
+        migliori_i = np.full((n_query, k), -1, dtype=np.int64)
+        norme_query = (query ** 2).sum(axis=1)[:, None]
+
+        totale = self.ntotal if righe is None else len(righe)
+        for inizio in range(0, totale, RIGHE_PER_BLOCCO):
+            fine = min(inizio + RIGHE_PER_BLOCCO, totale)
+            if righe is None:
+                blocco, posizioni = self._blocco(inizio, fine), np.arange(inizio, fine)
+            else:
+                posizioni = righe[inizio:fine]
+                blocco = self._righe(posizioni)
+            distanze = norme_query + (blocco ** 2).sum(axis=1)[None, :] - 2.0 * query @ blocco.T
+            # Unisce i migliori del blocco con i migliori trovati finora
+            tutte_d = np.concatenate([migliori_d, distanze], axis=1)
+            tutti_i = np.concatenate([migliori_i, np.broadcast_to(posizioni, (n_query, fine - inizio))], axis=1)
+            kk = min(k, tutte_d.shape[1])
+            scelti = np.argpartition(tutte_d, kk - 1, axis=1)[:, :kk]
+            migliori_d = np.take_along_axis(tutte_d, scelti, axis=1)
+            migliori_i = np.take_along_axis(tutti_i, scelti, axis=1)
+
+        ordine = np.argsort(migliori_d, axis=1)
+        migliori_d = np.take_along_axis(migliori_d, ordine, axis=1)
+        migliori_i = np.take_along_axis(migliori_i, ordine, axis=1)
+        migliori_d[migliori_i < 0] = np.inf
+        return np.maximum(migliori_d, 0), migliori_i
+
+
+def _file_indice(index_path, modalita=MODALITA_VETTORI):
+    """File principale dell'indice nella modalità indicata (per verificarne l'esistenza)."""
+    if modalita == "faiss":
+        return index_path
+    return percorsi_archivio(index_path, modalita)["meta"]
+
+
+def esiste_indice(index_path, modalita=MODALITA_VETTORI):
+    return os.path.exists(_file_indice(index_path, modalita))
+
+
+def firma_file(percorso):
+    """Data di modifica e dimensione di un file, oppure None se non esiste."""
+    try:
+        stat = os.stat(percorso)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def firma_indice(index_path, modalita=MODALITA_VETTORI):
+    """Dimensione e data di modifica dei dati dell'indice: cambiano a ogni scrittura."""
+    return firma_file(index_path if modalita == "faiss" else percorsi_archivio(index_path, modalita)["vettori"])
+
+
+def apri_indice(index_path, modalita=MODALITA_VETTORI):
+    """
+    Apre l'indice nella modalità configurata. Se l'archivio memory-mapped non esiste
+    ma c'è un indice FAISS, lo converte automaticamente.
+    """
+    if modalita == "faiss":
+        import faiss
+        return faiss.read_index(index_path)
+    if not esiste_indice(index_path, modalita) and os.path.exists(index_path):
+        converti(index_path, modalita)
+    return ArchivioMmap.apri(index_path, modalita)
+
+
+def crea_indice(vettori, index_path, d=None, modalita=MODALITA_VETTORI):
+    """Crea (sovrascrivendolo) l'indice con i vettori dati e lo salva su disco."""
+    d = d if d is not None else vettori.shape[1]
+    if modalita == "faiss":
+        import faiss
+        index = faiss.IndexFlatL2(d)
+        if len(vettori):
+            index.add(np.ascontiguousarray(vettori, dtype=np.float32))
+        faiss.write_index(index, index_path)
+        return index
+    archivio = ArchivioMmap.crea(index_path, modalita, d)
+    if len(vettori):
+        archivio.add(vettori)
+    return archivio
+
+
+def cerca(index, query, k, righe=None):
+    """
+    Ricerca dei k vicini, eventualmente limitata alle righe indicate (ricerca con filtro sui metadati).
+    Con FAISS usa un IDSelector, così le distanze vengono calcolate solo per le righe selezionate.
+
+    Returns:
+        tuple: (distanze, indici) come index.search, con le posizioni nell'indice completo.
+    """
+    if righe is None:
+        return index.search(query, k)
+    righe = np.ascontiguousarray(righe, dtype=np.int64)
+    k = min(k, len(righe))
+    if k == 0:
+        return np.zeros((len(query), 0), dtype=np.float32), np.zeros((len(query), 0), dtype=np.int64)
+    if isinstance(index, ArchivioMmap):
+        return index.search(query, k, righe=righe)
+    import faiss
+    try:
+        parametri = faiss.SearchParameters(sel=faiss.IDSelectorBatch(righe))
+        return index.search(query, k, params=parametri)
+    except (AttributeError, TypeError):
+        # Versioni di FAISS senza SearchParameters: distanze calcolate sui soli vettori selezionati
+        vettori = np.vstack([index.reconstruct(int(i)) for i in righe])
+        distanze = (query ** 2).sum(axis=1)[:, None] + (vettori ** 2).sum(axis=1)[None, :] - 2.0 * query @ vettori.T
+        migliori = np.argsort(distanze, axis=1)[:, :k]
+        return np.maximum(np.take_along_axis(distanze, migliori, axis=1), 0), righe[migliori]
+
+
+def salva_indice(index, index_path):
+    """Rende persistenti le aggiunte all'indice (l'archivio memory-mapped scrive già in add)."""
+    if isinstance(index, ArchivioMmap):
+        return
+    import faiss
+    faiss.write_index(index, index_path)
+
+
+def elimina_indice(index_path):
+    """Elimina l'indice FAISS e tutti gli archivi memory-mapped associati."""
+    percorsi = [index_path]
+    for precisione in ("float16", "int8"):
+        percorsi.extend(percorsi_archivio(index_path, precisione).values())
+    for percorso in percorsi:
+        if os.path.exists(percorso):
+            os.remove(percorso)
+
+
+def converti(index_path, precisione):
+    """Converte l'indice FAISS float32 esistente in un archivio memory-mapped."""
+    import faiss
+
+    index = faiss.read_index(index_path)
+    vettori = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+    archivio = crea_indice(vettori, index_path, d=index.d, modalita=precisione)
+    dimensione = sum(os.path.getsize(p) for p in percorsi_archivio(index_path, precisione).values())
+    logger.info(f"Indice convertito in {precisione}: {archivio.ntotal} vettori, "
+                f"{os.path.getsize(index_path) / 1e6:.1f} MB -> {dimensione / 1e6:.1f} MB")
+    return archivio
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Conversione dell'indice FAISS in un archivio memory-mapped")
+    parser.add_argument("precisione", choices=["float16", "int8"])
+    parser.add_argument("--indice", default="faiss_index.index")
+    args = parser.parse_args()
+    if not os.path.exists(args.indice):
+        sys.exit(f"Indice {args.indice} non trovato")
+    converti(args.indice, args.precisione)
+    print(f"Avvia il server con PROVA_VETTORI={args.precisione} per usare l'archivio.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#warmup.py
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Stati possibili di un componente
+IN_ATTESA = "in_attesa"
+IN_CARICAMENTO = "in_caricamento"
+PRONTO = "pronto"
+ERRORE = "errore"
+
+
+class Componente:
+    """Un componente caricato in background (modello, indice, ...) e il suo stato."""
+
+    def __init__(self, nome, caricatore):
+        self.nome = nome
+        self.caricatore = caricatore
+        self.stato = IN_ATTESA
+        self.errore = None
+        self.durata = None
+        self._lock = threading.Lock()
+
+    def carica(self):
+        """Esegue il caricatore una sola volta, aggiornando lo stato del componente."""
+        with self._lock:
+            if self.stato == PRONTO:
+                return
+            self.stato = IN_CARICAMENTO
+            inizio = time.perf_counter()
+            try:
+                self.caricatore()
+                self.stato = PRONTO
+                self.errore = None
+                logger.info(f"Componente '{self.nome}' pronto in {time.perf_counter() - inizio:.1f}s")
+            except Exception as e:
+                self.stato = ERRORE
+                self.errore = str(e)
+                logger.error(f"Errore nel caricamento del componente '{self.nome}': {e}")
+            finally:
+                self.durata = time.perf_counter() - inizio
+
+    def descrizione(self):
+        return {
+            "stato": self.stato,
+            "errore": self.errore,
+            "durata_secondi": round(self.durata, 3) if self.durata is not None else None,
+        }
+
+
+_componenti = {}
+
+
+def registra_componente(nome, caricatore):
+    """Registra un componente da caricare durante il warm-up."""
+    _componenti[nome] = Componente(nome, caricatore)
+
+
+def avvia_warmup():
+    """
+    Avvia il caricamento di tutti i componenti registrati, ognuno nel proprio thread,
+    senza bloccare l'avvio del server.
+    """
+    for componente in _componenti.values():
+        threading.Thread(target=componente.carica, name=f"warmup-{componente.nome}", daemon=True).start()
+    logger.info(f"Warm-up avviato per {len(_componenti)} componenti: {', '.join(_componenti)}")
+
+
+def stato_componenti():
+    """Restituisce lo stato di ogni componente registrato."""
+    return {nome: componente.descrizione() for nome, componente in _componenti.items()}
+
+
+def componenti_pronti(nomi=None):
+    """Indica se i componenti indicati (o tutti) sono pronti."""
+    nomi = _componenti.keys() if nomi is None else nomi
+    return all(nome in _componenti and _componenti[nome].stato == PRONTO for nome in nomi)
+
+
+def componenti_in_errore(nomi=None):
+    """Restituisce, per i componenti indicati (o tutti) il cui caricamento è fallito, il messaggio d'errore."""
+    nomi = _componenti.keys() if nomi is None else nomi
+    return {nome: _componenti[nome].errore for nome in nomi if nome in _componenti and _componenti[nome].stato == ERRORE}
+
+
+def caricamento_terminato():
+    """Indica se il caricamento di tutti i componenti è finito, con successo o con errore."""
+    return all(componente.stato in (PRONTO, ERRORE) for componente in _componenti.values())